@@ -0,0 +1,301 @@
+"""
+End-to-end throughput benchmark of the pipeline
+CloneDetection and LogRemover run on a fixed, locally generated corpus in a scratch folder (temp/benchmark), with
+NiCad (and optionally the JavaFormatter JVM) replaced by deterministic stubs so that it runs anywhere.
+Every stage runs in its own forked process; projects/sec, MB/sec and peak RSS are appended to
+    result/benchmark/history.csv
+and compared with the baseline of the current host (result/benchmark/baseline_<host>.json).
+The command fails (exit code 1) when a stage is slower than the baseline by more than the threshold.
+
+Usage:
+    python src/benchmark/benchmark.py [--projects 20] [--threshold 0.2] [--update_baseline]
+    python src/benchmark/benchmark.py --nicad real --java real
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import tarfile
+import atexit
+import argparse
+import resource
+import subprocess
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import pandas as pd
+import src.util.utils as utils
+
+D_RESULT = os.path.join(utils.get_proj_root(), 'result', 'benchmark')
+D_WORK = os.path.join(utils.get_proj_root(), 'temp', 'benchmark')
+STAGES = ['clone_detection', 'log_remove']
+SIZE_TYPE = 'bench'
+
+# Deterministic NiCad stand-in: writes the extraction and an empty clone report in NiCad's layout
+NICAD_STUB = r'''#!/bin/sh
+granularity=$1; system=$3; config=$4
+find "$system" -type f -name '*.java' | sort | while read -r f; do
+    printf '<source file="%s" startline="1" endline="%s">\n' "$f" "$(wc -l < "$f" | tr -d ' ')"
+    cat "$f"
+    printf '</source>\n'
+done > "${system}_${granularity}.xml"
+mkdir -p "${system}_${granularity}-clones"
+printf '<clones>\n<systeminfo processor="nicad6_stub" system="%s" granularity="%s"/>\n</clones>\n' \
+    "$(basename "$system")" "$granularity" > "${system}_${granularity}-clones/$(basename "$system")_${granularity}-clones-0.00.xml"
+'''
+JAVA_STUB = '#!/bin/sh\nexit 0\n'
+
+_JAVA_METHOD = '''    public int m{k}(int a) {{
+        log.info("m{k} called with " + a);
+        int b = a * {x};
+        if (log.isDebugEnabled()) {{
+            log.debug("b is " + b);
+        }}
+        for (int i = 0; i < {y}; i++) {{
+            b += i % {z};
+        }}
+        log.warn("m{k} returns {{}}", b);
+        return b;
+    }}'''
+
+
+def generate_corpus(d, n_projects=20, n_files=20, n_methods=10, seed=0):
+    """
+    Generate the benchmark corpus: projects of java files logging with slf4j, compressed as the original dataset
+    Parameters
+    ----------
+    d: The corpus folder
+    n_projects: The number of projects
+    n_files: The number of java files per project
+    n_methods: The number of methods per java file
+    seed: The random seed
+
+    Returns
+    -------
+    df: The SLOC catalog of the corpus (filesize_sloc_<size> columns plus size_mb)
+    """
+    rnd = random.Random(seed)
+    rows = []
+    for p in range(n_projects):
+        project_id = 1000 + p
+        repo_name = 'bench%d' % p
+        d_proj = os.path.join(d, 'src', repo_name)
+        n_bytes = n_lines = 0
+        for i in range(n_files):
+            methods = [_JAVA_METHOD.format(k=k, x=rnd.randint(2, 9), y=rnd.randint(2, 99), z=rnd.randint(2, 9))
+                       for k in range(n_methods)]
+            code = ('package bench.p{p};\n\nimport org.slf4j.Logger;\nimport org.slf4j.LoggerFactory;\n\n'
+                    'public class C{i} {{\n    private static final Logger log = LoggerFactory.getLogger(C{i}.class);\n\n'
+                    '{methods}\n}}\n').format(p=p, i=i, methods='\n\n'.join(methods))
+            f = os.path.join(d_proj, 'src', 'bench', 'p%d' % p, 'C%d.java' % i)
+            utils.create_folder_if_not_exist(os.path.dirname(f))
+            with open(f, 'w') as w:
+                w.write(code)
+            n_bytes += len(code)
+            n_lines += code.count('\n')
+        repo_path = os.path.join(d, 'bench_%s.tar.gz' % repo_name)
+        with tarfile.open(repo_path, 'w:gz') as tar:
+            tar.add(d_proj, arcname=repo_name)
+        rows.append({'project_id': project_id, 'git_url': '', 'repo_name': repo_name,
+                     'owner_repo': 'bench/%s' % repo_name, 'repo_path': repo_path, 'size': SIZE_TYPE, 'Name': 'Java',
+                     'Bytes': n_bytes, 'CodeBytes': 0, 'Lines': n_lines, 'Code': n_lines, 'Comment': 0, 'Blank': 0,
+                     'Complexity': 0, 'Count': n_files, 'WeightedComplexity': 0, 'Files': '[]',
+                     'size_mb': n_bytes / 1024 / 1024})
+    shutil.rmtree(os.path.join(d, 'src'))
+    return pd.DataFrame(rows)
+
+
+def prepare_workdir(args):
+    """
+    Create a clean scratch folder with the corpus, the stubs and the inputs the pipeline expects
+    Returns
+    -------
+    d_work, df_corpus, env: The scratch folder, the corpus catalog and the environment of all stages
+    """
+    d_corpus = os.path.join(D_WORK, 'corpus_{}_{}_{}'.format(args.projects, args.files, args.methods))
+    f_catalog = os.path.join(d_corpus, 'catalog.csv')
+    if not os.path.isfile(f_catalog):
+        # The corpus is generated once and reused by later runs
+        shutil.rmtree(d_corpus, ignore_errors=True)
+        generate_corpus(d_corpus, args.projects, args.files, args.methods).to_csv(f_catalog, index=False)
+    df = utils.csv_loader(f_catalog)
+
+    d_work = os.path.join(D_WORK, 'run')
+    shutil.rmtree(d_work, ignore_errors=True)
+    for d in ['conf', 'result/proj_sloc', 'result/proj_size', 'result/proj_sample', 'stub/bin', 'temp']:
+        utils.create_folder_if_not_exist(os.path.join(d_work, d))
+    shutil.copy(os.path.join(utils.get_proj_root(), 'conf', 'lu_levels.json'), os.path.join(d_work, 'conf'))
+    df.drop(columns='size_mb').to_csv(
+        os.path.join(d_work, 'result/proj_sloc/filesize_sloc_%s.csv' % SIZE_TYPE), index=False)
+    df[['project_id', 'git_url', 'repo_name', 'owner_repo', 'repo_path', 'size_mb']].to_csv(
+        os.path.join(d_work, 'result/proj_size/filesize_mb_%s.csv' % SIZE_TYPE), index=False)
+    pd.DataFrame({'project': ['%d-%s' % (x, y) for x, y in zip(df['project_id'], df['repo_name'])],
+                  'others': '', 'slf4j': True}).to_csv(os.path.join(d_work, 'conf', 'log_all_stats.csv'), index=False)
+
+    env = {'LOGGINGBENCH_REPO_ZIPPED_ROOT': d_corpus,
+           'LOGGINGBENCH_TEMP_PROJ_ROOT': os.path.join(d_work, 'temp'),
+           'LOGGINGBENCH_CLEAN_REPO_ARCHIVE_ROOT': os.path.join(d_work, 'temp', 'cleaned_archive')}
+    if args.nicad == 'stub':
+        f_stub = os.path.join(d_work, 'stub', 'nicad6')
+        with open(f_stub, 'w') as w:
+            w.write(NICAD_STUB)
+        os.chmod(f_stub, 0o755)
+        env['LOGGINGBENCH_NICAD_ROOT'] = os.path.dirname(f_stub)
+    f_jar = os.path.join(utils.get_proj_root(), 'resources', 'javaformatter', 'JavaFormatter.jar')
+    if args.java == 'stub' or (args.java == 'auto' and (shutil.which('java') is None or not os.path.isfile(f_jar))):
+        args.java = 'stub'
+        f_stub = os.path.join(d_work, 'stub', 'bin', 'java')
+        with open(f_stub, 'w') as w:
+            w.write(JAVA_STUB)
+        os.chmod(f_stub, 0o755)
+        env['PATH'] = os.path.dirname(f_stub) + os.pathsep + os.environ.get('PATH', '')
+    else:
+        args.java = 'real'
+    return d_work, df, env
+
+
+def _stage_clone_detection(df):
+    from src.clone_detection.clone_detection import CloneDetection, parallel_run
+    cdetec = CloneDetection(language='java', granularity='functions', clonetype='type1', remove_logging=False)
+    parallel_run(df=df, func=cdetec.clone_detection_in_project)
+
+
+def _stage_log_remove(df):
+    from src.log_remove.log_remover import LogRemover
+    logremover = LogRemover(f_removal='result/log_remove/logging_removal_lines.json',
+                            sample_dir='result/proj_sample',
+                            f_log_stats='conf/log_all_stats.csv',
+                            repeats=1,
+                            sample_percentage=1.0,
+                            sample_sizes=[SIZE_TYPE],
+                            is_ignore_failed_clone_detections=False)
+    logremover.logger_detector(1)
+    logremover.removal_sink.compact()
+
+
+def run_stage(stage, d_work, df, env):
+    """
+    Run a stage in a forked process
+    Returns
+    -------
+    dict: seconds and peak_rss_mb (the largest single process of the stage)
+    """
+    f_out = os.path.join(d_work, '%s.json' % stage)
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            os.chdir(d_work)
+            os.environ.update(env)
+            func = globals()['_stage_' + stage]
+            start = time.time()
+            func(df.drop(columns='size_mb'))
+            seconds = time.time() - start
+            with open(f_out, 'w') as w:
+                json.dump({'seconds': seconds,
+                           'children_maxrss': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}, w)
+            code = 0
+        finally:
+            # os._exit skips atexit, which stops daemon children such as the log listener
+            atexit._run_exitfuncs()
+            sys.stdout.flush()
+            os._exit(code)
+    _, status, rusage = os.wait4(pid, 0)
+    if os.waitstatus_to_exitcode(status) != 0 or not os.path.isfile(f_out):
+        raise RuntimeError('Benchmark stage %s failed' % stage)
+    with open(f_out) as r:
+        out = json.load(r)
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    out['peak_rss_mb'] = max(rusage.ru_maxrss, out.pop('children_maxrss')) / unit
+    return out
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=utils.get_proj_root(),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def check_regressions(records, f_baseline, threshold):
+    """
+    Compare throughput with the baseline
+    Returns
+    -------
+    list of messages, one per regressed stage
+    """
+    if not os.path.isfile(f_baseline):
+        return []
+    with open(f_baseline) as r:
+        baseline = json.load(r)
+    regressions = []
+    for record in records:
+        base = baseline.get(record['stage'])
+        if base is None: continue
+        for metric in ['projects_per_sec', 'mb_per_sec']:
+            if record[metric] < base[metric] * (1 - threshold):
+                regressions.append('%s %s: %.3f vs baseline %.3f (-%.0f%%)' % (
+                    record['stage'], metric, record[metric], base[metric],
+                    100 * (1 - record[metric] / base[metric])))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End-to-end throughput benchmark')
+    parser.add_argument('--projects', type=int, default=20, help="The number of generated projects")
+    parser.add_argument('--files', type=int, default=20, help="The number of java files per project")
+    parser.add_argument('--methods', type=int, default=10, help="The number of methods per java file")
+    parser.add_argument('--stages', type=str, default=','.join(STAGES), help="Comma separated stages to run")
+    parser.add_argument('--nicad', choices=['stub', 'real'], default='stub',
+                        help="Run the NiCad stub or the NiCad installation of this host")
+    parser.add_argument('--java', choices=['auto', 'stub', 'real'], default='auto',
+                        help="Run JavaFormatter or skip it with a stub; auto uses it if java and the jar are available")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="Fail if a stage is slower than the baseline by more than this fraction")
+    parser.add_argument('--update_baseline', action='store_true',
+                        help="Save the throughput of this run as the baseline of this host")
+    args = parser.parse_args()
+
+    d_work, df, env = prepare_workdir(args)
+    mb = df['size_mb'].sum()
+    utils.create_folder_if_not_exist(D_RESULT)
+    host = socket.gethostname()
+    records = []
+    for stage in [x.strip() for x in args.stages.split(',')]:
+        if stage not in STAGES:
+            raise ValueError('Unknown stage %s; choose from %s' % (stage, STAGES))
+        out = run_stage(stage, d_work, df, env)
+        records.append({'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'commit': _git_commit(), 'host': host,
+                        'workers': utils.getWorkers(), 'stage': stage, 'nicad': args.nicad, 'java': args.java,
+                        'pandas': pd.__version__, 'projects': len(df), 'mb': round(mb, 3),
+                        'seconds': round(out['seconds'], 3),
+                        'projects_per_sec': len(df) / out['seconds'], 'mb_per_sec': mb / out['seconds'],
+                        'peak_rss_mb': round(out['peak_rss_mb'], 1)})
+        print('{stage}: {projects_per_sec:.2f} projects/s, {mb_per_sec:.2f} MB/s, peak RSS {peak_rss_mb} MB'.format(
+            **records[-1]))
+
+    # Append only: the header is written with the first record
+    f_history = os.path.join(D_RESULT, 'history.csv')
+    pd.DataFrame(records).to_csv(f_history, mode='a', index=False, header=not os.path.isfile(f_history))
+
+    f_baseline = os.path.join(D_RESULT, 'baseline_%s.json' % host)
+    regressions = check_regressions(records, f_baseline, args.threshold)
+    if args.update_baseline:
+        baseline = {}
+        if os.path.isfile(f_baseline):
+            with open(f_baseline) as r:
+                baseline = json.load(r)
+        baseline.update({r['stage']: {k: r[k] for k in ['projects_per_sec', 'mb_per_sec', 'commit', 'time']}
+                         for r in records})
+        with open(f_baseline, 'w') as w:
+            json.dump(baseline, w, indent=4)
+        print('Baseline saved in %s' % f_baseline)
+    elif regressions:
+        print('Throughput regressed beyond %.0f%%:\n  %s' % (args.threshold * 100, '\n  '.join(regressions)))
+        sys.exit(1)
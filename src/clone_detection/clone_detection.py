@@ -2,26 +2,39 @@
 Clone detection in selected java projects
 
 """
+import asyncio
 import multiprocessing
 import os
 import logging
+import signal
 import sys
+import time
 from numpy import datetime64
 import pandas as pd
 import shutil
 import tarfile
 import glob
-import subprocess
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, nullcontext
 from pandarallel import pandarallel
 from datetime import datetime
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
 import src.util.utils as utils
+import src.util.child_usage as child_usage
+from src.util.admission import AdmissionController, load_size_estimates
+from src.util.work_queue import open_work_queue, run_leased_workers
+from src.util.result_sink import CsvResultSink
+from src.util.corpus_archive import ProjectArchive
+from src.util.metrics import RunMetrics, fail, iterrows, reporting, track
+from src.util.profiler import ProfiledWorker, merge_profiles, record_child_wait
+from src.util.runtime_model import RuntimeModel, balanced_chunks, longest_first, log_eta
+from src.clone_detection.fragment_cache import FragmentCache
+from src.clone_detection.nicad_batch import BatchSplitter
 from src.log_remove.log_remover import LogRemover
 
 logger = logging.getLogger(__name__)
-lock = utils.setRWLock()
 
 
 class CloneDetection:
@@ -30,7 +43,10 @@ class CloneDetection:
         self.language = language
         self.granularity = granularity
         self.clonetype = clonetype
-        self.NiCadRoot = utils.getPath('NICAD_ROOT')
+        # All (granularity, clonetype) configurations; granularity and clonetype may be comma separated lists
+        # Configurations of the same granularity are adjacent, so NiCad reuses their extraction
+        self.configs = list(dict.fromkeys(
+            (g.strip(), t.strip()) for g in granularity.split(',') for t in clonetype.split(',')))
         # The temp folder for tar file to decompress and anlayze
         self.remove_logging = remove_logging
         if remove_logging:
@@ -41,87 +57,480 @@ class CloneDetection:
         # Result archive path
         self.res_dir = 'result/clone_detection'
         utils.create_folder_if_not_exist(self.res_dir)
+        if len(self.configs) > 1:
+            # Results of each configuration are saved in their own folder
+            for config in self.configs:
+                utils.create_folder_if_not_exist(os.path.join(self.res_dir, '_'.join(config)))
         self.f_nicad_check = os.path.join(self.res_dir, 'clone_detection_check.csv')
+        # Every worker writes its own shard; shards are merged into f_nicad_check after the run
+        # One row per project and NiCad configuration
+        self.nicad_check_sink = CsvResultSink(self.f_nicad_check, key=['project_id', 'granularity', 'clonetype'])
+        # Wall time, CPU and peak RSS of the child processes of every project, per tool
+        self.child_usage_sink = CsvResultSink(os.path.join(self.res_dir, 'child_usage.csv'),
+                                              key=['project_id', 'tool'])
         # Folder to save logging removed projects in compressed format
         self.d_archive_logging_removed = utils.getPath('CLEAN_REPO_ARCHIVE_ROOT', ischeck=False)
         utils.create_folder_if_not_exist(self.d_archive_logging_removed)
         # Folder to store the nicad log of failed clone detections
         self.d_failed_nicad_logs = 'temp/failed_nicad_logs'
         utils.create_folder_if_not_exist(self.d_failed_nicad_logs)
+        # Folder to store the streamed NiCad output of each project (asyncio runner)
+        self.d_nicad_logs = 'log/clone_detection/nicad'
+        utils.create_folder_if_not_exist(self.d_nicad_logs)
         # Preserved object for log removing
         self.logremover = None
-        
+        # Preserved object for live progress metrics (RunMetrics), shared with the forked workers
+        self.metrics = None
+        # Preserved object for disk/memory admission control
+        self.admission = None
+        # Preserved object for reusing fragments of the original-project run (logging removal only)
+        self.fragment_cache = None
+        # Seconds allowed to the external tools of a project (plus timeout_per_kloc per KLOC), None for no limit
+        self.timeout = None
+        self.timeout_per_kloc = 0
+        # Small projects (up to nicad_batch_max_mb of java code) are detected nicad_batch at a time, 1 to disable
+        self.nicad_batch = 1
+        self.nicad_batch_max_mb = 1
+
+    @property
+    def NiCadRoot(self):
+        # Looked up on first use, so that detectors without NiCad (see token_clone_detection.py) run anywhere
+        return utils.getPath('NICAD_ROOT')
+
+    def _admit(self, row):
+        """
+        Reserve disk/memory budget for a project if admission control is enabled
+        """
+        if self.admission is None:
+            return nullcontext()
+        return self.admission.reserve(row)
+
+    def _admit_all(self, rows):
+        """
+        Reserve the budget of several projects at once if admission control is enabled
+        """
+        if self.admission is None:
+            return nullcontext()
+        return self.admission.reserve_all(rows)
+
+    def _timeout(self, row, timeout=None):
+        """
+        Seconds allowed to the external tools of a project, scaled with its size; None for no limit
+        """
+        return child_usage.scaled_timeout(row, timeout if timeout is not None else self.timeout,
+                                          self.timeout_per_kloc)
+
+    def _res_tar_f(self, row, granularity, clonetype):
+        """
+        The result tar file of a project under a configuration
+        A single configuration keeps the flat layout result/clone_detection/<id>_<archive>,
+        several configurations are saved as result/clone_detection/<granularity>_<clonetype>/<id>_<archive>
+        """
+        f = '_'.join([str(row['project_id']), os.path.basename(row['repo_path'])])
+        if len(self.configs) == 1:
+            return os.path.join(self.res_dir, f)
+        return os.path.join(self.res_dir, '_'.join([granularity, clonetype]), f)
+
+    def _pending_configs(self, row):
+        """
+        The configurations whose results of a project are not on file yet
+        Returns
+        -------
+        list of (granularity, clonetype, res_tar_f)
+        """
+        configs = [(g, t, self._res_tar_f(row, g, t)) for g, t in self.configs]
+        # Skip detecting if analyzed file already exists
+        # This is to handle cases when server breakdown
+        return [c for c in configs if not os.path.isfile(c[2])]
+
+    def _nicad_cmd(self, proj_dir, granularity, clonetype):
+        # Example: ./nicad5 functions java systems/JHotDraw54b1 default-report
+        return ' '.join(['./nicad6', granularity, self.language, proj_dir, clonetype])
+
+    def _snapshot_outputs(self, tmp_out_proj_dir, granularity):
+        """
+        The files in NiCad result folders of a granularity and their modification time,
+        so that the outputs of the next configuration can be told apart
+        """
+        snapshot = {}
+        for d in glob.glob(tmp_out_proj_dir + '_{}*'.format(granularity)):
+            for root, _, files in os.walk(d):
+                for f in files:
+                    f = os.path.join(root, f)
+                    snapshot[f] = os.stat(f).st_mtime_ns
+        return snapshot
 
     def clone_detection_in_project(self, df):
         """
         Perform clone detection with NiCad 6.2
+        Small projects are detected in batches if nicad_batch is above 1 (see nicad_batch.py)
         Returns
         -------
         df: The dataframe with projects to be analyzed
         """
+        batches, df = self._nicad_batches(df)
+        for df_batch in batches:
+            self.clone_detection_batch(df_batch)
         for i, row in df.iterrows():
-            repo_path = row['repo_path']
-            repo_id = row['project_id']
+            with track(self.metrics, row) as progress:
+                self._clone_detection_project(row, progress)
 
-            # Save all results into a tar file
-            res_tar_f = os.path.join(self.res_dir, '_'.join([str(repo_id), os.path.basename(repo_path)]))
+    def _clone_detection_project(self, row, progress):
+        """
+        Clone detection of a single project, saving the results of each configuration into a tar file
+        Parameters
+        ----------
+        row: dataframe row, records the information of a project
+        progress: The Progress of the project, failed if a configuration fails
+        """
+        repo_path = row['repo_path']
+        repo_id = row['project_id']
 
-            # Skip detecting if analyzed file already exists
-            # This is to handle cases when server breakdown
-            if os.path.isfile(res_tar_f): continue
+        # Save all results into a tar file per configuration
+        configs = self._pending_configs(row)
+        if not configs: return
 
-            if not os.path.isfile(repo_path):
-                logger.error('Unable to find path: {}'.format(repo_path))
-                continue
+        if not os.path.isfile(repo_path):
+            logger.error('Unable to find path: {}'.format(repo_path))
+            progress.fail()
+            return
 
+        with self._admit(row), utils.log_context(project_id=repo_id), child_usage.collect() as usage, \
+                child_usage.deadline(self._timeout(row)):
+            start = time.time()
             # The project will be decompressed under this directory, and NiCad results will be written here as well
             tmp_out_dir = os.path.abspath(os.path.join(self.tmp, str(repo_id)))
 
-            # Clean temp project if it exists. This could happen when a previous job collapsed
-            if os.path.isdir(tmp_out_dir):
-                shutil.rmtree(tmp_out_dir)
+            # Decompress tar to temp folder, once for all configurations
+            tmp_out_proj_dir = self._extract_project(repo_path, tmp_out_dir)
+
+            res_tar_fs = []
+            for granularity, clonetype, res_tar_f in configs:
+                # NiCad clone deteciton
+                cmd = self._nicad_cmd(tmp_out_proj_dir, granularity, clonetype)
+                snapshot = self._snapshot_outputs(tmp_out_proj_dir, granularity) if len(self.configs) > 1 else None
+                try:
+                    p = child_usage.run(cmd, tool='nicad6', shell=True, cwd=self.NiCadRoot)
+                except child_usage.ChildTimeout:
+                    # The other configurations would not get any time either
+                    logger.error('Clone detection timed out after {:.0f}s at project {}'.format(
+                        self._timeout(row), row['repo_name']))
+                    self.backup_failed_log(tmp_out_dir)
+                    break
+                except Exception as e:
+                    logger.error('Clone detection fail at project {}, {}'.format(row['repo_name'], str(e)))
+                    continue
+                # Check if process succeed
+                if p.returncode != 0:
+                    logger.error('Error in running clone detection for project {}. Command: {}"'.format(
+                        row['repo_name'], cmd
+                    ))
+                    continue
+
+                # Move result to location
+                self._archive_nicad_results(tmp_out_proj_dir, res_tar_f, granularity, snapshot)
+                res_tar_fs.append(res_tar_f)
+            if res_tar_fs:
+                logger.info('Clone detection finished in {:.1f}s. Results are saved in {}'.format(
+                    time.time() - start, ', '.join(res_tar_fs)))
+            if len(res_tar_fs) < len(configs):
+                progress.fail()
+            # Remove temp out folder
+            shutil.rmtree(tmp_out_dir)
+        self.record_child_usage(row, usage)
 
-            # Decompress tar to temp folder
-            tar = tarfile.open(repo_path, "r:gz")
-            tar.extractall(path=tmp_out_dir)
-            tar.close()
-
-            # The temporary decompressed project directory
-            tmp_out_proj_dir = os.path.join(tmp_out_dir, os.listdir(tmp_out_dir)[0])
-
-            # NiCad clone deteciton
-            # Example: ./nicad5 functions java systems/JHotDraw54b1 default-report
-            cmd = ' '.join([
-                './nicad6',
-                self.granularity,
-                self.language,
-                tmp_out_proj_dir,
-                self.clonetype
-            ])
-            p = subprocess.Popen(cmd, shell=True, cwd=self.NiCadRoot)
-            try:
-                p.communicate()
-            except Exception as e:
-                logger.error('Clone detection fail at project {}, {}'.format(row['repo_name'], str(e)))
-                shutil.rmtree(tmp_out_dir)
-                continue
-            # Check if process succeed
-            if p.returncode != 0:
-                logger.error('Error in running clone detection for project {}. Command: {}"'.format(
-                    row['repo_name'], cmd
-                ))
-                shutil.rmtree(tmp_out_dir)
-                continue
+    def _nicad_batches(self, df):
+        """
+        Split the projects into batches of small projects and the projects detected one by one
+        Returns
+        -------
+        (batches, df): The dataframes of the batches, and the dataframe of the other projects
+        """
+        if self.nicad_batch <= 1 or df.empty or 'Bytes' not in df.columns:
+            return [], df
+        small = pd.Series([row['Bytes'] <= self.nicad_batch_max_mb * 1024 * 1024 and os.path.isfile(row['repo_path'])
+                           and bool(self._pending_configs(row)) for _, row in df.iterrows()], index=df.index)
+        df_small = df[small.values]
+        batches = [df_small.iloc[i:i + self.nicad_batch] for i in range(0, len(df_small), self.nicad_batch)]
+        if batches and len(batches[-1]) == 1:
+            # A batch of one project is no cheaper than the project alone
+            return batches[:-1], pd.concat([df[~small.values], batches[-1]])
+        return batches, df[~small.values]
+
+    def clone_detection_batch(self, df):
+        """
+        Clone detection of several small projects with one NiCad run per configuration (see nicad_batch.py)
+        The results of every project are saved as if NiCad ran on the project alone; if NiCad fails on the batch,
+        the projects without results are detected one by one
+        Parameters
+        ----------
+        df: The dataframe with the projects of the batch
+        """
+        rows = [row for _, row in df.iterrows()]
+        d_batch = os.path.abspath(os.path.join(self.tmp, 'batch_{}'.format(rows[0]['project_id'])))
+        timeouts = [self._timeout(row) for row in rows]
+        with ExitStack() as stack:
+            progress = [stack.enter_context(track(self.metrics, row)) for row in rows]
+            # The whole batch is admitted at once; holding part of it while waiting for the rest can deadlock workers
+            stack.enter_context(self._admit_all(rows))
+            pending = {str(row['project_id']): self._pending_configs(row) for row in rows}
+            archived = {repo_id: [] for repo_id in pending}
+            with utils.log_context(project_id=os.path.basename(d_batch)), child_usage.collect() as usage, \
+                    child_usage.deadline(None if None in timeouts else sum(timeouts)):
+                start = time.time()
+                if os.path.isdir(d_batch):
+                    shutil.rmtree(d_batch)
+                try:
+                    # Every project gets its own folder in the batch system
+                    splitter = BatchSplitter(d_batch, {
+                        repo_id: self._extract_project(row['repo_path'], os.path.join(d_batch, repo_id))
+                        for repo_id, row in zip(pending, rows)})
+                    for granularity, clonetype in self.configs:
+                        res_tar_fs = {repo_id: f for repo_id, configs in pending.items()
+                                      for g, t, f in configs if (g, t) == (granularity, clonetype)}
+                        if not res_tar_fs: continue
+                        cmd = self._nicad_cmd(d_batch, granularity, clonetype)
+                        snapshot = self._snapshot_outputs(d_batch, granularity) if len(self.configs) > 1 else None
+                        p = child_usage.run(cmd, tool='nicad6', shell=True, cwd=self.NiCadRoot)
+                        if p.returncode != 0:
+                            logger.error('Error in running clone detection for batch {}. Command: {}"'.format(
+                                os.path.basename(d_batch), cmd))
+                            break
+                        proj_dirs = splitter.split_outputs(granularity, snapshot)
+                        for repo_id, res_tar_f in res_tar_fs.items():
+                            # Only the outputs of this configuration are split into the folder of the project
+                            self._archive_nicad_results(proj_dirs[repo_id], res_tar_f, granularity,
+                                                        {} if len(self.configs) > 1 else None)
+                            shutil.rmtree(os.path.dirname(proj_dirs[repo_id]))
+                            archived[repo_id].append(res_tar_f)
+                except child_usage.ChildTimeout:
+                    logger.error('Clone detection timed out after {:.0f}s at batch {}'.format(
+                        sum(timeouts), os.path.basename(d_batch)))
+                except Exception as e:
+                    logger.error('Clone detection fail at batch {}, {}'.format(os.path.basename(d_batch), str(e)))
+                finally:
+                    # Remove the batch, its NiCad outputs next to it and the outputs of projects that were not archived
+                    shutil.rmtree(d_batch, ignore_errors=True)
+                    for granularity in dict.fromkeys(g for g, _ in self.configs):
+                        for f in glob.glob(d_batch + '_{}*'.format(granularity)):
+                            shutil.rmtree(f) if os.path.isdir(f) else os.remove(f)
+                    for repo_id in pending:
+                        shutil.rmtree(os.path.abspath(os.path.join(self.tmp, repo_id)), ignore_errors=True)
+
+            done = [len(archived[repo_id]) == len(pending[repo_id]) for repo_id in pending]
+            if any(done):
+                logger.info('Clone detection of batch {} ({} projects) finished in {:.1f}s.'.format(
+                    os.path.basename(d_batch), sum(done), time.time() - start))
+            # The runs of the batch are shared by its projects in proportion to their size
+            total = sum(float(row['Bytes']) for row, ok in zip(rows, done) if ok)
+            for row, ok, progress_row in zip(rows, done, progress):
+                if ok:
+                    self.record_child_usage(row, child_usage.share(
+                        usage, float(row['Bytes']) / total if total > 0 else 1 / sum(done)))
+                else:
+                    self._clone_detection_project(row, progress_row)
+
+    def _extract_project(self, repo_path, tmp_out_dir):
+        """
+        Decompress a project archive into the temp folder
+        Parameters
+        ----------
+        repo_path: The compressed project
+        tmp_out_dir: The folder to decompress the project into
+
+        Returns
+        -------
+        tmp_out_proj_dir: The decompressed project directory
+        """
+        # Clean temp project if it exists. This could happen when a previous job collapsed
+        if os.path.isdir(tmp_out_dir):
+            shutil.rmtree(tmp_out_dir)
 
-            # Move result to location
-            nicad_output_list = glob.glob(tmp_out_proj_dir + '_{}*'.format(self.granularity))
+        # NiCad only reads the java sources of a java project; a repacked corpus gives them without the rest
+        is_java = self.language == 'java'
+        with ProjectArchive.open(repo_path, java_only=is_java) as archive:
+            archive.extract(tmp_out_dir, suffix='.java' if is_java else None)
+        folders = os.listdir(tmp_out_dir)
+        if not folders:
+            # No java file in the project: NiCad gets an empty project folder, named after the archive
+            folders = [os.path.basename(repo_path).replace('.tar.gz', '')]
+            utils.create_folder_if_not_exist(os.path.join(tmp_out_dir, folders[0]))
+        return os.path.join(tmp_out_dir, folders[0])
+
+    def _archive_nicad_results(self, tmp_out_proj_dir, res_tar_f, granularity=None, snapshot=None):
+        """
+        Save all NiCad outputs of a project into a tar file
+        Parameters
+        ----------
+        tmp_out_proj_dir: The decompressed project directory NiCad ran on
+        res_tar_f: The result tar file
+        granularity: The granularity NiCad ran with, default to self.granularity
+        snapshot: Result files before this run (see _snapshot_outputs); only files created or changed since then
+            are saved from the result folders. Extracted and normalized sources are always saved
+        """
+        nicad_output_list = glob.glob(tmp_out_proj_dir + '_{}*'.format(granularity or self.granularity))
 
-            with tarfile.open(res_tar_f, mode='w:gz') as tar:
-                for f_nicad_out in nicad_output_list:
+        with tarfile.open(res_tar_f, mode='w:gz') as tar:
+            for f_nicad_out in nicad_output_list:
+                if snapshot is None or os.path.isfile(f_nicad_out):
                     tar.add(f_nicad_out, arcname=os.path.basename(f_nicad_out))
-            logger.info('Clone detection finished. Results are saved in {}'.format(res_tar_f))
-            # Remove temp out folder
-            shutil.rmtree(tmp_out_dir)
+                    continue
+                for root, _, files in os.walk(f_nicad_out):
+                    for f in files:
+                        f = os.path.join(root, f)
+                        if snapshot.get(f) != os.stat(f).st_mtime_ns:
+                            tar.add(f, arcname=os.path.relpath(f, os.path.dirname(tmp_out_proj_dir)))
+
+    async def _run_nicad_async(self, proj_dir, f_log, timeout=None, granularity=None, clonetype=None):
+        """
+        Launch NiCad as an asyncio subprocess and stream its stdout/stderr into a per-project log
+        Parameters
+        ----------
+        proj_dir: The decompressed project directory
+        f_log: The log file of this NiCad run
+        timeout: Seconds to wait before NiCad is killed; None waits forever
+        granularity: The NiCad granularity, default to self.granularity
+        clonetype: The NiCad configuration, default to self.clonetype
+
+        Returns
+        -------
+        returncode: The return code of NiCad
+        """
+        # NiCad is reaped by the asyncio child watcher, so its resource usage is measured by the exec wrapper
+        f_usage = os.path.splitext(f_log)[0] + '.usage.json'
+        cmd = ['./nicad6', granularity or self.granularity, self.language, proj_dir, clonetype or self.clonetype]
+        # NiCad starts TXL children, so it gets its own process group to be killed as a whole
+        proc = await asyncio.create_subprocess_exec(
+            *child_usage.exec_command(cmd, f_usage, tool='nicad6'),
+            cwd=self.NiCadRoot,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True)
+
+        start = time.perf_counter()
+        with open(f_log, 'wb') as w:
+            async def stream_output():
+                while True:
+                    chunk = await proc.stdout.read(1 << 16)
+                    if not chunk:
+                        break
+                    w.write(chunk)
+            try:
+                await asyncio.wait_for(asyncio.gather(stream_output(), proc.wait()), timeout=timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                await proc.wait()
+                if isinstance(e, asyncio.TimeoutError):
+                    # The exec wrapper is killed with NiCad, so only the wall time is known
+                    nan = float('nan')
+                    child_usage.record([{'tool': 'nicad6', 'wall': time.perf_counter() - start, 'user': nan,
+                                         'sys': nan, 'max_rss_mb': nan, 'returncode': proc.returncode,
+                                         'timed_out': True}])
+                raise
+            finally:
+                # asyncio subprocesses are not seen by the profiler's Popen timers
+                record_child_wait('nicad6', time.perf_counter() - start)
+                child_usage.record(child_usage.load_exec_usage(f_usage))
+        return proc.returncode
+
+    async def _clone_detection_project_async(self, row, sem, executor, timeout=None):
+        """
+        Clone detection of a single project: extraction and archiving run in the thread executor,
+        NiCad runs as an asyncio subprocess. At most sem projects are in flight at the same time.
+        Parameters
+        ----------
+        row: dataframe row, records the information of a project
+        sem: The semaphore that bounds the number of concurrent projects
+        executor: The thread executor for blocking extraction/archiving steps
+        timeout: Seconds to wait for NiCad of a project, scaled with its size; None to use self.timeout
+        """
+        timeout = self._timeout(row, timeout)
+        repo_path = row['repo_path']
+        repo_id = row['project_id']
+        configs = self._pending_configs(row)
+
+        if not configs: return
+
+        if not os.path.isfile(repo_path):
+            logger.error('Unable to find path: {}'.format(repo_path))
+            return
+
+        loop = asyncio.get_running_loop()
+        # Every asyncio task has its own context, so the usage of concurrent projects is collected apart
+        with utils.log_context(project_id=repo_id), child_usage.collect() as usage:
+            async with sem:
+                with track(self.metrics, row) as progress:
+                    if self.admission is not None:
+                        # Waiting for budget blocks, so it runs in the default executor to keep the extraction threads free
+                        await loop.run_in_executor(None, self.admission.acquire, row)
+                    tmp_out_dir = os.path.abspath(os.path.join(self.tmp, str(repo_id)))
+                    start = time.time()
+                    try:
+                        tmp_out_proj_dir = await loop.run_in_executor(executor, self._extract_project, repo_path, tmp_out_dir)
+                        res_tar_fs = []
+                        for granularity, clonetype, res_tar_f in configs:
+                            f_log = os.path.join(self.d_nicad_logs, '{}.log'.format(
+                                repo_id if len(self.configs) == 1 else '_'.join([str(repo_id), granularity, clonetype])))
+                            snapshot = None
+                            if len(self.configs) > 1:
+                                snapshot = await loop.run_in_executor(
+                                    executor, self._snapshot_outputs, tmp_out_proj_dir, granularity)
+                            try:
+                                returncode = await self._run_nicad_async(tmp_out_proj_dir, f_log, timeout=timeout,
+                                                                         granularity=granularity, clonetype=clonetype)
+                            except asyncio.TimeoutError:
+                                logger.error('Clone detection timed out after {}s at project {}; see {}'.format(
+                                    timeout, row['repo_name'], f_log))
+                                progress.fail()
+                                continue
+                            if returncode != 0:
+                                logger.error('Error in running clone detection for project {}. See {}'.format(
+                                    row['repo_name'], f_log))
+                                progress.fail()
+                                continue
+                            await loop.run_in_executor(executor, self._archive_nicad_results,
+                                                       tmp_out_proj_dir, res_tar_f, granularity, snapshot)
+                            res_tar_fs.append(res_tar_f)
+                        if res_tar_fs:
+                            logger.info('Clone detection finished in {:.1f}s. Results are saved in {}'.format(
+                                time.time() - start, ', '.join(res_tar_fs)))
+                    except Exception as e:
+                        logger.error('Clone detection fail at project {}, {}'.format(row['repo_name'], str(e)))
+                        progress.fail()
+                    finally:
+                        # Remove temp out folder
+                        await loop.run_in_executor(executor, shutil.rmtree, tmp_out_dir, True)
+                        if self.admission is not None:
+                            self.admission.release(row)
+            self.record_child_usage(row, usage)
+
+    async def _clone_detection_in_project_async(self, df, workers, timeout=None):
+        sem = asyncio.Semaphore(workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            tasks = [asyncio.ensure_future(self._clone_detection_project_async(row, sem, executor, timeout))
+                     for _, row in df.iterrows()]
+            try:
+                await asyncio.gather(*tasks)
+            except asyncio.CancelledError:
+                for t in tasks:
+                    t.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+
+    def clone_detection_in_project_async(self, df, workers=None, timeout=None):
+        """
+        Perform clone detection with NiCad 6.2 from a single event loop
+        Unlike parallel_run, no Python process is forked per chunk; the NiCad processes are the only children
+        Parameters
+        ----------
+        df: The dataframe with projects to be analyzed
+        workers: The number of projects processed at the same time, default to utils.getWorkers()
+        timeout: Seconds to wait for NiCad of each project (scaled with its size), None to use self.timeout
+        """
+        asyncio.run(self._clone_detection_in_project_async(df, workers or utils.getWorkers(), timeout))
 
     def clone_detection_logging_removal(self, df):
         """
@@ -135,13 +544,15 @@ class CloneDetection:
         clone_detection_result = []
         # Save newly added json locally
         logging_remove_json_new = defaultdict(dict)
-        for i, row in df.iterrows():
+        for i, row in iterrows(self.metrics, df):
             repo_path = row['repo_path']
             # FIXME: For local
             repo_path = os.path.join(utils.getPath('REPO_ZIPPED_ROOT', ischeck=False), os.path.basename(repo_path))
             
             repo_id = str(row['project_id'])
             row['NiCadPassed'] = False
+            # Why the project failed: missing, logging_removal, nicad_error or timeout
+            row['FailureClass'] = None
 
             # Check if the current file is already archived in the logging removal projects folder
             f_proj_logging_remove_tar = os.path.join(self.d_archive_logging_removed, '%s.tar.gz' % repo_id)
@@ -149,81 +560,137 @@ class CloneDetection:
             # Check if original file exists
             if not os.path.isfile(repo_path):
                 logger.error('Unable to find path: {}'.format(repo_path))
-                clone_detection_result.append(row)
+                row['FailureClass'] = 'missing'
+                clone_detection_result.extend(self._config_rows(row))
+                fail(self.metrics)
                 continue
 
-            # The project will be decompressed under this directory, and NiCad results will be written here as well
-            tmp_out_dir = os.path.abspath(os.path.join(self.tmp, str(repo_id)))
-
-            # Clean temp project if it exists. This could happen when a previous job collapsed
-            if os.path.isdir(tmp_out_dir):
-                shutil.rmtree(tmp_out_dir)
-
-
-            if os.path.isfile(f_proj_logging_remove_tar):
-                # Decompress tar to temp folder, if this has been already logging removed
-                # This will be used for clone detection directly
-                tar = tarfile.open(f_proj_logging_remove_tar, "r:gz")
-                tar.extractall(path=os.path.abspath(self.tmp))
-                tar.close()
-            else:
-                # If not file recorded, means the file has not been logging removed, we will perform logging removal on this file
-                lrm = self.logremover.find_and_remove_logging(row=row)
-                if lrm is not None:
-                    log_remove_repo_id, log_remove_repo_detail = lrm
-                    logging_remove_json_new[log_remove_repo_id] = log_remove_repo_detail
-
-            # The temporary decompressed project directory
-            tmp_out_proj_dir = os.path.join(tmp_out_dir, os.listdir(tmp_out_dir)[0])
-
-            # NiCad clone deteciton
-            # Example: ./nicad5 functions java systems/JHotDraw54b1 default-report
-            cmd = ' '.join([
-                './nicad6',
-                self.granularity,
-                self.language,
-                tmp_out_proj_dir,
-                self.clonetype
-            ])
-            p = subprocess.Popen(cmd, shell=True, cwd=self.NiCadRoot)
-            try:
-                p.communicate()
-            except Exception as e:
-                logger.error('Clone detection fail at project {}, {}'.format(row['repo_name'], str(e)))
-                self.backup_failed_log(tmp_out_dir)
+            # The deadline covers logging removal and NiCad of the project
+            with self._admit(row), utils.log_context(project_id=repo_id), child_usage.collect() as usage, \
+                    child_usage.deadline(self._timeout(row)):
+                start = time.time()
+                # The project will be decompressed under this directory, and NiCad results will be written here as well
+                tmp_out_dir = os.path.abspath(os.path.join(self.tmp, str(repo_id)))
+
+                # Clean temp project if it exists. This could happen when a previous job collapsed
+                if os.path.isdir(tmp_out_dir):
+                    shutil.rmtree(tmp_out_dir)
+
+
+                if os.path.isfile(f_proj_logging_remove_tar):
+                    # Decompress tar to temp folder, if this has been already logging removed
+                    # This will be used for clone detection directly
+                    tar = tarfile.open(f_proj_logging_remove_tar, "r:gz")
+                    tar.extractall(path=os.path.abspath(self.tmp))
+                    tar.close()
+                else:
+                    # If not file recorded, means the file has not been logging removed, we will perform logging removal on this file
+                    lrm = self.logremover.find_and_remove_logging(row=row)
+                    if lrm is not None:
+                        log_remove_repo_id, log_remove_repo_detail = lrm
+                        logging_remove_json_new[log_remove_repo_id] = log_remove_repo_detail
+
+                if not os.path.isdir(tmp_out_dir):
+                    # Logging removal did not leave a project to detect clones in
+                    row['FailureClass'] = 'timeout' if child_usage.timed_out(usage) else 'logging_removal'
+                    fail(self.metrics)
+                    self.record_child_usage(row, usage)
+                    clone_detection_result.extend(self._config_rows(row))
+                    continue
+
+                # The temporary decompressed project directory
+                tmp_out_proj_dir = os.path.join(tmp_out_dir, os.listdir(tmp_out_dir)[0])
+
+                if self.fragment_cache is not None:
+                    # Extract only the files changed by logging removal; NiCad reuses the merged extraction
+                    for granularity in dict.fromkeys(g for g, _ in self.configs):
+                        clonetype = next(t for g, t in self.configs if g == granularity)
+                        self.fragment_cache.prepare(row, tmp_out_proj_dir, granularity, clonetype, repo_path)
+
+                # NiCad clone deteciton; every configuration is run and recorded, whether the others pass or not
+                failures = {}
+                for granularity, clonetype in self.configs:
+                    if 'timeout' in failures.values():
+                        # The deadline of the project has passed; the remaining configurations cannot run
+                        failures[(granularity, clonetype)] = 'timeout'
+                        continue
+                    cmd = self._nicad_cmd(tmp_out_proj_dir, granularity, clonetype)
+                    try:
+                        p = child_usage.run(cmd, tool='nicad6', shell=True, cwd=self.NiCadRoot)
+                    except child_usage.ChildTimeout:
+                        logger.error('Clone detection timed out after {:.0f}s at project {}'.format(
+                            self._timeout(row), row['repo_name']))
+                        failures[(granularity, clonetype)] = 'timeout'
+                        continue
+                    except Exception as e:
+                        logger.error('Clone detection fail at project {} ({} {}), {}'.format(
+                            row['repo_name'], granularity, clonetype, str(e)))
+                        failures[(granularity, clonetype)] = 'nicad_error'
+                        continue
+                    # Check if process succeed
+                    if p.returncode != 0:
+                        logger.error('Error in running clone detection for project {}. Command: {}"'.format(
+                            row['repo_name'], cmd
+                        ))
+                        failures[(granularity, clonetype)] = 'nicad_error'
+                if failures:
+                    fail(self.metrics)
+                    self.backup_failed_log(tmp_out_dir)
+                else:
+                    logger.info('Clone detection for project {}({}) finished in {:.1f}s.'.format(
+                        row['repo_name'], repo_id, time.time() - start))
+                # Remove temp out folder
                 shutil.rmtree(tmp_out_dir)
-                clone_detection_result.append(row)
-                continue
-            # Check if process succeed
-            if p.returncode != 0:
-                logger.error('Error in running clone detection for project {}. Command: {}"'.format(
-                    row['repo_name'], cmd
-                ))
-                self.backup_failed_log(tmp_out_dir)
-                shutil.rmtree(tmp_out_dir)
-                clone_detection_result.append(row)
-                continue
-            logger.info('Clone detection for project {}({}) finished.'.format(row['repo_name'], repo_id))
-            # Remove temp out folder
-            shutil.rmtree(tmp_out_dir)
-            row['NiCadPassed'] = True
-            clone_detection_result.append(row)
+                self.record_child_usage(row, usage)
+                clone_detection_result.extend(self._config_rows(row, failures))
         
         self.logremover.dump_remove_logging_result(logging_remove_json_new)
         self.dump_nicad_clone_check_result(df=pd.DataFrame(clone_detection_result))
 
+    def record_child_usage(self, row, usage):
+        """
+        Add the usage of the child processes of a project to its result row, and save it per tool
+        Parameters
+        ----------
+        row: dataframe row, records the information of a project
+        usage: The invocations collected by child_usage.collect()
+        """
+        for k, v in child_usage.summarize(usage).items():
+            row[k] = v
+        self.child_usage_sink.write(child_usage.usage_by_tool(usage, project_id=row['project_id']))
+
+    def _config_rows(self, row, failures=None):
+        """
+        The result rows of a project, one per NiCad configuration
+        Parameters
+        ----------
+        row: dataframe row of the project; its FailureClass applies to every configuration if failures is None
+        failures: (granularity, clonetype) -> FailureClass of the failed configurations, None if NiCad did not run
+
+        Returns
+        -------
+        list of rows with granularity, clonetype, NiCadPassed and FailureClass
+        """
+        rows = []
+        for granularity, clonetype in self.configs:
+            res = row.copy()
+            res['granularity'] = granularity
+            res['clonetype'] = clonetype
+            if failures is None:
+                res['NiCadPassed'] = False
+            else:
+                res['FailureClass'] = failures.get((granularity, clonetype))
+                res['NiCadPassed'] = res['FailureClass'] is None
+            rows.append(res)
+        return rows
+
     def dump_nicad_clone_check_result(self, df):
         """
-        Output NiCad clone check result
+        Output NiCad clone check result into the shard of the current worker
         :param result:
         :return:
         """
-
-        with lock:
-            if os.path.isfile(self.f_nicad_check):
-                df.to_csv(self.f_nicad_check, mode='a', index=False, header=False)
-            else:
-                df.to_csv(self.f_nicad_check, mode='w', index=False, header=True)
+        self.nicad_check_sink.write(df)
 
     def backup_failed_log(self, d):
         """
@@ -254,9 +721,8 @@ def logging_setup(args):
 
     # Set logger
     utils.setlogger(f_log=os.path.abspath('log/clone_detection/{}.log'.format(
-        '_'.join([args.language, args.granularity, args.clonetype, size_types_str]), logger='clone_detection',
-        level=logging.INFO
-    )))
+        '_'.join([args.language, args.granularity, args.clonetype, size_types_str]))),
+        level=logging.INFO)
 
 def load_projects_list(args, fromdir, ftype):
     """
@@ -277,20 +743,51 @@ def load_projects_list(args, fromdir, ftype):
         dfs.append(df_projects)
     return pd.concat(dfs)
 
-def parallel_run(df, func):
+def parallel_run(df, func, model=None, metrics=None):
     """
     Run function in parallel
     :param df:
     :param chunks:
+    :param model: RuntimeModel; if given, chunks are balanced by predicted runtime and ordered longest first
+    :param metrics: RunMetrics updated by the workers and reported by this process while they run
     :return:
     """
     jobs = []
-    for df_sp in utils.chunkify(data=df, chunks=utils.getWorkers()):
+    if model is not None:
+        df_sps = balanced_chunks(df, model, chunks=utils.getWorkers())
+    else:
+        df_sps = utils.chunkify(data=df, chunks=utils.getWorkers())
+    for df_sp in df_sps:
         jobs.append(
             multiprocessing.Process(target=func, args=(df_sp, ))
         )
-    [j.start() for j in jobs]
-    [j.join() for j in jobs]
+    with reporting(metrics, df):
+        [j.start() for j in jobs]
+        [j.join() for j in jobs]
+
+def run(df, func, args, profile_dir=None, model=None, metrics=None):
+    """
+    Run function on all projects, either chunked by parallel_run or leased from a shared work queue
+    Parameters
+    ----------
+    df: The dataframe with projects to be analyzed
+    func: The function processing a dataframe of projects
+    args: The parsed arguments
+    profile_dir: The folder for profiles of all workers, None to disable profiling
+    model: RuntimeModel used to balance the chunks, None to split projects evenly
+    metrics: RunMetrics updated by the workers, None to disable
+    """
+    if profile_dir:
+        func = ProfiledWorker(func, profile_dir)
+    if args.work_queue:
+        # Runs of different configurations must not share their task lists
+        namespace = '_'.join([args.language, args.granularity, args.clonetype,
+                              'logging_removed' if args.remove_logging else 'original'])
+        queue = open_work_queue(args.work_queue, namespace=namespace, ttl=args.lease_ttl)
+        with reporting(metrics, df):
+            run_leased_workers(df=df, func=func, queue=queue)
+    else:
+        parallel_run(df=df, func=func, model=model, metrics=metrics)
 
 def skip_examined_projects(df):
     """
@@ -321,7 +818,30 @@ if __name__ == '__main__':
     # Prepare logging
     logging_setup(args)
 
+    size_types = [x.strip() for x in args.size_level.split(',')]
+    admission = None
+    if args.admission_control:
+        # Created before any worker is forked so that all workers share the reservations
+        admission = AdmissionController(
+            d_tmp=cdetec.tmp,
+            size_mb=load_size_estimates(size_types),
+            disk_headroom_mb=args.disk_headroom_gb * 1024,
+            mem_headroom_mb=args.mem_headroom_gb * 1024)
+    cdetec.admission = admission
+    cdetec.timeout = args.timeout
+    cdetec.timeout_per_kloc = args.timeout_per_kloc
+    cdetec.nicad_batch = args.nicad_batch
+    cdetec.nicad_batch_max_mb = args.nicad_batch_max_mb
+    profile_dir = None
+    if args.profile:
+        profile_dir = os.path.join('log/profile', 'clone_detection_' + start_time.strftime('%Y%m%d_%H%M%S'))
+    # Counters shared by all workers, so they are created before any worker is forked
+    cdetec.metrics = RunMetrics('clone_detection_logging_removal' if cdetec.remove_logging else 'clone_detection',
+                                interval=args.metrics_interval, progress=args.progress)
+
     if cdetec.remove_logging:
+        if args.use_asyncio:
+            logger.warning('The asyncio runner does not support logging removal; fall back to parallel_run')
         # Run logging removal
         f_removal = 'result/log_remove/logging_removal_lines.json'
         # Saves the dataframe after merging with LU usage table
@@ -329,19 +849,52 @@ if __name__ == '__main__':
         logremover = LogRemover(
             f_removal=f_removal, 
             sample_dir=d_inner_proj_clone,
-            sample_sizes=[x.strip() for x in args.size_level.split(',')],
+            sample_sizes=size_types,
             repeats=0,
-            sample_percentage=1.0)
+            sample_percentage=1.0,
+            admission=admission)
         cdetec.logremover = logremover
+        if args.fragment_cache:
+            cdetec.fragment_cache = FragmentCache(cdetec)
         df = load_projects_list(args, fromdir=d_inner_proj_clone, ftype='inner_project_clone')
+        # Runtime model fitted from earlier runs (see src/util/runtime_model.py), None if not fitted yet
+        model = RuntimeModel.load('clone_detection_logging_removal')
+        if model is not None:
+            log_eta(df, model, utils.getWorkers())
         #cdetec.clone_detection_logging_removal(df)
-        parallel_run(df=df, func=cdetec.clone_detection_logging_removal)
+        run(df=df, func=cdetec.clone_detection_logging_removal, args=args, profile_dir=profile_dir, model=model,
+            metrics=cdetec.metrics)
+        # Merge the results of all workers
+        logremover.removal_sink.compact()
+        logremover.child_usage_sink.compact()
+        logremover.density.build_table()
+        cdetec.nicad_check_sink.compact()
     else:
         # Load target df
         df = load_projects_list(args, fromdir='result/proj_sloc', ftype='filesize')
         # Skip projects that have already been examined
         skip_examined_projects(df)
+        model = RuntimeModel.load('clone_detection')
+        if model is not None:
+            log_eta(df, model, utils.getWorkers())
         #cdetec.clone_detection_in_project(df)
-        parallel_run(df=df, func=cdetec.clone_detection_in_project)
+        if args.use_asyncio:
+            if args.nicad_batch > 1:
+                logger.warning('The asyncio runner does not batch projects; every project gets its own NiCad run')
+            if model is not None:
+                # Projects are started in order, so long projects do not become the tail of the run
+                df = longest_first(df, model)
+            # A single process; NiCad waits are recorded by _run_nicad_async
+            func = cdetec.clone_detection_in_project_async
+            if profile_dir:
+                func = ProfiledWorker(func, profile_dir)
+            with reporting(cdetec.metrics, df):
+                func(df)
+        else:
+            run(df=df, func=cdetec.clone_detection_in_project, args=args, profile_dir=profile_dir, model=model,
+                metrics=cdetec.metrics)
+    cdetec.child_usage_sink.compact()
+    if profile_dir:
+        logger.info('Profile report (%s):\n%s' % (profile_dir, merge_profiles(profile_dir)))
     
     utils.print_msg_box('Finished!\nRunning Time: %s' % str(datetime.now()- start_time))
\ No newline at end of file
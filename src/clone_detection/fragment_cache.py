@@ -0,0 +1,201 @@
+"""
+Fragment cache for NiCad runs on logging-removed projects
+Logging removal only touches a small part of a project, yet NiCad extracts the fragments of every file again.
+The cache keeps a per-file content-hash index of the fragments extracted in the original-project run:
+    result/fragment_cache/<granularity>/<project_id>.json.gz    relpath -> {sha1, fragments}
+Before NiCad runs on the cleaned project, unchanged files reuse their cached fragments and only changed files are
+extracted (by NiCad on a mini system holding just those files). The merged <system>_<granularity>.xml is written
+next to the project, where NiCad picks it up instead of extracting the whole project again.
+"""
+import os
+import re
+import sys
+import gzip
+import json
+import shutil
+import hashlib
+import logging
+import tarfile
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import src.util.utils as utils
+import src.util.child_usage as child_usage
+from src.util.corpus_archive import ProjectArchive
+
+logger = logging.getLogger(__name__)
+
+_SOURCE = re.compile(r'<source file="([^"]*)"[^>]*>.*?</source>\n?', re.S)
+
+
+def _sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _relpath(f, system):
+    # NiCad records the path it was given; the part after the system folder is the same in every run
+    marker = '/%s/' % system
+    return f.split(marker, 1)[1] if marker in f else f
+
+
+def parse_fragments(xml, system):
+    """
+    Group the fragments of a NiCad extraction by source file
+    Parameters
+    ----------
+    xml: The text of <system>_<granularity>.xml
+    system: The name of the system folder NiCad ran on
+
+    Returns
+    -------
+    dict: relpath -> list of <source> elements
+    """
+    fragments = {}
+    for m in _SOURCE.finditer(xml):
+        fragments.setdefault(_relpath(m.group(1), system), []).append(m.group(0).rstrip('\n'))
+    return fragments
+
+
+class FragmentCache:
+    def __init__(self, cdetec, d_cache='result/fragment_cache'):
+        """
+        Parameters
+        ----------
+        cdetec: The CloneDetection object whose original-project results are reused
+        d_cache: The folder of fragment indexes
+        """
+        self.cdetec = cdetec
+        self.d_cache = d_cache
+
+    def _f_index(self, repo_id, granularity):
+        return os.path.join(self.d_cache, granularity, '%s.json.gz' % repo_id)
+
+    def _original_results(self, row, granularity):
+        # Any clone type of a granularity has the same extraction
+        for g, t in self.cdetec.configs:
+            res_tar_f = self.cdetec._res_tar_f(row, g, t)
+            if g == granularity and os.path.isfile(res_tar_f):
+                return res_tar_f
+        return None
+
+    def build_index(self, row, granularity, repo_path):
+        """
+        Build the index of a project from its original NiCad results and the original sources
+        Parameters
+        ----------
+        row: dataframe row, records the information of a project
+        granularity: The NiCad granularity
+        repo_path: The compressed original project
+
+        Returns
+        -------
+        index: relpath -> {sha1, fragments}; None if the original results are not on file
+        """
+        res_tar_f = self._original_results(row, granularity)
+        if res_tar_f is None or not os.path.isfile(repo_path):
+            return None
+        with tarfile.open(res_tar_f, 'r:gz') as tar:
+            members = [m for m in tar.getmembers() if m.isfile() and m.name.endswith('_%s.xml' % granularity)
+                       and '/' not in m.name]
+            if not members:
+                return None
+            system = members[0].name[:-len('_%s.xml' % granularity)]
+            fragments = parse_fragments(tar.extractfile(members[0]).read().decode('utf-8', 'replace'), system)
+
+        index = {}
+        with ProjectArchive.open(repo_path, java_only=True) as archive:
+            for name, data in archive.members(suffix='.java'):
+                # Member names start with the project folder
+                name = os.path.normpath(name)
+                relpath = name.split('/', 1)[1] if '/' in name else name
+                index[relpath] = {'sha1': _sha1(data), 'fragments': fragments.get(relpath, [])}
+
+        f_index = self._f_index(row['project_id'], granularity)
+        utils.create_folder_if_not_exist(os.path.dirname(f_index))
+        with gzip.open(f_index + '.tmp', 'wt') as w:
+            json.dump(index, w)
+        os.replace(f_index + '.tmp', f_index)
+        return index
+
+    def load_index(self, row, granularity, repo_path):
+        """
+        Load the index of a project, building it on first use
+        """
+        f_index = self._f_index(row['project_id'], granularity)
+        if os.path.isfile(f_index):
+            with gzip.open(f_index, 'rt') as r:
+                return json.load(r)
+        return self.build_index(row, granularity, repo_path)
+
+    def _extract_changed(self, proj_dir, changed, granularity, clonetype):
+        # Let NiCad extract the changed files only, from a mini system with the same layout
+        d_mini = tempfile.mkdtemp(prefix='fragment_cache_', dir=os.path.dirname(proj_dir))
+        mini_proj_dir = os.path.join(d_mini, os.path.basename(proj_dir))
+        try:
+            for relpath in changed:
+                f = os.path.join(mini_proj_dir, relpath)
+                utils.create_folder_if_not_exist(os.path.dirname(f))
+                shutil.copy2(os.path.join(proj_dir, relpath), f)
+            try:
+                p = child_usage.run(self.cdetec._nicad_cmd(mini_proj_dir, granularity, clonetype), tool='nicad6',
+                                    shell=True, cwd=self.cdetec.NiCadRoot, stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.DEVNULL)
+            except child_usage.ChildTimeout:
+                # The project is out of time; the NiCad run that follows fails with the timeout
+                return None
+            f_xml = '%s_%s.xml' % (mini_proj_dir, granularity)
+            if p.returncode != 0 or not os.path.isfile(f_xml):
+                return None
+            with open(f_xml, errors='replace') as r:
+                return parse_fragments(r.read(), os.path.basename(proj_dir))
+        finally:
+            shutil.rmtree(d_mini, ignore_errors=True)
+
+    def prepare(self, row, proj_dir, granularity, clonetype, repo_path):
+        """
+        Write <proj_dir>_<granularity>.xml from cached fragments of unchanged files and freshly extracted
+        fragments of changed files, so that NiCad skips the extraction of the whole project
+        Parameters
+        ----------
+        row: dataframe row, records the information of a project
+        proj_dir: The cleaned project directory NiCad is about to run on
+        granularity: The NiCad granularity
+        clonetype: A NiCad configuration of this granularity, used to extract the changed files
+        repo_path: The compressed original project
+
+        Returns
+        -------
+        (reused, extracted): The number of files; None if NiCad has to extract the whole project
+        """
+        index = self.load_index(row, granularity, repo_path)
+        if index is None:
+            return None
+
+        unchanged, changed = [], []
+        for root, _, files in os.walk(proj_dir):
+            for f in files:
+                if not f.endswith('.java'): continue
+                relpath = os.path.relpath(os.path.join(root, f), proj_dir)
+                with open(os.path.join(root, f), 'rb') as r:
+                    sha1 = _sha1(r.read())
+                (unchanged if index.get(relpath, {}).get('sha1') == sha1 else changed).append(relpath)
+
+        extracted = {}
+        if changed:
+            extracted = self._extract_changed(proj_dir, changed, granularity, clonetype)
+            if extracted is None:
+                logger.warning('Fail to extract changed files of project %s; NiCad extracts the whole project'
+                               % row['project_id'])
+                return None
+
+        # Fragments are recorded with the path of the current project, as NiCad would
+        changed_set = set(changed)
+        with open('%s_%s.xml' % (proj_dir, granularity), 'w') as w:
+            for relpath in sorted(unchanged + changed):
+                fragments = extracted.get(relpath, []) if relpath in changed_set else index[relpath]['fragments']
+                f = os.path.join(proj_dir, relpath).replace('\\', '/')
+                for fragment in fragments:
+                    w.write(re.sub(r'file="[^"]*"', lambda _: 'file="%s"' % f, fragment, count=1) + '\n')
+        logger.info('Fragment cache: reused %d files, extracted %d changed files' % (len(unchanged), len(changed)))
+        return len(unchanged), len(changed)
@@ -0,0 +1,378 @@
+"""
+Corpus-wide index of near-duplicate logging-bearing fragments
+NiCad only compares fragments within a project. To find which logging-bearing fragments are shared between projects,
+every method of the corpus that makes a logging call (see src/log_remove/logging_index.py) is fingerprinted:
+    - the method is tokenized, comments are dropped and literals normalized (identifiers are kept, so that methods
+      of the same shape with other names do not collide)
+    - the MinHash signature of its token shingles estimates the Jaccard similarity with any other method
+    - the signature is split into LSH bands; methods with an equal band share a bucket
+The index is a SQLite file built in a parallel pass over the corpus (one task per project, merged by a single writer)
+and updated incrementally like the logging index. Projects sharing near-duplicate fragments with a project are
+found through the buckets of its fragments, and the candidates are checked with their signatures:
+    python src/clone_detection/fragment_index.py build [-l small,medium,large,vlarge]
+    python src/clone_detection/fragment_index.py similar 1234 [--threshold 0.8]
+    python src/clone_detection/fragment_index.py summary
+"""
+import os
+import re
+import sys
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+import multiprocessing
+from bisect import bisect_right
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import numpy as np
+import pandas as pd
+import src.util.utils as utils
+from src.util.corpus_archive import ProjectArchive, find_repacked
+from src.log_remove.logging_index import find_call_sites, load_corpus, load_levels
+
+logger = logging.getLogger(__name__)
+
+# Groups: comment, string or char literal, number, word, any other character
+_TOKEN = re.compile(r'(//[^\n]*|/\*.*?\*/)|("(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\')|(\d[\w.]*)'
+                    r'|([A-Za-z_$][\w$]*)|(\S)', re.S)
+# Words followed by (...) { that do not declare a method
+_NOT_METHOD = {'if', 'for', 'while', 'switch', 'catch', 'synchronized', 'try', 'return', 'new', 'else', 'do'}
+# Modulus of the MinHash permutations (a Mersenne prime); (a * x + b) stays below 2^64 for 32-bit shingle hashes
+_PRIME = (1 << 61) - 1
+
+
+def tokenize(text):
+    """
+    The tokens of a java source, without comments and with literals normalized
+    Returns
+    -------
+    list: (token, offset in text)
+    """
+    tokens = []
+    for m in _TOKEN.finditer(text):
+        comment, string, number, word, op = m.groups()
+        if comment is not None: continue
+        tokens.append(('"S"' if string is not None else 'N' if number is not None else word or op, m.start()))
+    return tokens
+
+
+def find_methods(tokens):
+    """
+    The outermost method and constructor bodies of a tokenized source
+    Returns
+    -------
+    list: (first, last) token index of the method name and of its closing brace
+    """
+    methods = []
+    i = 0
+    while i < len(tokens):
+        if tokens[i][0] != '{':
+            i += 1
+            continue
+        # Skip back over a throws clause to the closing parenthesis of the parameters
+        j = i - 1
+        while j > 0 and tokens[j][0] != ')' and (tokens[j][0] in {',', '.'} or tokens[j][0].isidentifier()):
+            if tokens[j][0] == 'throws':
+                j -= 1
+                break
+            j -= 1
+        start = None
+        if j > 0 and tokens[j][0] == ')':
+            depth = 0
+            for k in range(j, -1, -1):
+                depth += {')': 1, '(': -1}.get(tokens[k][0], 0)
+                if depth == 0:
+                    name = tokens[k - 1][0] if k > 0 else ''
+                    previous = tokens[k - 2][0] if k > 1 else ''
+                    if name.isidentifier() and name not in _NOT_METHOD and previous not in {'new', '.'}:
+                        start = k - 1
+                    break
+        # The matching closing brace
+        depth, end = 0, None
+        for k in range(i, len(tokens)):
+            depth += {'{': 1, '}': -1}.get(tokens[k][0], 0)
+            if depth == 0:
+                end = k
+                break
+        if end is None:
+            break
+        if start is not None:
+            methods.append((start, end))
+            i = end + 1
+        else:
+            # Class or initializer body: look for methods inside
+            i += 1
+    return methods
+
+
+def minhash(tokens, a, b, shingle):
+    """
+    The MinHash signature of the token shingles of a fragment, None if it has fewer tokens than a shingle
+    """
+    if len(tokens) < shingle:
+        return None
+    hashes = np.fromiter((zlib.crc32(' '.join(tokens[i:i + shingle]).encode('utf-8'))
+                          for i in range(len(tokens) - shingle + 1)), dtype=np.uint64)
+    hashes = np.unique(hashes)
+    return ((np.outer(a, hashes) + b[:, None]) % np.uint64(_PRIME)).min(axis=1)
+
+
+def _permutations(num_perm, seed=1):
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, 1 << 29, size=num_perm).astype(np.uint64)
+    b = rng.randint(0, 1 << 31, size=num_perm).astype(np.uint64)
+    return a, b
+
+
+def _bucket(band, values):
+    # A signed 64-bit key of the values of a band, as SQLite stores integers
+    return int.from_bytes(hashlib.blake2b(values.tobytes(), digest_size=8, person=b'band%d' % band).digest(),
+                          'little', signed=True)
+
+
+def _archive_state(repo_path):
+    f = find_repacked(repo_path, java_only=True) or repo_path
+    st = os.stat(f)
+    return f, st.st_mtime, st.st_size
+
+
+def _index_project(task):
+    project_id, repo_path, levels, params = task
+    try:
+        f, mtime, size = _archive_state(repo_path)
+        num_perm, _, shingle, min_tokens = params
+        a, b = _permutations(num_perm)
+        re_levels = re.compile(r'\.\s*(%s)\s*\(' % '|'.join(map(re.escape, levels)), re.I)
+        fragments = []
+        with ProjectArchive.open(repo_path, java_only=True) as archive:
+            for name, data in archive.members(suffix='.java'):
+                try:
+                    text = data.decode('utf-8')
+                except UnicodeError:
+                    text = data.decode('iso-8859-1')
+                if not re_levels.search(text): continue
+                newlines = [m.start() for m in re.finditer('\n', text)]
+                tokens = tokenize(text)
+                for start, end in find_methods(tokens):
+                    if end - start + 1 < min_tokens: continue
+                    body = text[tokens[start][1]:tokens[end][1] + 1]
+                    if not find_call_sites(body, re_levels): continue
+                    signature = minhash([t for t, _ in tokens[start:end + 1]], a, b, shingle)
+                    if signature is None: continue
+                    fragments.append((os.path.normpath(name), bisect_right(newlines, tokens[start][1]) + 1,
+                                      bisect_right(newlines, tokens[end][1]) + 1, signature))
+        return project_id, f, mtime, size, fragments, None
+    except Exception as e:
+        return project_id, None, None, None, None, str(e)
+
+
+class FragmentIndex:
+    def __init__(self, path='result/clone_detection/fragment_index.sqlite', f_lu_levels='conf/lu_levels.json',
+                 num_perm=64, bands=16, shingle=5, min_tokens=50):
+        """
+        Parameters
+        ----------
+        path: The SQLite file of the index
+        f_lu_levels: The LUs and their level functions; methods calling any of them are indexed
+        num_perm: The length of MinHash signatures
+        bands: The number of LSH bands; fragments with a Jaccard similarity above about
+            (1 / bands) ** (bands / num_perm) are likely to share a bucket
+        shingle: The number of tokens of a shingle
+        min_tokens: Methods with fewer tokens (e.g. accessors) are not indexed
+        """
+        if num_perm % bands:
+            raise ValueError('num_perm (%d) must be a multiple of bands (%d)' % (num_perm, bands))
+        self.path = path
+        self.levels = load_levels(f_lu_levels)
+        self.params = (num_perm, bands, shingle, min_tokens)
+        if os.path.dirname(path):
+            utils.create_folder_if_not_exist(os.path.dirname(path))
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+        with self._lock:
+            conn = self._connect()
+            conn.execute('CREATE TABLE IF NOT EXISTS archives ('
+                         'project_id INTEGER PRIMARY KEY, archive TEXT, mtime REAL, size INTEGER, params TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS fragments (fragment_id INTEGER PRIMARY KEY, '
+                         'project_id INTEGER, file TEXT, startline INTEGER, endline INTEGER, signature BLOB)')
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets ('
+                         'band INTEGER, bucket INTEGER, project_id INTEGER, fragment_id INTEGER)')
+            conn.execute('CREATE INDEX IF NOT EXISTS fragments_project ON fragments (project_id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS buckets_bucket ON buckets (band, bucket)')
+            conn.execute('CREATE INDEX IF NOT EXISTS buckets_project ON buckets (project_id)')
+
+    def _connect(self):
+        # A SQLite connection must not be shared with forked children
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def _params_key(self):
+        return ','.join(map(str, self.params)) + ';' + ','.join(self.levels)
+
+    def is_current(self, project_id, repo_path):
+        """
+        Whether the project is indexed from its current archive, with the current parameters and level functions
+        """
+        if not os.path.isfile(repo_path) and find_repacked(repo_path, java_only=True) is None:
+            return False
+        with self._lock:
+            row = self._connect().execute('SELECT archive, mtime, size, params FROM archives WHERE project_id = ?',
+                                          (int(project_id),)).fetchone()
+        return row is not None and tuple(row) == _archive_state(repo_path) + (self._params_key(),)
+
+    def update(self, df, workers=None):
+        """
+        Index the projects that are new or whose archive changed
+        Parameters
+        ----------
+        df: The projects, with project_id and repo_path
+        workers: The number of processes reading and fingerprinting archives
+
+        Returns
+        -------
+        (indexed, failed): The number of projects
+        """
+        tasks = [(int(row['project_id']), row['repo_path'], self.levels, self.params) for _, row in df.iterrows()
+                 if not self.is_current(row['project_id'], row['repo_path'])]
+        indexed = failed = 0
+        if not tasks:
+            return indexed, failed
+        num_perm, bands = self.params[:2]
+        rows = num_perm // bands
+        # Fragments are fingerprinted by the pool; this process is the only writer
+        with multiprocessing.Pool(processes=min(workers or utils.getWorkers(), len(tasks))) as pool:
+            for project_id, f, mtime, size, fragments, err in pool.imap_unordered(_index_project, tasks):
+                if err is not None:
+                    failed += 1
+                    logger.error('Fail to index fragments of project %s: %s' % (project_id, err))
+                    continue
+                with self._lock:
+                    conn = self._connect()
+                    conn.execute('BEGIN IMMEDIATE')
+                    try:
+                        conn.execute('DELETE FROM buckets WHERE project_id = ?', (project_id,))
+                        conn.execute('DELETE FROM fragments WHERE project_id = ?', (project_id,))
+                        for relpath, startline, endline, signature in fragments:
+                            fragment_id = conn.execute(
+                                'INSERT INTO fragments (project_id, file, startline, endline, signature) '
+                                'VALUES (?, ?, ?, ?, ?)',
+                                (project_id, relpath, startline, endline, signature.tobytes())).lastrowid
+                            conn.executemany('INSERT INTO buckets VALUES (?, ?, ?, ?)', [
+                                (band, _bucket(band, signature[band * rows:(band + 1) * rows]), project_id, fragment_id)
+                                for band in range(bands)])
+                        conn.execute('INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?)',
+                                     (project_id, f, mtime, size, self._params_key()))
+                        conn.execute('COMMIT')
+                    except Exception:
+                        conn.execute('ROLLBACK')
+                        raise
+                indexed += 1
+        return indexed, failed
+
+    def _signatures(self, fragment_ids):
+        signatures = {}
+        fragment_ids = sorted(fragment_ids)
+        with self._lock:
+            conn = self._connect()
+            # Stay below the limit of SQLite host parameters
+            for i in range(0, len(fragment_ids), 500):
+                chunk = fragment_ids[i:i + 500]
+                for fragment_id, signature in conn.execute(
+                        'SELECT fragment_id, signature FROM fragments WHERE fragment_id IN (%s)'
+                        % ','.join('?' * len(chunk)), chunk):
+                    signatures[fragment_id] = np.frombuffer(signature, dtype=np.uint64)
+        return signatures
+
+    def shared_fragments(self, project_id, threshold=0.5):
+        """
+        The near-duplicates of the fragments of a project in other projects
+        Parameters
+        ----------
+        project_id: The project
+        threshold: The least estimated Jaccard similarity of the token shingles of two fragments
+
+        Returns
+        -------
+        df: fragment_id, file, startline, endline, other_project_id, other_fragment_id, other_file,
+            other_startline, other_endline, similarity
+        """
+        with self._lock:
+            candidates = self._connect().execute(
+                'SELECT DISTINCT a.fragment_id, b.fragment_id FROM buckets a JOIN buckets b '
+                'ON a.band = b.band AND a.bucket = b.bucket AND b.project_id != a.project_id '
+                'WHERE a.project_id = ?', (int(project_id),)).fetchall()
+        signatures = self._signatures({x for pair in candidates for x in pair})
+        pairs = []
+        for mine, other in candidates:
+            similarity = float(np.mean(signatures[mine] == signatures[other]))
+            if similarity >= threshold:
+                pairs.append((mine, other, similarity))
+        df = pd.DataFrame(pairs, columns=['fragment_id', 'other_fragment_id', 'similarity'])
+        fragment_ids = set(df['fragment_id']) | set(df['other_fragment_id'])
+        with self._lock:
+            df_fragments = pd.read_sql_query(
+                'SELECT fragment_id, project_id, file, startline, endline FROM fragments WHERE fragment_id IN (%s)'
+                % (','.join(map(str, fragment_ids)) or 'NULL'), self._connect())
+        df = df.merge(df_fragments.drop(columns='project_id'), on='fragment_id')
+        df = df.merge(df_fragments.add_prefix('other_'), on='other_fragment_id')
+        return df[['fragment_id', 'file', 'startline', 'endline', 'other_project_id', 'other_fragment_id',
+                   'other_file', 'other_startline', 'other_endline', 'similarity']]
+
+    def similar_projects(self, project_id, threshold=0.5):
+        """
+        The projects sharing near-duplicate logging-bearing fragments with a project
+        Returns
+        -------
+        df: project_id, fragments (of the given project with a near-duplicate there), pairs, max_similarity;
+            most shared first
+        """
+        df = self.shared_fragments(project_id, threshold)
+        df = df.groupby('other_project_id').agg(fragments=('fragment_id', 'nunique'), pairs=('fragment_id', 'size'),
+                                                max_similarity=('similarity', 'max')).reset_index()
+        return df.rename(columns={'other_project_id': 'project_id'}).sort_values(
+            ['fragments', 'max_similarity'], ascending=False, ignore_index=True)
+
+    def summary(self):
+        """
+        Indexed fragments per project
+        """
+        with self._lock:
+            return pd.read_sql_query(
+                'SELECT a.project_id, COUNT(f.fragment_id) AS fragments FROM archives a '
+                'LEFT JOIN fragments f ON f.project_id = a.project_id GROUP BY a.project_id', self._connect())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index of near-duplicate logging-bearing fragments of the corpus')
+    parser.add_argument('command', choices=['build', 'similar', 'summary'])
+    parser.add_argument('project_id', nargs='?', type=int, help="The project of the similar command")
+    parser.add_argument('--index', default='result/clone_detection/fragment_index.sqlite')
+    parser.add_argument('-l', '--size_level', default='small,medium,large,vlarge')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    index = FragmentIndex(args.index)
+    if args.command == 'build':
+        df = load_corpus([x.strip() for x in args.size_level.split(',')])
+        indexed, failed = index.update(df, workers=args.workers)
+        logger.info('Indexed %d projects (%d failed, %d up to date) in %s'
+                    % (indexed, failed, len(df) - indexed - failed, args.index))
+    elif args.command == 'similar':
+        if args.project_id is None:
+            parser.error('similar needs a project_id')
+        start = time.time()
+        df = index.similar_projects(args.project_id, threshold=args.threshold)
+        print(df.to_string(index=False))
+        logger.info('%d projects share fragments with project %d (%.3fs)'
+                    % (len(df), args.project_id, time.time() - start))
+    else:
+        df = index.summary()
+        print('%d projects, %d fragments' % (len(df), df['fragments'].sum()))
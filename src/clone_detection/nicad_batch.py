@@ -0,0 +1,286 @@
+"""
+Batched NiCad runs on small projects
+For small projects the fixed cost of a NiCad run (startup, TXL grammars, reports) dominates. A batch packs several
+projects into a single NiCad system:
+    temp/projects/batch_<project_id>/<project_id>/<project folder>
+NiCad runs once per configuration on the batch, and its XML outputs are split into the outputs NiCad writes next to
+a project when it runs on the project alone (temp/projects/<project_id>/<project folder>_<granularity>...):
+    - sources of extractions go to the project of their file, with the path of the single-project run
+    - clone pairs are kept if both sources belong to the same project; pairs across projects are discarded
+    - clone classes are reduced to the sources of a project and split into the clusters of its kept pairs
+    - pcids are renumbered in the order of the fragments of the project; npcs, npairs and nclasses are recounted
+Outputs that are not XML (e.g. HTML reports) are not split.
+"""
+import os
+import re
+import sys
+import glob
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import src.util.utils as utils
+
+logger = logging.getLogger(__name__)
+
+# Top-level elements of NiCad XML outputs: sources of extractions, clone pairs and clone classes
+_ELEMENT = re.compile(r'(<clone\b.*?</clone>\n?|<class\b.*?</class>\n?|<source\b[^>]*?(?:/>|>.*?</source>)\n?)', re.S)
+_SOURCE = re.compile(r'<source\b[^>]*?(?:/>|>.*?</source>)\n?', re.S)
+
+
+def _attr(element, name):
+    m = re.search(r'\b%s="([^"]*)"' % name, element)
+    return m.group(1) if m else None
+
+
+def _set_attr(element, name, value):
+    return re.sub(r'\b(%s)="[^"]*"' % name, lambda m: '%s="%s"' % (m.group(1), value), element, count=1)
+
+
+def _fragment(source):
+    return _attr(source, 'file'), _attr(source, 'startline'), _attr(source, 'endline')
+
+
+class BatchSplitter:
+    def __init__(self, d_batch, projects):
+        """
+        Parameters
+        ----------
+        d_batch: The batch system NiCad ran on
+        projects: project_id -> the decompressed project directory in the batch (d_batch/<project_id>/<folder>)
+        """
+        self.d_batch = d_batch
+        self.projects = {str(k): v for k, v in projects.items()}
+        self._batch_name = os.path.basename(d_batch)
+        # The outputs of a project are written where NiCad writes them in a single-project run
+        self.proj_dirs = {repo_id: os.path.join(os.path.dirname(d_batch), repo_id, os.path.basename(proj_dir))
+                          for repo_id, proj_dir in self.projects.items()}
+        # pcid of each fragment of a project, in the order of the extraction
+        self._pcids = {}
+
+    def owner(self, f):
+        """
+        The project id of a source file of the batch, None if it is not in a project of the batch
+        """
+        marker = '/%s/' % self._batch_name
+        if marker not in f:
+            return None
+        repo_id = f.split(marker, 1)[1].split('/', 1)[0]
+        return repo_id if repo_id in self.projects else None
+
+    def _rewrite(self, source, repo_id):
+        # The path of the file in the single-project run, and its pcid among the fragments of the project
+        f = _attr(source, 'file')
+        source = _set_attr(source, 'file', f.replace('/%s/%s/' % (self._batch_name, repo_id), '/%s/' % repo_id, 1))
+        pcid = self._pcids.get(repo_id, {}).get(_fragment(source))
+        if pcid is not None and _attr(source, 'pcid') is not None:
+            source = _set_attr(source, 'pcid', pcid)
+        return source
+
+    def _header(self, text, repo_id, counts):
+        m = re.search(r'(<systeminfo\b[^>]*\bsystem=")([^"]*)(")', text)
+        if m:
+            system = m.group(2)
+            proj_dir = self.proj_dirs[repo_id]
+            if self.d_batch in system:
+                system = system.replace(self.d_batch, proj_dir)
+            else:
+                system = system.replace(self._batch_name, os.path.basename(proj_dir))
+            text = text[:m.start(2)] + system + text[m.end(2):]
+        for name, value in counts.items():
+            text = re.sub(r'(<\w+info\b[^>]*\b%s=")[^"]*(")' % name, lambda x: x.group(1) + str(value) + x.group(2),
+                          text)
+        return text
+
+    def index_extraction(self, xml):
+        """
+        Number the fragments of each project in the order of the batch extraction <d_batch>_<granularity>.xml,
+        as NiCad numbers the fragments of a single project
+        """
+        self._pcids = {}
+        for source in _SOURCE.findall(xml):
+            repo_id = self.owner(_attr(source, 'file') or '')
+            if repo_id is None: continue
+            source = self._rewrite(source, repo_id)
+            pcids = self._pcids.setdefault(repo_id, {})
+            pcids.setdefault(_fragment(source), len(pcids) + 1)
+
+    def _npcs(self, repo_id, text):
+        # Fragments of the project within the size limits of the run
+        minlines = _attr(text, 'minlines')
+        maxlines = _attr(text, 'maxlines')
+        n = 0
+        for f, startline, endline in self._pcids.get(repo_id, {}):
+            try:
+                nlines = int(endline) - int(startline) + 1
+            except (TypeError, ValueError):
+                n += 1
+                continue
+            if minlines is not None and nlines < int(minlines): continue
+            if maxlines is not None and nlines > int(maxlines): continue
+            n += 1
+        return n
+
+    def split_xml(self, xml, pairs=None):
+        """
+        Split a NiCad XML output of the batch
+        Parameters
+        ----------
+        xml: The text of the output
+        pairs: The clone pairs of the same run split by split_xml(), used to cluster the classes of a project;
+            None to keep the sources of a project in a class together
+
+        Returns
+        -------
+        dict: project_id -> the text of the output of the project
+        """
+        parts = _ELEMENT.split(xml)
+        # Text between elements (root and info elements) is kept by every project
+        elements = {repo_id: [] for repo_id in self.projects}
+        counts = {repo_id: {} for repo_id in self.projects}
+        for i, part in enumerate(parts):
+            if i % 2 == 0:
+                for repo_id in self.projects:
+                    elements[repo_id].append(('text', part))
+                continue
+            if part.startswith('<source'):
+                repo_id = self.owner(_attr(part, 'file') or '')
+                if repo_id is not None:
+                    elements[repo_id].append(('source', self._rewrite(part, repo_id)))
+            elif part.startswith('<clone'):
+                sources = _SOURCE.findall(part)
+                owners = {self.owner(_attr(s, 'file') or '') for s in sources}
+                if len(owners) != 1 or None in owners: continue
+                repo_id = owners.pop()
+                elements[repo_id].append(('clone', _SOURCE.sub(lambda m: self._rewrite(m.group(0), repo_id), part)))
+                counts[repo_id]['npairs'] = counts[repo_id].get('npairs', 0) + 1
+            else:
+                for repo_id, clusters in self._split_class(part, pairs).items():
+                    for cluster in clusters:
+                        elements[repo_id].append(('class', cluster))
+
+        is_classes = pairs is not None or re.search(r'<class\b', xml) is not None
+        res = {}
+        for repo_id, items in elements.items():
+            classid = 0
+            out = []
+            for kind, item in items:
+                if kind == 'class':
+                    classid += 1
+                    item = _set_attr(item, 'classid', classid)
+                out.append(item)
+            counts[repo_id]['npcs'] = self._npcs(repo_id, xml)
+            if is_classes:
+                counts[repo_id]['nclasses'] = classid
+                if pairs is not None:
+                    counts[repo_id]['npairs'] = len(_pair_fragments(pairs.get(repo_id, '')))
+                else:
+                    # The pairs of a class output are unknown without the pairs output of the run
+                    counts[repo_id].pop('npairs', None)
+            else:
+                counts[repo_id].setdefault('npairs', 0)
+            res[repo_id] = self._header(''.join(out), repo_id, counts[repo_id])
+        return res
+
+    def _split_class(self, element, pairs):
+        """
+        The sources of a clone class per project, clustered by the kept clone pairs of the project
+        Returns
+        -------
+        dict: project_id -> list of class elements
+        """
+        m = re.match(r'(<class\b[^>]*>\n?)(.*)(</class>\n?)$', element, re.S)
+        if not m:
+            return {}
+        head, body, tail = m.groups()
+        by_project = {}
+        for source in _SOURCE.findall(body):
+            repo_id = self.owner(_attr(source, 'file') or '')
+            if repo_id is not None:
+                by_project.setdefault(repo_id, []).append(self._rewrite(source, repo_id))
+
+        res = {}
+        for repo_id, sources in by_project.items():
+            clusters = [sources]
+            if pairs is not None:
+                clusters = _cluster(sources, _pair_fragments(pairs.get(repo_id, '')))
+            res[repo_id] = [_set_attr(head, 'nclones', len(c)) + ''.join(c) + tail for c in clusters if len(c) > 1]
+        return res
+
+    def split_outputs(self, granularity, snapshot=None):
+        """
+        Write the outputs of every project of the batch from the outputs of the batch run of a granularity
+        Parameters
+        ----------
+        granularity: The NiCad granularity
+        snapshot: Batch outputs before this run (see CloneDetection._snapshot_outputs); files in result folders
+            that did not change since then belong to another configuration and are not split
+
+        Returns
+        -------
+        dict: project_id -> the project directory whose outputs are written, as NiCad would name them
+        """
+        outputs = []
+        for f_out in glob.glob(self.d_batch + '_{}*'.format(granularity)):
+            if os.path.isfile(f_out):
+                outputs.append(f_out)
+                continue
+            for root, _, files in os.walk(f_out):
+                for f in files:
+                    f = os.path.join(root, f)
+                    if snapshot is None or snapshot.get(f) != os.stat(f).st_mtime_ns:
+                        outputs.append(f)
+
+        f_extraction = '%s_%s.xml' % (self.d_batch, granularity)
+        if os.path.isfile(f_extraction):
+            with open(f_extraction, errors='replace') as r:
+                self.index_extraction(r.read())
+
+        # Pairs first, so that the classes of the same run can be clustered with them
+        split_pairs = {}
+        d_parent = os.path.dirname(self.d_batch)
+        for f_out in sorted(outputs, key=lambda f: '-classes' in os.path.basename(f)):
+            relpath = os.path.relpath(f_out, d_parent)
+            if not f_out.endswith('.xml'):
+                logger.debug('Output {} of a NiCad batch is not split'.format(relpath))
+                continue
+            with open(f_out, errors='replace') as r:
+                xml = r.read()
+            stem = f_out[:-len('.xml')]
+            pairs = split_pairs.get(re.sub(r'-classes(-withsource)?$', '', stem)) if '-classes' in stem else None
+            res = self.split_xml(xml, pairs=pairs)
+            if '<clone' in xml and '-classes' not in stem:
+                split_pairs[re.sub(r'-withsource$', '', stem)] = res
+            for repo_id, text in res.items():
+                proj_dir = self.proj_dirs[repo_id]
+                # <batch>_<granularity>... becomes <project folder>_<granularity>..., in files and folders alike
+                relpath_proj = relpath.replace(self._batch_name + '_', os.path.basename(proj_dir) + '_')
+                f = os.path.join(os.path.dirname(proj_dir), relpath_proj)
+                utils.create_folder_if_not_exist(os.path.dirname(f))
+                with open(f, 'w') as w:
+                    w.write(text)
+        return dict(self.proj_dirs)
+
+
+def _pair_fragments(xml):
+    # The fragments of each clone pair of a split pairs output
+    return [[_fragment(s) for s in _SOURCE.findall(clone)] for clone in re.findall(r'<clone\b.*?</clone>', xml, re.S)]
+
+
+def _cluster(sources, pairs):
+    """
+    Group the sources of a class into the connected components of the clone pairs
+    """
+    parent = {}
+
+    def find(x):
+        while parent.setdefault(x, x) != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+    for pair in pairs:
+        for other in pair[1:]:
+            parent[find(pair[0])] = find(other)
+    clusters = {}
+    for source in sources:
+        clusters.setdefault(find(_fragment(source)), []).append(source)
+    return list(clusters.values())
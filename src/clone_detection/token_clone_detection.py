@@ -0,0 +1,586 @@
+"""
+In-process Type-1/Type-2 clone detection of Java projects by token hashing
+A fast alternative to NiCad when only exact (type1) and renamed (type2) clones are needed:
+    1. Java sources are tokenized; whitespace and comments are dropped
+    2. Fragments (functions or blocks) are cut from the token stream by matching braces
+    3. The token window of each fragment is hashed as is (type1), or after identifiers and literals are
+       normalized (type2, as NiCad's blind renaming)
+    4. Fragments with the same hash are grouped into clone classes through a hash index
+Results are written in NiCad's file layout and archived like CloneDetection does, so that NiCad is only needed
+for type3 clones.
+
+Usage:
+    python src/clone_detection/token_clone_detection.py -l small --granularity functions --clonetype type1,type2
+    python src/clone_detection/token_clone_detection.py -l small --validate 20 [--nicad_root <NiCad-6.2>]
+"""
+import os
+import re
+import sys
+import time
+import random
+import shutil
+import hashlib
+import logging
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from itertools import combinations
+from collections import defaultdict
+from datetime import datetime
+from xml.sax.saxutils import escape, quoteattr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import pandas as pd
+import src.util.utils as utils
+from src.clone_detection.clone_detection import CloneDetection, load_projects_list, logging_setup, \
+    skip_examined_projects
+
+logger = logging.getLogger(__name__)
+
+# clonetype -> NiCad renaming; type3 needs NiCad
+RENAMING = {
+    'type1': None,
+    'type2': 'blind',
+}
+# The defaults of NiCad configurations
+MIN_LINES = 10
+MAX_LINES = 2500
+
+_TOKEN = re.compile(r'''
+     (?P<ws>\s+)
+    |(?P<comment>//[^\n]*|/\*.*?\*/)
+    |(?P<literal>"""(?:[^\\]|\\.)*?"""
+        |"(?:[^"\\\n]|\\.)*"
+        |'(?:[^'\\\n]|\\.)+'
+        |(?:0[xX][\da-fA-F_]+|0[bB][01_]+|\d[\d_]*\.?[\d_]*(?:[eE][+-]?\d+)?|\.\d[\d_]*(?:[eE][+-]?\d+)?)[lLfFdD]?)
+    |(?P<ident>[A-Za-z_$][\w$]*)
+    |(?P<op>>>>=|<<=|>>=|\.\.\.|->|::|\+\+|--|&&|\|\||[=!<>+\-*/%&|^]=|.)
+''', re.S | re.X)
+
+JAVA_KEYWORDS = frozenset('''
+    abstract assert boolean break byte case catch char class const continue default do double else enum extends
+    final finally float for goto if implements import instanceof int interface long native new package private
+    protected public return short static strictfp super switch synchronized this throw throws transient try void
+    volatile while var record yield sealed permits
+'''.split())
+_LITERAL_KEYWORDS = frozenset(['true', 'false', 'null'])
+# An identifier followed by "(" is a call, not a method header, after these
+_NOT_METHOD = frozenset(['if', 'for', 'while', 'switch', 'catch', 'synchronized', 'try', 'return', 'new', 'throw',
+                         'else', 'do', 'case', 'assert'])
+_TYPE_DECLARATION = frozenset(['class', 'interface', 'enum', 'record', 'new'])
+
+
+def tokenize(code):
+    """
+    Tokenize Java source code
+    Parameters
+    ----------
+    code: The source code
+
+    Returns
+    -------
+    list of (kind, text, line); kind is literal, ident, keyword or op
+    """
+    tokens = []
+    line = 1
+    for m in _TOKEN.finditer(code):
+        kind, text = m.lastgroup, m.group()
+        if kind == 'ident':
+            if text in _LITERAL_KEYWORDS:
+                kind = 'literal'
+            elif text in JAVA_KEYWORDS:
+                kind = 'keyword'
+        if kind not in ('ws', 'comment'):
+            tokens.append((kind, text, line))
+        line += text.count('\n')
+    return tokens
+
+
+def _match_braces(tokens):
+    # Index of the matching "}" of each "{"; unbalanced braces are left unmatched
+    pairs, stack = {}, []
+    for i, (_, text, _) in enumerate(tokens):
+        if text == '{':
+            stack.append(i)
+        elif text == '}' and stack:
+            pairs[stack.pop()] = i
+    return pairs
+
+
+def _statement_start(tokens, i):
+    # The first token after the previous statement boundary
+    while i > 0 and tokens[i - 1][1] not in (';', '{', '}'):
+        i -= 1
+    return i
+
+
+def _is_method_body(tokens, i):
+    # "{" after "<name>(...)" or "<name>(...) throws A, B"
+    j = i - 1
+    if j >= 0 and tokens[j][0] == 'ident':
+        # Skip the throws clause
+        while j >= 0 and tokens[j][1] != 'throws' and (tokens[j][0] == 'ident' or tokens[j][1] in (',', '.')):
+            j -= 1
+        if j < 0 or tokens[j][1] != 'throws':
+            return False
+        j -= 1
+    if j < 0 or tokens[j][1] != ')':
+        return False
+    depth = 0
+    while j >= 0:
+        depth += {')': 1, '(': -1}.get(tokens[j][1], 0)
+        if depth == 0: break
+        j -= 1
+    name = j - 1
+    return (name >= 0 and tokens[name][0] == 'ident' and tokens[name][1] not in _NOT_METHOD and
+            (name == 0 or tokens[name - 1][1] not in ('new', '.')))
+
+
+def extract_fragments(tokens, granularity):
+    """
+    Cut fragments from the token stream of a file
+    Parameters
+    ----------
+    tokens: The tokens of a file
+    granularity: functions (method and constructor declarations) or blocks (all code blocks)
+
+    Returns
+    -------
+    list of (start, end) token index ranges, end inclusive
+    """
+    fragments = []
+    for i, j in sorted(_match_braces(tokens).items()):
+        start = _statement_start(tokens, i)
+        if granularity == 'functions':
+            if _is_method_body(tokens, i):
+                fragments.append((start, j))
+        else:
+            header = {text for _, text, _ in tokens[start:i]}
+            # Type bodies and array initializers are not code blocks
+            if header & _TYPE_DECLARATION or (i > 0 and tokens[i - 1][1] in ('=', ']', ',', '(')):
+                continue
+            fragments.append((start, j))
+    return fragments
+
+
+def fragment_hash(tokens, renaming=None):
+    """
+    Hash the token window of a fragment
+    Parameters
+    ----------
+    tokens: The tokens of the fragment
+    renaming: None for type1; blind normalizes all identifiers and literals for type2
+
+    Returns
+    -------
+    bytes
+    """
+    if renaming == 'blind':
+        texts = ('x' if kind == 'ident' else 'L' if kind == 'literal' else text for kind, text, _ in tokens)
+    else:
+        texts = (text for _, text, _ in tokens)
+    return hashlib.blake2b('\x00'.join(texts).encode('utf-8', 'replace'), digest_size=16).digest()
+
+
+class SourceFragments:
+    """
+    The fragments of all Java files of a project at a granularity, extracted once for all clone types
+    """
+    def __init__(self, proj_dir, granularity, min_lines=MIN_LINES, max_lines=MAX_LINES):
+        """
+        Parameters
+        ----------
+        proj_dir: The decompressed project directory
+        granularity: functions or blocks
+        min_lines: Fragments shorter than this are ignored
+        max_lines: Fragments longer than this are ignored
+        """
+        self.proj_dir = proj_dir
+        self.granularity = granularity
+        self.min_lines = min_lines
+        self.max_lines = max_lines
+        # list of (file, startline, endline, source text, tokens); the index is the pcid
+        self.fragments = []
+        for root, _, files in os.walk(proj_dir):
+            for f in sorted(files):
+                if f.endswith('.java'):
+                    self._add_file(os.path.join(root, f))
+
+    def _add_file(self, f):
+        try:
+            with open(f, encoding='utf-8', errors='replace') as r:
+                code = r.read()
+        except OSError as e:
+            logger.warning('Unable to read %s: %s' % (f, e))
+            return
+        lines = code.split('\n')
+        tokens = tokenize(code)
+        for start, end in extract_fragments(tokens, self.granularity):
+            startline, endline = tokens[start][2], tokens[end][2]
+            if not self.min_lines <= endline - startline + 1 <= self.max_lines:
+                continue
+            self.fragments.append((f, startline, endline, '\n'.join(lines[startline - 1:endline]),
+                                   tokens[start:end + 1]))
+
+    def clone_classes(self, renaming=None):
+        """
+        Group fragments with the same hash
+        Parameters
+        ----------
+        renaming: None for type1, blind for type2
+
+        Returns
+        -------
+        list of lists of pcids, one list per clone class
+        """
+        index = defaultdict(list)
+        for pcid, fragment in enumerate(self.fragments):
+            index[fragment_hash(fragment[4], renaming)].append(pcid)
+        return [pcids for pcids in index.values() if len(pcids) > 1]
+
+    def write_extraction(self, f):
+        """
+        Write the extracted fragments as NiCad's <system>_<granularity>.xml
+        """
+        with open(f, 'w') as w:
+            for file, startline, endline, text, _ in self.fragments:
+                w.write('<source file={} startline="{}" endline="{}">\n{}\n</source>\n'.format(
+                    quoteattr(file), startline, endline, escape(text)))
+
+    def _source_tag(self, pcid):
+        file, startline, endline, _, _ = self.fragments[pcid]
+        return '<source file={} startline="{}" endline="{}" pcid="{}"></source>\n'.format(
+            quoteattr(file), startline, endline, pcid + 1)
+
+    def write_clones(self, d_out, renaming, classes, cputime_ms=0):
+        """
+        Write clone pairs and clone classes in NiCad's layout:
+            <system>_<granularity>[-blind]-clones/<system>_<granularity>[-blind]-clones-0.00.xml
+            <system>_<granularity>[-blind]-clones/<system>_<granularity>[-blind]-clones-0.00-classes.xml
+        Parameters
+        ----------
+        d_out: The folder holding the project directory
+        renaming: None for type1, blind for type2
+        classes: The clone classes from clone_classes
+        cputime_ms: The detection time reported in runinfo
+        """
+        system = os.path.basename(self.proj_dir)
+        name = '{}_{}{}-clones'.format(system, self.granularity, '-' + renaming if renaming else '')
+        d_clones = os.path.join(d_out, name)
+        utils.create_folder_if_not_exist(d_clones)
+        systeminfo = '<systeminfo processor="token_hash" system={} granularity="{}" threshold="0%" ' \
+                     'minlines="{}" maxlines="{}"/>\n'.format(quoteattr(system), self.granularity,
+                                                              self.min_lines, self.max_lines)
+        npairs = sum(len(c) * (len(c) - 1) // 2 for c in classes)
+        cloneinfo = '<cloneinfo npcs="{}" npairs="{}"/>\n'.format(len(self.fragments), npairs)
+        runinfo = '<runinfo ncompares="{}" cputime="{}"/>\n'.format(len(self.fragments), int(cputime_ms))
+
+        with open(os.path.join(d_clones, name + '-0.00.xml'), 'w') as w:
+            w.write('<clones>\n' + systeminfo + cloneinfo + runinfo)
+            for pcids in classes:
+                nlines = self.fragments[pcids[0]][2] - self.fragments[pcids[0]][1] + 1
+                for a, b in combinations(pcids, 2):
+                    w.write('<clone nlines="{}" similarity="100">\n'.format(nlines))
+                    w.write(self._source_tag(a) + self._source_tag(b))
+                    w.write('</clone>\n')
+            w.write('</clones>\n')
+
+        with open(os.path.join(d_clones, name + '-0.00-classes.xml'), 'w') as w:
+            w.write('<classes>\n' + systeminfo + cloneinfo + runinfo)
+            w.write('<classinfo nclasses="{}"/>\n'.format(len(classes)))
+            for classid, pcids in enumerate(classes, 1):
+                nlines = self.fragments[pcids[0]][2] - self.fragments[pcids[0]][1] + 1
+                w.write('<class classid="{}" nclones="{}" nlines="{}" similarity="100">\n'.format(
+                    classid, len(pcids), nlines))
+                for pcid in pcids:
+                    w.write(self._source_tag(pcid))
+                w.write('</class>\n')
+            w.write('</classes>\n')
+
+
+def detect_clones(proj_dir, configs, extracted=None):
+    """
+    Detect clones of a decompressed project and write NiCad-style outputs next to it
+    Parameters
+    ----------
+    proj_dir: The decompressed project directory
+    configs: list of (granularity, clonetype)
+    extracted: dict of granularity -> SourceFragments, extracted fragments shared between calls
+
+    Returns
+    -------
+    dict: (granularity, clonetype) -> clone classes
+    """
+    d_out = os.path.dirname(proj_dir)
+    results = {}
+    extracted = {} if extracted is None else extracted
+    for granularity, clonetype in configs:
+        if granularity not in extracted:
+            # Extract once per granularity and reuse for all clone types
+            extracted[granularity] = SourceFragments(proj_dir, granularity)
+            extracted[granularity].write_extraction(
+                os.path.join(d_out, '{}_{}.xml'.format(os.path.basename(proj_dir), granularity)))
+        fragments = extracted[granularity]
+        start = time.process_time()
+        classes = fragments.clone_classes(RENAMING[clonetype])
+        fragments.write_clones(d_out, RENAMING[clonetype], classes, (time.process_time() - start) * 1000)
+        results[(granularity, clonetype)] = classes
+    return results
+
+
+class TokenCloneDetection(CloneDetection):
+    """
+    CloneDetection with the in-process token hash detector instead of NiCad
+    Only type1 and type2 of functions/blocks granularity are supported
+    """
+    def __init__(self, language, granularity, clonetype, remove_logging=False):
+        super().__init__(language, granularity, clonetype, remove_logging)
+        if language != 'java':
+            raise ValueError('The token detector only supports java, got %s' % language)
+        for g, t in self.configs:
+            if g not in ('functions', 'blocks') or t not in RENAMING:
+                raise ValueError('The token detector supports functions/blocks with %s; use NiCad for %s %s' % (
+                    '/'.join(RENAMING.keys()), g, t))
+
+    def clone_detection_project(self, row):
+        """
+        Clone detection of a single project, for all configurations
+        Parameters
+        ----------
+        row: dict or dataframe row, records the information of a project
+        """
+        repo_path = row['repo_path']
+        repo_id = row['project_id']
+        configs = self._pending_configs(row)
+        if not configs: return
+
+        if not os.path.isfile(repo_path):
+            logger.error('Unable to find path: {}'.format(repo_path))
+            return
+
+        with self._admit(row), utils.log_context(project_id=repo_id):
+            start = time.time()
+            tmp_out_dir = os.path.abspath(os.path.join(self.tmp, str(repo_id)))
+            try:
+                tmp_out_proj_dir = self._extract_project(repo_path, tmp_out_dir)
+                res_tar_fs = []
+                extracted = {}
+                for granularity, clonetype, res_tar_f in configs:
+                    snapshot = self._snapshot_outputs(tmp_out_proj_dir, granularity) if len(self.configs) > 1 else None
+                    detect_clones(tmp_out_proj_dir, [(granularity, clonetype)], extracted)
+                    self._archive_nicad_results(tmp_out_proj_dir, res_tar_f, granularity, snapshot)
+                    res_tar_fs.append(res_tar_f)
+                logger.info('Clone detection finished in {:.1f}s. Results are saved in {}'.format(
+                    time.time() - start, ', '.join(res_tar_fs)))
+            except Exception as e:
+                logger.error('Clone detection fail at project {}, {}'.format(row['repo_name'], str(e)))
+            finally:
+                shutil.rmtree(tmp_out_dir, ignore_errors=True)
+
+    def clone_detection_in_project(self, df, workers=None):
+        """
+        Perform clone detection on all projects with a process pool
+        Parameters
+        ----------
+        df: The dataframe with projects to be analyzed
+        workers: The number of processes, default to utils.getWorkers()
+        """
+        global _detector
+        # Forked workers use the detector through the module, so it is not pickled per project
+        _detector = self
+        rows = [row.to_dict() for _, row in df.iterrows()]
+        with multiprocessing.Pool(workers or utils.getWorkers()) as pool:
+            for _ in pool.imap_unordered(_clone_detection_project, rows):
+                pass
+
+
+# The detector used by pool workers, set before the pool is forked
+_detector = None
+
+
+def _clone_detection_project(row):
+    _detector.clone_detection_project(row)
+
+
+def _write_java_class(f, methods):
+    utils.create_folder_if_not_exist(os.path.dirname(f))
+    with open(f, 'w') as w:
+        w.write('package bench;\n\npublic class {} {{\n\n{}\n}}\n'.format(
+            os.path.splitext(os.path.basename(f))[0], '\n\n'.join(methods)))
+
+
+def _random_method(rnd, name, n_statements):
+    # A method of one statement per line, e.g. "int v3 = v1 * 7;"
+    variables = ['v%d' % i for i in range(3)]
+    lines = ['    public int {}(int v0, int v1, int v2) {{'.format(name)]
+    for i in range(n_statements):
+        var = 'v%d' % (i + 3)
+        lines.append('        int {} = {} {} {};'.format(var, rnd.choice(variables), rnd.choice('+-*'),
+                                                       rnd.randint(1, 999)))
+        variables.append(var)
+    lines.append('        return {};'.format(variables[-1]))
+    lines.append('    }')
+    return '\n'.join(lines)
+
+
+def generate_synthetic_corpus(d, n_projects=10, n_files=5, n_methods=8, seed=0):
+    """
+    Generate Java projects with known clones
+    Every project gets a type1 copy (reformatted and commented), a type2 copy (renamed, other literals) and
+    a type3 copy (one statement added) of some of its methods
+    Parameters
+    ----------
+    d: The output folder; projects are written as <d>/proj<i>.tar.gz
+    n_projects: The number of projects
+    n_files: The number of files per project
+    n_methods: The number of methods per file
+
+    Returns
+    -------
+    df: The projects (project_id, repo_name, repo_path)
+    truth: dict of project_id -> {clonetype: set of frozenset({(file, startline), (file, startline)})}
+    """
+    rnd = random.Random(seed)
+    rows, truth = [], {}
+    for p in range(n_projects):
+        name = 'proj%d' % p
+        d_src = os.path.join(d, 'src', name)
+        files = {}
+        for i in range(n_files):
+            files['src/bench/C%d.java' % i] = [_random_method(rnd, 'm%d' % j, rnd.randint(10, 25))
+                                               for j in range(n_methods)]
+        files['src/bench/Copies.java'] = []
+        # (original file, index, clonetype, index in Copies.java)
+        copies = []
+        for k, (i, idx) in enumerate(rnd.sample([(i, j) for i in range(n_files) for j in range(n_methods)], 3)):
+            f_orig = 'src/bench/C%d.java' % i
+            method = files[f_orig][idx]
+            type1 = method.replace('        ', '      ').replace(';', '; // copied', 1)
+            type2 = re.sub(r'\bv(\d+)\b', r'w\1', method)
+            type2 = re.sub(r'\b(\d+)\b', lambda m: str(int(m.group(1)) + 1), type2)
+            type2 = type2.replace('m%d(' % idx, 'copy%d(' % k, 1)
+            type3 = method.replace('        return', '        v0 = v0 + 1;\n        return', 1)
+            for clonetype, copy in (('type1', type1), ('type2', type2), ('type3', type3)):
+                files['src/bench/Copies.java'].append(copy)
+                copies.append((f_orig, idx, clonetype, len(files['src/bench/Copies.java']) - 1))
+        for f, methods in files.items():
+            _write_java_class(os.path.join(d_src, f), methods)
+
+        def startline(f, idx):
+            # Every class starts with 4 lines; methods are separated by a blank line
+            return 5 + sum(m.count('\n') + 2 for m in files[f][:idx])
+
+        truth_p = {'type1': set(), 'type2': set()}
+        for f_orig, idx, clonetype, idx_copy in copies:
+            a = (os.path.join(name, f_orig), startline(f_orig, idx))
+            b = (os.path.join(name, 'src/bench/Copies.java'), startline('src/bench/Copies.java', idx_copy))
+            if clonetype == 'type1':
+                truth_p['type1'].add(frozenset([a, b]))
+            if clonetype in ('type1', 'type2'):
+                truth_p['type2'].add(frozenset([a, b]))
+        # Copies of the same method are clones of each other as well
+        for k in range(3):
+            t1, t2 = [(os.path.join(name, 'src/bench/Copies.java'), startline('src/bench/Copies.java', 3 * k + i))
+                      for i in (0, 1)]
+            truth_p['type2'].add(frozenset([t1, t2]))
+
+        f_tar = os.path.join(d, '%s.tar.gz' % name)
+        subprocess.run(['tar', 'czf', f_tar, '-C', os.path.join(d, 'src'), name], check=True)
+        rows.append({'project_id': p, 'repo_name': name, 'repo_path': f_tar})
+        truth[p] = truth_p
+    return pd.DataFrame(rows), truth
+
+
+def _pairs_from_clones_xml(f, proj_dir):
+    # Clone pairs as frozensets of (file relative to the project's parent, startline)
+    pairs = set()
+    sources = re.findall(r'<source file="([^"]*)" startline="(\d+)"', open(f).read())
+    for i in range(0, len(sources) - 1, 2):
+        pairs.add(frozenset((os.path.relpath(file, os.path.dirname(proj_dir)), int(line))
+                            for file, line in sources[i:i + 2]))
+    return pairs
+
+
+def validate(n_projects=10, granularity='functions', nicad_root=None, seed=0):
+    """
+    Validate the token detector on a synthetic corpus: precision/recall against the injected clones,
+    and agreement and speed against NiCad if nicad_root is given
+    Returns
+    -------
+    df: One row per (detector, clonetype)
+    """
+    d = tempfile.mkdtemp(prefix='token_clone_validation_')
+    try:
+        df, truth = generate_synthetic_corpus(d, n_projects=n_projects, seed=seed)
+        detectors = ['token_hash'] + (['nicad6'] if nicad_root else [])
+        found = {(det, t): {} for det in detectors for t in RENAMING}
+        seconds = defaultdict(float)
+        for _, row in df.iterrows():
+            proj_dir = os.path.join(d, 'src', row['repo_name'])
+            for det in detectors:
+                for clonetype, renaming in RENAMING.items():
+                    for x in glob_nicad_outputs(proj_dir, granularity):
+                        shutil.rmtree(x) if os.path.isdir(x) else os.remove(x)
+                    start = time.time()
+                    if det == 'token_hash':
+                        detect_clones(proj_dir, [(granularity, clonetype)])
+                    else:
+                        subprocess.run(['./nicad6', granularity, 'java', proj_dir, clonetype], cwd=nicad_root,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    seconds[(det, clonetype)] += time.time() - start
+                    name = '{}_{}{}-clones'.format(row['repo_name'], granularity, '-' + renaming if renaming else '')
+                    f_clones = os.path.join(d, 'src', name, name + '-0.00.xml')
+                    found[(det, clonetype)][row['project_id']] = \
+                        _pairs_from_clones_xml(f_clones, proj_dir) if os.path.isfile(f_clones) else set()
+
+        records = []
+        for (det, clonetype), pairs in found.items():
+            tp = sum(len(pairs[p] & truth[p][clonetype]) for p in truth)
+            n_found = sum(len(pairs[p]) for p in truth)
+            n_truth = sum(len(truth[p][clonetype]) for p in truth)
+            record = {'detector': det, 'clonetype': clonetype, 'pairs': n_found,
+                      'precision': tp / n_found if n_found else 1.0, 'recall': tp / n_truth if n_truth else 1.0,
+                      'seconds': seconds[(det, clonetype)]}
+            if det != 'token_hash':
+                token_pairs = found[('token_hash', clonetype)]
+                union = sum(len(pairs[p] | token_pairs[p]) for p in truth)
+                record['agreement'] = sum(len(pairs[p] & token_pairs[p]) for p in truth) / union if union else 1.0
+            records.append(record)
+        return pd.DataFrame(records)
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+def glob_nicad_outputs(proj_dir, granularity):
+    """
+    The NiCad-style outputs of a project at a granularity
+    """
+    d = os.path.dirname(proj_dir)
+    prefix = '{}_{}'.format(os.path.basename(proj_dir), granularity)
+    return [os.path.join(d, x) for x in os.listdir(d) if x.startswith(prefix)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Token hash clone detection', add_help=False)
+    parser.add_argument('--validate', type=int, default=0,
+                        help="Validate on a synthetic corpus with this number of projects instead of detecting clones")
+    parser.add_argument('--nicad_root', type=str, default=None,
+                        help="NiCad installation to compare against during validation")
+    parser.add_argument('--granularity', type=str, default='functions')
+    extra_args, _ = parser.parse_known_args()
+    if extra_args.validate:
+        print(validate(n_projects=extra_args.validate, granularity=extra_args.granularity,
+                       nicad_root=extra_args.nicad_root).to_string(index=False))
+        sys.exit()
+
+    start_time = datetime.now()
+    args, _ = utils.parse_args_clone_detection()
+    if args.clonetype == 'default':
+        args.clonetype = 'type1,type2'
+    cdetec = TokenCloneDetection(language=args.language, granularity=args.granularity, clonetype=args.clonetype)
+    logging_setup(args)
+    df = load_projects_list(args, fromdir='result/proj_sloc', ftype='filesize')
+    skip_examined_projects(df)
+    cdetec.clone_detection_in_project(df)
+    utils.print_msg_box('Finished!\nRunning Time: %s' % str(datetime.now() - start_time))
@@ -3,7 +3,8 @@ import sys
 import subprocess
 import pandas as pd
 import logging
-sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from src.util.utils import setlogger, log_context
 
 logger = logging.getLogger(__name__)
 
@@ -35,7 +36,8 @@ def check_uncompressed_size(df):
         size_mb = subprocess.check_output(cmd, shell=True).decode('utf-8').strip()
         res['size_mb'] = size_mb
         res_all.append(res)
-        print('The size of %s is %s MB' % (os.path.basename(repo_path), str(size_mb)))
+        with log_context(project_id=res['project_id']):
+            logger.info('The size of %s is %s MB' % (os.path.basename(repo_path), str(size_mb)))
     return res_all
 
 
@@ -46,6 +48,7 @@ if __name__ == '__main__':
     # Compressed files directory
     root_dir = '/home/local/SAIL/kundi/BACKUP/dataset/GitJavaLoggingRepos'
     res_f = 'res/filesize_mb_{}.csv'.format('_'.join(size_types))
+    setlogger(os.path.abspath('log/size_calculator/proj_size_{}.log'.format('_'.join(size_types))))
     df_projects = csv_loader('conf/log_all_stats.csv')
     # Filter selected
     df_projects = df_projects.loc[df_projects['size'].isin(size_types)]
@@ -2,21 +2,16 @@ import multiprocessing
 import os
 import shutil
 import sys
-import subprocess
-import tarfile
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
 import pandas as pd
 import logging
 import ast
-from src.util.utils import getPath, parse_args_size_level, chunkify
-try:
-    from readerwriterlock import rwlock
-    lock = rwlock.RWLockWrite().gen_wlock()
-except ImportError:
-    from threading import Lock
-    lock = Lock()
+from src.util.utils import getPath, parse_args_size_level, chunkify, setlogger, log_context
+from src.util.result_sink import CsvResultSink
+from src.util.corpus_archive import ProjectArchive
+import src.util.child_usage as child_usage
 
 global logger
 logger = logging.getLogger(__name__)
@@ -34,7 +29,7 @@ def update_repo_lists(df_projects, root_dir):
     return df_projects
 
 
-def check_uncompressed_size(df, filetype='java', out_f=None):
+def check_uncompressed_size(df, filetype='java', out_f=None, timeout=None, timeout_per_kloc=0):
     res_all = []
     for idx, row in df.iterrows():
         res = row.to_dict()
@@ -48,10 +43,10 @@ def check_uncompressed_size(df, filetype='java', out_f=None):
             logger.warning('Unable to locate file: %s; skip' % repo_path)
             continue
 
-        # Unzip tar since scc seems not accept processing on the fly
-        tar = tarfile.open(repo_path, "r:gz")
-        tar.extractall(path=folder_d)
-        tar.close()
+        # Unzip tar since scc seems not accept processing on the fly; only the files scc counts
+        exts = [filetype] if isinstance(filetype, str) else filetype
+        with ProjectArchive.open(repo_path, java_only=exts == ['java']) as archive:
+            archive.extract(folder_d, suffix=tuple('.' + x for x in exts))
 
         if isinstance(filetype, str):
             cmd = "scc --no-complexity  --include-ext {ext} -f json {d}".format(d=folder_d, ext=filetype)
@@ -60,20 +55,32 @@ def check_uncompressed_size(df, filetype='java', out_f=None):
                 d=folder_d, exts=','.join(filetype))
         # Example:
         # [{"Name":"Java","Bytes":3034863,"CodeBytes":0,"Lines":99397,"Code":46919,"Comment":40154,"Blank":12324,"Complexity":0,"Count":523,"WeightedComplexity":0,"Files":[]}]
-        out = subprocess.check_output(cmd, shell=True).decode('utf-8').rstrip()
+        # The SLOC is not known yet, so the size of the archive stands in for the size of the project
+        scc_timeout = child_usage.scaled_timeout({'size_mb': os.path.getsize(repo_path) / 1024 / 1024}, timeout,
+                                                 timeout_per_kloc)
+        with child_usage.collect() as usage:
+            try:
+                out = child_usage.check_output(cmd, tool='scc', shell=True,
+                                               timeout=scc_timeout).decode('utf-8').rstrip()
+            except child_usage.ChildTimeout:
+                logger.error('scc timed out after %.0fs at %s; skip' % (scc_timeout, os.path.basename(repo_path)))
+                shutil.rmtree(folder_d, ignore_errors=True)
+                continue
 
         if os.path.isdir(folder_d): shutil.rmtree(folder_d)
 
         for res_sloc_per_ext in ast.literal_eval(out):
-            res_all.append({**res, **dict(res_sloc_per_ext)})
-        logger.info('Finish calculating SLOC of %s' % os.path.basename(repo_path))
+            res_all.append({**res, **dict(res_sloc_per_ext), **child_usage.summarize(usage, prefix='scc_')})
+        with log_context(project_id=res['project_id']):
+            logger.info('Finish calculating SLOC of %s' % os.path.basename(repo_path))
 
     if out_f:
         to_csv(res=res_all, f=out_f)
 
     return res_all
 
-def check_uncompressed_size_parallel(df_projects, out_f, file_type = 'java', chunks=20, ):
+def check_uncompressed_size_parallel(df_projects, out_f, file_type = 'java', chunks=20, timeout=None,
+                                     timeout_per_kloc=0):
     """
     Check SLOC in parallel
     :param df:
@@ -83,7 +90,8 @@ def check_uncompressed_size_parallel(df_projects, out_f, file_type = 'java', chu
     jobs = []
     for df in chunkify(data=df_projects, chunks=2):
         jobs.append(
-            multiprocessing.Process(target=check_uncompressed_size, args=(df, file_type, out_f, ))
+            multiprocessing.Process(target=check_uncompressed_size,
+                                    args=(df, file_type, out_f, timeout, timeout_per_kloc, ))
         )
     [j.start() for j in jobs]
     [j.join() for j in jobs]
@@ -97,21 +105,8 @@ def to_csv(res, f):
     :param f:
     :return:
     """
-    df = pd.DataFrame(res)
-    with lock:
-        if os.path.isfile(f):
-            df.to_csv(f, index=False, mode='a', header=False)
-        else:
-            df.to_csv(f, index=False, mode='w', header=True)
-
-def setlogger(f_log):
-    if not os.path.isdir(os.path.dirname(f_log)):
-        os.makedirs(os.path.dirname(f_log))
-    logging.basicConfig(
-        filename=os.path.join(f_log),
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        datefmt='%d-%b-%y %H:%M:%S')
+    # Each worker appends to its own shard; scc reports one row per language, hence the key
+    CsvResultSink(f, key=['project_id', 'Name']).write(pd.DataFrame(res))
 
 def output_prepare(f):
     if not os.path.isdir(os.path.dirname(f)):
@@ -129,6 +124,8 @@ if __name__ == '__main__':
     # The output locaiton
     out_f = os.path.abspath('../../result/proj_sloc/filesize_sloc_{}.csv'.format('_'.join(size_types)))
     output_prepare(out_f)
+    sink = CsvResultSink(out_f, key=['project_id', 'Name'])
+    sink.clear()
 
     # Set logger
     setlogger(os.path.abspath('../../log/sloc_calculator/proj_sloc_{}.log'.format('_'.join(size_types))))
@@ -140,7 +137,10 @@ if __name__ == '__main__':
     df_projects = update_repo_lists(df_projects, root_dir)
 
     # Check size
-    res_all = check_uncompressed_size_parallel(df_projects=df_projects, chunks=20, out_f=out_f)
+    res_all = check_uncompressed_size_parallel(df_projects=df_projects, chunks=20, out_f=out_f, timeout=args.timeout,
+                                               timeout_per_kloc=args.timeout_per_kloc)
+    # Merge the shards of all workers into out_f
+    sink.compact()
 
     # If use multiprocessing, add lock & append
     # res_all = check_uncompressed_size(df_projects, 'java')
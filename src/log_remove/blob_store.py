@@ -0,0 +1,269 @@
+"""
+Corpus-wide store of java files keyed by their content
+Forks and vendored libraries put the same .java file in many projects. Logging removal formats, scans and edits
+a file the same way wherever it is, so the results are memoized per distinct content (blob):
+    formatted: sha1 of the source                 -> JavaFormatter output
+    scans:     sha1 of the formatted source, LU   -> logging lines with their linetype
+    edits:     sha1 of the formatted source, LU   -> the source with the scanned logging lines removed
+where LU stands for the level functions removed. Each distinct file is then formatted and scanned once in the corpus,
+and the hit rates of the three memos are kept in the store:
+    python src/log_remove/blob_store.py summary
+"""
+import os
+import sys
+import json
+import zlib
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import pandas as pd
+import src.util.utils as ut
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('format', 'scan', 'edit')
+
+
+def blob_id(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _file_id(f):
+    # Results of a tool are only valid for the version of the tool that produced them
+    with open(f, 'rb') as r:
+        return blob_id(r.read())[:10]
+
+
+class BlobStore:
+    def __init__(self, path='result/log_remove/blob_store.sqlite', f_javaformatter=None):
+        """
+        Parameters
+        ----------
+        path: The SQLite file of the store
+        f_javaformatter: The JavaFormatter jar; formatted sources of another jar are not reused
+        """
+        self.path = path
+        f_javaformatter = f_javaformatter or os.path.join(
+            *[ut.get_proj_root(), 'resources', 'javaformatter', 'JavaFormatter.jar'])
+        self.formatter = _file_id(f_javaformatter) if os.path.isfile(f_javaformatter) else 'none'
+        if os.path.dirname(path):
+            ut.create_folder_if_not_exist(os.path.dirname(path))
+        # Hits and misses since the last flush_stats()
+        self.hits = Counter()
+        self.misses = Counter()
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+        with self._lock:
+            conn = self._connect()
+            conn.execute('CREATE TABLE IF NOT EXISTS formatted (blob TEXT, formatter TEXT, data BLOB, '
+                         'PRIMARY KEY (blob, formatter))')
+            conn.execute('CREATE TABLE IF NOT EXISTS scans (blob TEXT, functions TEXT, lines TEXT, '
+                         'PRIMARY KEY (blob, functions))')
+            conn.execute('CREATE TABLE IF NOT EXISTS edits (blob TEXT, functions TEXT, data BLOB, '
+                         'PRIMARY KEY (blob, functions))')
+            conn.execute('CREATE TABLE IF NOT EXISTS stats (kind TEXT PRIMARY KEY, hits INTEGER, misses INTEGER)')
+
+    def _connect(self):
+        # A SQLite connection must not be shared with forked children
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def _lookup(self, table, column, ids, key_column, key):
+        found = {}
+        ids = sorted(set(ids))
+        with self._lock:
+            conn = self._connect()
+            # Stay below the limit of SQLite host parameters
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                rows = conn.execute('SELECT blob, %s FROM %s WHERE %s = ? AND blob IN (%s)' % (
+                    column, table, key_column, ','.join('?' * len(chunk))), [key] + chunk).fetchall()
+                found.update(rows)
+        return found
+
+    def _insert(self, table, rows):
+        if not rows: return
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany('INSERT OR REPLACE INTO %s VALUES (?, ?, ?)' % table, rows)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def _memo(self, kind, blobs, found, compute):
+        """
+        Results of all blobs: found in the store, or computed once per distinct content
+        Parameters
+        ----------
+        kind: One of KINDS, for the hit rates
+        blobs: name -> content
+        found: blob id -> result, from the store
+        compute: Function computing name -> result of the given names, one per distinct content not found
+
+        Returns
+        -------
+        (results, computed): name -> result, and blob id -> result of the computed ones
+        """
+        ids = {name: blob_id(data) for name, data in blobs.items()}
+        missing = {}
+        for name, i in ids.items():
+            if i not in found:
+                missing.setdefault(i, name)
+        computed = {}
+        if missing:
+            res = compute(sorted(missing.values()))
+            computed = {i: res[name] for i, name in missing.items()}
+        with self._lock:
+            self.misses[kind] += len(computed)
+            self.hits[kind] += len(ids) - len(computed)
+        return {name: found[i] if i in found else computed[i] for name, i in ids.items()}, computed
+
+    def formatted(self, blobs, format_java):
+        """
+        The JavaFormatter output of java sources
+        Parameters
+        ----------
+        blobs: name -> source
+        format_java: Function formatting the given names, returning name -> formatted source
+
+        Returns
+        -------
+        name -> formatted source
+        """
+        found = {i: zlib.decompress(data) for i, data in self._lookup(
+            'formatted', 'data', map(blob_id, blobs.values()), 'formatter', self.formatter).items()}
+        res, computed = self._memo('format', blobs, found, format_java)
+        self._insert('formatted', [(i, self.formatter, zlib.compress(data)) for i, data in computed.items()])
+        return res
+
+    def scanned(self, blobs, function_names, scan):
+        """
+        The logging lines of formatted sources
+        Parameters
+        ----------
+        blobs: name -> formatted source
+        function_names: The level functions of the LUs removed
+        scan: Function scanning the given names, returning name -> line number -> {line, linetype};
+            names without logging may be left out
+
+        Returns
+        -------
+        name -> line number -> {line, linetype}, empty for names without logging
+        """
+        functions = _functions_key(function_names)
+        found = {i: _load_lines(lines) for i, lines in self._lookup(
+            'scans', 'lines', map(blob_id, blobs.values()), 'functions', functions).items()}
+
+        def compute(names):
+            res = scan(names)
+            return {name: {int(k): dict(v) for k, v in res.get(name, {}).items()} for name in names}
+        res, computed = self._memo('scan', blobs, found, compute)
+        self._insert('scans', [(i, functions, json.dumps(lines)) for i, lines in computed.items()])
+        return res
+
+    def edited(self, blobs, function_names, removal, edit):
+        """
+        The formatted sources with their scanned logging lines removed
+        Parameters
+        ----------
+        blobs: name -> formatted source, whose logging lines are removal[name] as returned by scanned()
+        function_names: The level functions of the LUs removed
+        removal: name -> line number -> {line, linetype}
+        edit: Function removing the logging lines of the given names, returning name -> edited source
+
+        Returns
+        -------
+        name -> edited source
+        """
+        functions = _functions_key(function_names)
+        found = {i: zlib.decompress(data) for i, data in self._lookup(
+            'edits', 'data', map(blob_id, blobs.values()), 'functions', functions).items()}
+        res, computed = self._memo('edit', blobs, found, lambda names: edit({name: removal[name] for name in names}))
+        self._insert('edits', [(i, functions, zlib.compress(data)) for i, data in computed.items()])
+        return res
+
+    def remove_logging(self, blobs, function_names, format_java, scan, edit, write):
+        """
+        Format, scan and edit the log related files of a project through the memos
+        Parameters
+        ----------
+        blobs: name -> source
+        function_names: The level functions of the LUs removed
+        format_java: See formatted()
+        scan: See scanned(); names are written formatted before it is called
+        edit: See edited(); it gets the logging lines of the names to edit
+        write: Function saving name -> content as the current content of the files of the project
+
+        Returns
+        -------
+        removal: name -> line number -> {line, linetype} of the names with logging
+        """
+        formatted = self.formatted(blobs, format_java)
+        write(formatted)
+        removal = {name: lines for name, lines in self.scanned(formatted, function_names, scan).items() if lines}
+        write(self.edited({name: formatted[name] for name in removal}, function_names, removal, edit))
+        self.flush_stats()
+        return removal
+
+    def flush_stats(self):
+        """
+        Add the hits and misses counted by this process to the store
+        """
+        with self._lock:
+            # Threads of a process share the counters, so they are taken and reset at once
+            rows = [(kind, self.hits[kind], self.misses[kind]) for kind in KINDS
+                    if self.hits[kind] or self.misses[kind]]
+            self.hits.clear()
+            self.misses.clear()
+            if not rows: return
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany('INSERT INTO stats VALUES (?, ?, ?) ON CONFLICT (kind) DO UPDATE SET '
+                                 'hits = hits + excluded.hits, misses = misses + excluded.misses', rows)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def summary(self):
+        """
+        Hits, misses and hit rate of each memo, and the number of distinct blobs stored
+        """
+        with self._lock:
+            conn = self._connect()
+            df = pd.read_sql_query('SELECT kind, hits, misses FROM stats', conn)
+            blobs = {kind: conn.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+                     for kind, table in zip(KINDS, ['formatted', 'scans', 'edits'])}
+        df['hit_rate'] = df['hits'] / (df['hits'] + df['misses']).clip(lower=1)
+        df['blobs'] = df['kind'].map(blobs)
+        return df
+
+
+def _functions_key(function_names):
+    # grep of logging removal is case insensitive
+    return ','.join(sorted({x.lower() for x in function_names}))
+
+
+def _load_lines(lines):
+    # JSON object keys are strings; line numbers are ints as in single_line_grep_logging
+    return {int(k): v for k, v in json.loads(lines).items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Content-addressed memo of logging removal')
+    parser.add_argument('command', choices=['summary'])
+    parser.add_argument('--store', default='result/log_remove/blob_store.sqlite')
+    args = parser.parse_args()
+    print(BlobStore(args.store).summary().to_string(index=False))
@@ -8,6 +8,7 @@ from queue import Queue
 import os
 import re
 import itertools
+import hashlib
 import json
 from numpy import True_
 import pandas as pd
@@ -15,16 +16,45 @@ import ast
 import subprocess
 import multiprocessing
 from collections import defaultdict
+from contextlib import nullcontext
+from functools import partial
+import time
+from datetime import datetime
 import sys
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 import src.util.utils as ut
+import src.util.child_usage as child_usage
+from src.util.admission import AdmissionController, load_size_estimates
+from src.util.work_queue import open_work_queue, run_leased_workers
+from src.util.profiler import ProfiledWorker, merge_profiles
+from src.util.runtime_model import RuntimeModel, balanced_chunks, log_eta
+from src.util.result_sink import CsvResultSink, JsonResultSink
+from src.util.corpus_archive import ProjectArchive
+from src.util.metrics import RunMetrics, fail, reporting, track
+from src.log_remove.project_sampler import ProjectSampler, filter_projects_by_lus
+from src.log_remove.logging_density import LoggingDensity
+from src.log_remove.virtual_project import VirtualProject
+from src.log_remove.logging_index import LoggingIndex, load_corpus
+from src.log_remove.blob_store import BlobStore
+from src.log_remove.lu_detector import merge_detected_lus
 
 logger = ut.setlogger(
     f_log='log/log_removal/log_removal.log',
     logger="log_remover",
 )
-lock = ut.setRWLock()
+
+# The LogRemover used by file shard workers; set before the pool is forked so it is not pickled per task
+_shard_remover = None
+
+
+def _remove_logging_shard(task):
+    d, files, function_names, stored_proj_logging_removal = task
+    # The usage of the children of a shard is sent back to the project
+    with child_usage.collect() as usage:
+        res = _shard_remover.remove_logging_files(d=d, files=files, function_names=function_names,
+                                                  stored_proj_logging_removal=stored_proj_logging_removal)
+    return res, usage
 
 
 class LogRemover:
@@ -36,16 +66,32 @@ class LogRemover:
                  sample_sizes=['small', 'medium', 'large', 'vlarge'],
                  is_remove_cleaned_project=False,
                  is_archive_cleaned_project=True,
-                 is_ignore_failed_clone_detections=True):
+                 is_ignore_failed_clone_detections=True,
+                 admission=None,
+                 work_queue=None,
+                 lease_ttl=600,
+                 profile_dir=None,
+                 shard_size_mb=None,
+                 shard_workers=None,
+                 in_memory=False,
+                 logging_index=None,
+                 shared_project_link='symlink',
+                 metrics=None,
+                 timeout=None,
+                 timeout_per_kloc=0,
+                 blob_store=None):
 
         self.f_removal = f_removal
         ut.create_folder_if_not_exist(os.path.dirname(f_removal))
         # f_removal records processed files and lines in JSON
-        if os.path.isfile(f_removal):
-            with open(f_removal) as r:
-                self.logging_remove_json = json.load(r)
-        else:
-            self.logging_remove_json = defaultdict(dict)
+        # Workers append to their own shards, which are merged into f_removal by compact()
+        self.removal_sink = JsonResultSink(f_removal)
+        self.logging_remove_json = self.removal_sink.read()
+        # Logging density counters collected while scanning, next to f_removal
+        self.density = LoggingDensity(os.path.dirname(f_removal))
+        # Wall time, CPU and peak RSS of the child processes of every project, per tool, next to f_removal
+        self.child_usage_sink = CsvResultSink(os.path.join(os.path.dirname(f_removal), 'child_usage.csv'),
+                                              key=['project_id', 'tool'])
 
         self.d_proj_size = 'result/proj_size'
         self.sample_sizes = sample_sizes
@@ -55,6 +101,35 @@ class LogRemover:
         self.is_remove_cleaned_project = is_remove_cleaned_project
         self.is_archive_cleaned_project = is_archive_cleaned_project
         self.is_ignore_failed_clone_detections = is_ignore_failed_clone_detections
+        # Disk/memory admission control shared by all workers, None to disable
+        self.admission = admission
+        # Shared work queue (path) to lease projects from, None to split projects into chunks
+        self.work_queue = work_queue
+        self.lease_ttl = lease_ttl
+        # Folder for profiles of all workers, None to disable profiling
+        self.profile_dir = profile_dir
+        # Projects with more java code (MB) than this are split into file shards processed by a pool, None to disable
+        self.shard_size_mb = shard_size_mb
+        self.shard_workers = shard_workers or ut.getWorkers()
+        # Read, clean and archive projects in memory instead of decompressing them to the temp folder
+        self.in_memory = in_memory
+        # LoggingIndex to look up the files with logging call sites, None to grep every project
+        self.logging_index = logging_index
+        if logging_index is not None:
+            # Projects missing from f_log_stats get the LUs detected from their imports
+            self.df_proj_lus = merge_detected_lus(self.df_proj_lus, logging_index.lus())
+        # How repeats reference the cleaned projects of the shared store: symlink or hardlink; None to clean
+        # a project again for every repeat that samples it
+        self.shared_project_link = shared_project_link
+        # RunMetrics updated by the workers and reported by the parent, None to disable
+        self.metrics = metrics
+        # Seconds allowed to the external tools of a project (plus timeout_per_kloc per KLOC), None for no limit
+        self.timeout = timeout
+        self.timeout_per_kloc = timeout_per_kloc
+        # BlobStore memoizing the formatting, scanning and edits of java files by content, None to disable
+        self.blob_store = blob_store
+        # Runtime model fitted from earlier runs, used to balance the chunks of workers; None if not fitted yet
+        self.runtime_model = RuntimeModel.load('log_remove')
         if is_ignore_failed_clone_detections:
             self.ignore_projects = self._get_ignored_projects()
         self.archive_dir = ut.getPath('CLEAN_REPO_ARCHIVE_ROOT')
@@ -77,6 +152,30 @@ class LogRemover:
         self.d_clean_project_root = os.path.join(ut.getPath('TEMP_PROJ_ROOT', ischeck=False), sample_dirname)
         ut.create_folder_if_not_exist(self.d_clean_project_root)
 
+    def _admit(self, row):
+        """
+        Reserve disk/memory budget for a project if admission control is enabled
+        """
+        if self.admission is None:
+            return nullcontext()
+        return self.admission.reserve(row)
+
+    def _timeout(self, row):
+        """
+        Seconds allowed to the external tools of a project, scaled with its size; None for no limit
+        """
+        return child_usage.scaled_timeout(row, self.timeout, self.timeout_per_kloc)
+
+    def _shards(self, row):
+        """
+        The number of file shards of a project, 1 for the per-project path
+        """
+        if self.shard_size_mb is None or self.shard_workers < 2:
+            return 1
+        if row['Bytes'] / 1024 / 1024 <= self.shard_size_mb:
+            return 1
+        return self.shard_workers
+
     def load_lu_per_project(self, f):
         """
         Load log_all_stats.csv and get the LUs used in each project
@@ -90,6 +189,10 @@ class LogRemover:
         -------
 
         """
+        if not os.path.isfile(f):
+            # LUs of all projects are then detected by the logging index
+            logger.warning('LU statistics %s not found' % f)
+            return pd.DataFrame(columns=['project_id', 'others'])
         df = ut.csv_loader(f)
         df['project_id'] = df['project'].apply(lambda x: int(x.split('-')[0]))
         keep_cols = ['project_id', 'others'] + [x for x in self.lu_levels.keys() if x in df.columns]
@@ -111,33 +214,6 @@ class LogRemover:
             lu_levels = json.load(r)
         return lu_levels
 
-    def filter_row(self, row):
-        """
-        Check if a row contain general logging utilities
-        If listed LU is not in recorded dataset as a separate column, will check it through the 'others' column
-        Parameters
-        ----------
-        row
-        cols
-
-        Returns
-        If is general LU, and the LU used
-        -------
-
-        """
-        general_lus = []
-        for x in self.lu_levels.keys():
-            if x in row.keys():
-                ig = row[x]
-            else:
-                if isinstance(row['others'], str):
-                    ig = (x in row['others'])
-                else:
-                    continue
-            if ig is True:
-                general_lus.append(x)
-        return len(general_lus) > 0, general_lus
-
     def filter_projects_by_lus(self, df):
         """
         Filter projects by selected logging utilities
@@ -147,17 +223,25 @@ class LogRemover:
         Returns
         -------
         """
-        df = pd.merge(df, self.df_proj_lus, on='project_id')
-        df[['is_general', 'general_lus']] = df.apply(func=self.filter_row, axis=1, result_type='expand')
-        return df[df['is_general'] == True]
+        return filter_projects_by_lus(df, self.df_proj_lus, self.lu_levels)
 
     def _get_ignored_projects(self):
         """
         Filter projects that cannot be parsed in NiCad
         """
         f_failed = 'result/clone_detection/clone_detection_check.csv'
-        df_failed = pd.read_csv(f_failed)
-        return list(df_failed.loc[df_failed['NiCadPassed']==False]['project_id'])
+        # Include shards of a run that has not been compacted yet
+        df_failed = CsvResultSink(f_failed, key=['project_id', 'granularity', 'clonetype']).read()
+        ignored = set()
+        if 'NiCadPassed' in df_failed.columns:
+            # A project is ignored if any of its NiCad configurations failed
+            ignored.update(df_failed.loc[df_failed['NiCadPassed']==False]['project_id'])
+        # Projects whose external tools timed out in clone detection or logging removal would time out again
+        for f_usage in ['result/clone_detection/child_usage.csv', self.child_usage_sink.f]:
+            df_usage = CsvResultSink(f_usage, key=['project_id', 'tool']).read()
+            if 'timeouts' in df_usage.columns:
+                ignored.update(df_usage.loc[df_usage['timeouts'] > 0, 'project_id'])
+        return list(ignored)
 
     def project_sample(self, sample_percentage=0.1, overwrite=False):
         """
@@ -195,23 +279,12 @@ class LogRemover:
                 df_projects = self.filter_projects_by_lus(df=df_projects)
                 df_projects.to_csv(f_projects_inner_clone, index=False) 
         else:
-            # If sample dir
-            for repeat in range(1, self.repeats + 1):
-                for size_type in self.sample_sizes:
-                    f_projects_sample = os.path.join(self.sample_dir, 'sample_{}_sloc_{}.csv'.format(repeat, size_type))
-                    if os.path.isfile(f_projects_sample):
-                        if overwrite:
-                            print('Overwrite existing project {}'.format(os.path.basename(f_projects_sample)))
-                        else:
-                            print('Sample projects already exist in {}; skip'.format(os.path.basename(f_projects_sample)))
-                            continue
-                    df_projects = ut.csv_loader(os.path.join(sloc_dir, 'filesize_sloc_{}.csv'.format(size_type)))
-                    if self.is_ignore_failed_clone_detections:
-                        df_projects = df_projects.loc[~df_projects['project_id'].isin(self.ignore_projects)]
-                    df_projects = self.filter_projects_by_lus(df=df_projects)
-                    df_projects_sample = df_projects.sample(frac=sample_percentage, random_state=repeat)
-                    df_projects_sample.to_csv(f_projects_sample, index=False)
-    
+            # Load and filter the population once, then draw all repeats together
+            sampler = ProjectSampler(lu_levels=self.lu_levels, df_proj_lus=self.df_proj_lus, sloc_dir=sloc_dir,
+                                     ignore_projects=self.ignore_projects if self.is_ignore_failed_clone_detections else None)
+            # logger_detector reads the per-file samples
+            sampler.run(sample_sizes=self.sample_sizes, sample_percentage=sample_percentage, repeats=self.repeats,
+                        sample_dir=self.sample_dir, export_legacy=True, overwrite=overwrite)
 
     def get_total_project_size(self, proj_id_list):
         """
@@ -277,21 +350,41 @@ class LogRemover:
         self.dump_remove_logging_result(logging_remove_json_new)
 
     def remove_logging_multiprocessing(self, df, repeat_idx):
+        func = partial(self.remove_logging_multithreading, repeat_idx=repeat_idx)
+        if self.profile_dir:
+            func = ProfiledWorker(func, self.profile_dir)
+        if self.work_queue:
+            # Every repeat has its own task list since a project can be sampled by several repeats
+            queue = open_work_queue(self.work_queue, namespace='repeat_%d' % repeat_idx, ttl=self.lease_ttl)
+            with reporting(self.metrics, df):
+                run_leased_workers(df=df, func=func, queue=queue)
+            return
         # Preserve for parallelism
         jobs = []
-        for d in ut.chunkify(df, ut.getWorkers()):
+        if self.runtime_model is not None:
+            log_eta(df, self.runtime_model, ut.getWorkers())
+            df_sps = balanced_chunks(df, self.runtime_model, ut.getWorkers())
+        else:
+            df_sps = ut.chunkify(df, ut.getWorkers())
+        for d in df_sps:
             jobs.append(
-                multiprocessing.Process(target=self.remove_logging_multithreading, args=(d, repeat_idx,))
+                multiprocessing.Process(target=func, args=(d,))
             )
-        [j.start() for j in jobs]
-        [j.join() for j in jobs]
+        with reporting(self.metrics, df):
+            [j.start() for j in jobs]
+            [j.join() for j in jobs]
 
     def remove_logging_multithreading(self, df, repeat_idx):
         q = Queue()
-        ts = [threading.Thread(target=self.find_and_remove_logging, args=(row, repeat_idx, q,)) for idx, row in
-              df.iterrows()]
+        # Sharded projects fork their own pool, which is done from the main thread once the threads are joined
+        is_sharded = [self._shards(row) > 1 for idx, row in df.iterrows()]
+        ts = [threading.Thread(target=self.find_and_remove_logging_tracked, args=(row, repeat_idx, q,)) for
+              (idx, row), sharded in zip(df.iterrows(), is_sharded) if not sharded]
         for t in ts: t.start()
         for t in ts: t.join()
+        for (idx, row), sharded in zip(df.iterrows(), is_sharded):
+            if sharded:
+                self.find_and_remove_logging_tracked(row, repeat_idx, q)
 
         log_remove_lst = []
         while not q.empty():
@@ -315,33 +408,90 @@ class LogRemover:
         """
         # Skip writing or updating if new_json object is empty
         if not any(new_json): return
+        self.removal_sink.write(new_json)
 
-        # Save Json
-        with lock:
-            if os.path.isfile(self.f_removal):
-                with open(self.f_removal, 'r+') as f_update:
-                    js = json.load(f_update)
-                    for k, v in new_json.items():
-                        # Update if project exists
-                        js[k] = v
-                    f_update.seek(0)
-                    f_update.write(json.dumps(js, indent=4))
-                    f_update.truncate()
-            else:
-                with open(self.f_removal, 'w') as f_update:
-                    f_update.write(json.dumps(new_json, indent=4))
+    def find_and_remove_logging_tracked(self, row, repeat_idx=None, q=None):
+        """
+        find_and_remove_logging, counted in the progress metrics
+        """
+        with track(self.metrics, row):
+            return self.find_and_remove_logging(row=row, repeat_idx=repeat_idx, q=q)
 
-    def find_and_remove_logging(self, row, repeat_idx=None, q=None):
+    def _shared_project_dir(self, row):
+        """
+        The folder of a cleaned project in the shared store, keyed by project and by the level functions removed
+        """
+        general_lus = ast.literal_eval(row['general_lus'])
+        function_names = sorted(set(itertools.chain.from_iterable([self.lu_levels[lu] for lu in general_lus])))
+        config = hashlib.sha1(','.join(function_names).encode()).hexdigest()[:10]
+        return os.path.abspath(os.path.join(self.d_clean_project_root, 'shared', config, str(int(row['project_id']))))
+
+    def _link_shared_project(self, shared_dir, repeat_dir):
+        """
+        Make the cleaned project of the shared store show up in the folder of a repeat
+        """
+        if os.path.islink(repeat_dir):
+            os.unlink(repeat_dir)
+        elif os.path.isdir(repeat_dir):
+            shutil.rmtree(repeat_dir)
+        ut.create_folder_if_not_exist(os.path.dirname(repeat_dir))
+        if self.shared_project_link == 'hardlink':
+            shutil.copytree(shared_dir, repeat_dir, copy_function=os.link)
+        else:
+            os.symlink(shared_dir, repeat_dir, target_is_directory=True)
+
+    def find_and_remove_logging_shared(self, row, repeat_idx, q=None):
+        """
+        find_and_remove_logging for a repeat, through the shared store: a project sampled by several repeats is
+        cleaned once and linked into the folder of every repeat
+        """
+        shared_dir = self._shared_project_dir(row)
+        repeat_dir = os.path.abspath(os.path.join(
+            *[self.d_clean_project_root, 'repeat_%d' % repeat_idx, str(int(row['project_id']))]))
+        f_done = shared_dir + '.done'
+        res = None
+        if os.path.isfile(f_done) and os.path.isdir(shared_dir):
+            with ut.log_context(project_id=row['project_id']):
+                logger.info('Project %s has been cleaned for an earlier repeat; link it' % row['owner_repo'])
+        else:
+            if os.path.isdir(shared_dir):
+                # Left by a failed cleaning; reexamine the project
+                shutil.rmtree(shared_dir)
+            res, is_cleaned = self._find_and_remove_logging(row=row, q=q, out_dir=shared_dir)
+            if not is_cleaned:
+                if os.path.isdir(shared_dir):
+                    shutil.rmtree(shared_dir)
+                return res
+            if not os.path.isdir(shared_dir):
+                return res
+            open(f_done, 'w').close()
+        self._link_shared_project(shared_dir, repeat_dir)
+        return res
+
+    def find_and_remove_logging(self, row, repeat_idx=None, q=None, out_dir=None):
         """
         Decompress selected java projects and remove logging statements from them
         Parameters
         ----------
         row: dataframe row, records the information of a project
         repeat_idx: The repeat index of current experiment
+        out_dir: The folder to clean the project into, default to the folder of the repeat
 
         Returns
         -------
 
+        """
+        if repeat_idx and out_dir is None and self.shared_project_link and not self.is_remove_cleaned_project:
+            return self.find_and_remove_logging_shared(row=row, repeat_idx=repeat_idx, q=q)
+        return self._find_and_remove_logging(row=row, repeat_idx=repeat_idx, q=q, out_dir=out_dir)[0]
+
+    def _find_and_remove_logging(self, row, repeat_idx=None, q=None, out_dir=None):
+        """
+        find_and_remove_logging, with its status
+        Returns
+        -------
+        (result, is_cleaned): the result of find_and_remove_logging, and False if the project was not cleaned
+            completely (missing, failed or timed out)
         """
         repo_path = row['repo_path']
         repo_id = int(row['project_id'])
@@ -350,7 +500,9 @@ class LogRemover:
         # The previously removed logging recorded for this project
         stored_proj_logging_removal = None
 
-        if repeat_idx:
+        if out_dir is not None:
+            tmp_out_dir = out_dir
+        elif repeat_idx:
             # Temp location to store project
             tmp_out_dir = os.path.abspath(os.path.join(
                 *[self.d_clean_project_root, 'repeat_%d' % repeat_idx, str(repo_id)]
@@ -365,17 +517,17 @@ class LogRemover:
         if str(repo_id) in self.logging_remove_json.keys():
             # Skip remove logging if this project has already been log removed
             if os.path.isdir(tmp_out_dir):
-                print('Project %s has already been log removed; skip' % owner_repo)
-                return
+                logger.info('Project %s has already been log removed; skip' % owner_repo)
+                return None, True
             # If cleaned project not in temp, but in archived location
             else:
                 if os.path.isfile(archived_f):
                     # Decompress previously cleaned project from archived file
                     # The project has java only so no need to remove non-java files
-                    print('Cleaned project %s found. Decompressing previously archived project' % owner_repo)
+                    logger.info('Cleaned project %s found. Decompressing previously archived project' % owner_repo)
                     self.decompress_project(f_tar=archived_f, out_d=os.path.dirname(tmp_out_dir),
                                             clean_project=False, keep_java_only=False)
-                    return
+                    return None, True
                 else:
                     # If archived file does not exist, while logging removal info is on file
                     # This happens when we move to a new machine
@@ -391,65 +543,286 @@ class LogRemover:
 
         if not os.path.isfile(repo_path):
             logger.error('Cannot find project %s at %s' % (owner_repo, repo_path))
-            return
-        print('Start decompression and logging removal from %s' % owner_repo)
-        # Decompress
-        self.decompress_project(f_tar=repo_path, out_d=tmp_out_dir, keep_java_only=True)
-
-        general_lus = ast.literal_eval(row['general_lus'])
-        function_names = set(itertools.chain.from_iterable([self.lu_levels[lu] for lu in general_lus]))
-
-        try:
-            proj_logging_removal = self.logging_remover_cu_line(d=tmp_out_dir,
-                                                                function_names=function_names,
-                                                                stored_proj_logging_removal=stored_proj_logging_removal)
-        except Exception:
-            logger.warning("Fail to remove logging in project %s. Either no logging or command failed." % owner_repo)
-            proj_logging_removal = None
-
-        # If remove cleaned project from temp folder
-        if self.is_remove_cleaned_project:
-            shutil.rmtree(tmp_out_dir)
+            fail(self.metrics)
+            return None, False
+        with self._admit(row), ut.log_context(project_id=repo_id), child_usage.collect() as usage, \
+                child_usage.deadline(self._timeout(row)):
+            start = time.time()
+            general_lus = ast.literal_eval(row['general_lus'])
+            function_names = set(itertools.chain.from_iterable([self.lu_levels[lu] for lu in general_lus]))
+            candidate_files = None
+            if self.logging_index is not None and self.logging_index.is_current(repo_id, repo_path):
+                candidate_files = self.logging_index.files(repo_id, function_names)
+            # A partially cleaned project (timed out) is neither kept nor archived
+            timed_out = False
+            is_failed = False
+
+            if self.in_memory:
+                logger.info('Start logging removal from %s in memory' % owner_repo)
+                vproj = VirtualProject.from_archive(repo_path, keep_java_only=True)
+                try:
+                    proj_logging_removal = self.logging_remover_virtual(vproj=vproj,
+                                                                        function_names=function_names,
+                                                                        stored_proj_logging_removal=stored_proj_logging_removal,
+                                                                        candidate_files=candidate_files)
+                except child_usage.ChildTimeout:
+                    logger.error('Logging removal timed out after %.0fs in project %s'
+                                 % (self._timeout(row), owner_repo))
+                    fail(self.metrics)
+                    timed_out, proj_logging_removal = True, None
+                except Exception:
+                    logger.warning("Fail to remove logging in project %s. Either no logging or command failed." % owner_repo)
+                    fail(self.metrics)
+                    is_failed, proj_logging_removal = True, None
+                self.density.record(repo_id, proj_logging_removal, {lu: self.lu_levels[lu] for lu in general_lus})
+
+                # The tree is written to the temp folder only if it is kept there
+                if not self.is_remove_cleaned_project and not timed_out:
+                    vproj.materialize(tmp_out_dir)
+                if self.is_archive_cleaned_project and not timed_out:
+                    vproj.write_archive(archived_f, arcname=os.path.basename(tmp_out_dir))
+            else:
+                logger.info('Start decompression and logging removal from %s' % owner_repo)
+                # Decompress
+                self.decompress_project(f_tar=repo_path, out_d=tmp_out_dir, keep_java_only=True)
 
-        # If save cleaned project into a separate location
-        if self.is_archive_cleaned_project:
-            with tarfile.open(archived_f, 'w:gz') as tar:
-                tar.add(tmp_out_dir, arcname=os.path.basename(tmp_out_dir))
+                try:
+                    proj_logging_removal = self.logging_remover_cu_line(d=tmp_out_dir,
+                                                                        function_names=function_names,
+                                                                        stored_proj_logging_removal=stored_proj_logging_removal,
+                                                                        shards=self._shards(row),
+                                                                        candidate_files=candidate_files)
+                except child_usage.ChildTimeout:
+                    logger.error('Logging removal timed out after %.0fs in project %s'
+                                 % (self._timeout(row), owner_repo))
+                    fail(self.metrics)
+                    timed_out, proj_logging_removal = True, None
+                except Exception:
+                    logger.warning("Fail to remove logging in project %s. Either no logging or command failed." % owner_repo)
+                    fail(self.metrics)
+                    is_failed, proj_logging_removal = True, None
+                self.density.record(repo_id, proj_logging_removal, {lu: self.lu_levels[lu] for lu in general_lus})
+
+                # If save cleaned project into a separate location
+                if self.is_archive_cleaned_project and not timed_out:
+                    with tarfile.open(archived_f, 'w:gz') as tar:
+                        tar.add(tmp_out_dir, arcname=os.path.basename(tmp_out_dir))
+
+                # If remove cleaned project from temp folder
+                if self.is_remove_cleaned_project or timed_out:
+                    shutil.rmtree(tmp_out_dir)
+            logger.info('Logging removal finished in %.1fs. Project %s' % (time.time() - start, owner_repo))
+        self.child_usage_sink.write(child_usage.usage_by_tool(usage, project_id=repo_id))
 
         if proj_logging_removal:
             if q is not None:
                 q.put([repo_id, proj_logging_removal])
             # Record result in json
-            return (repo_id, proj_logging_removal)
+            return (repo_id, proj_logging_removal), not (timed_out or is_failed)
         else:
-            return None
+            return None, not (timed_out or is_failed)
 
-    def logging_remover_cu_line(self, d, function_names, stored_proj_logging_removal=None):
+    def logging_remover_cu_line(self, d, function_names, stored_proj_logging_removal=None, shards=1,
+                                candidate_files=None):
         """
         Convert java files with keyword "log" to Compilation Unit then perform single line grep
         Parameters
         ----------
         d: The project directory
         function_names: The function names of log level
+        shards: The number of file shards processed in parallel, 1 to process the project in this process
+        candidate_files: The files with logging call sites from the logging index, None to grep the project
 
         Returns
         -------
 
         """
         self.rename_files(d=d)
-        log_related_files = self.get_files_with_keyword(keyword='log', d=d, function_names=function_names)
+        if candidate_files is not None and not all(os.path.isfile(os.path.join(d, f)) for f in candidate_files):
+            # Renamed files are not in the index
+            candidate_files = None
+        if candidate_files is not None:
+            log_related_files = candidate_files
+        else:
+            log_related_files = self.get_files_with_keyword(keyword='log', d=d, function_names=function_names)
+        if shards > 1:
+            return self.logging_remover_sharded(d=d, files=log_related_files, function_names=function_names,
+                                                stored_proj_logging_removal=stored_proj_logging_removal,
+                                                shards=shards)
+        if self.blob_store is not None and not stored_proj_logging_removal:
+            return self.remove_logging_blobs(d=d, files=log_related_files, function_names=function_names)
         self.format_java(d=d, files=log_related_files)
 
         if stored_proj_logging_removal:
             proj_logging_removal = stored_proj_logging_removal
         else:
             # If logging removal for this project is not recorded
-            proj_logging_removal = self.single_line_grep_logging(function_names=function_names, d=d)
+            proj_logging_removal = self.single_line_grep_logging(function_names=function_names, d=d,
+                                                                 files=candidate_files)
         del stored_proj_logging_removal
         if proj_logging_removal:
             self.remove_logging_by_linenum(dict_removal=proj_logging_removal, d=d, function_names=function_names)
         return proj_logging_removal
 
+    def logging_remover_virtual(self, vproj, function_names, stored_proj_logging_removal=None, candidate_files=None):
+        """
+        logging_remover_cu_line on an in-memory project
+        Parameters
+        ----------
+        vproj: The VirtualProject read from the compressed project
+        function_names: The function names of log level
+        stored_proj_logging_removal: The previously recorded logging removal of this project
+        candidate_files: The files with logging call sites from the logging index, None to search the project
+
+        Returns
+        -------
+        proj_logging_removal: f_path -> line number -> {line, linetype}
+        """
+        vproj.rename_files()
+        if candidate_files is not None and not all(f in vproj.files for f in candidate_files):
+            # Renamed files are not in the index
+            candidate_files = None
+        if candidate_files is not None:
+            log_related_files = candidate_files
+        else:
+            log_related_files = vproj.get_files_with_keyword(keyword='log', function_names=function_names)
+        if self.blob_store is not None and not stored_proj_logging_removal:
+            return self.logging_remover_virtual_blobs(vproj, files=log_related_files, function_names=function_names)
+        vproj.format_java(files=log_related_files)
+
+        if stored_proj_logging_removal:
+            proj_logging_removal = stored_proj_logging_removal
+        else:
+            proj_logging_removal = vproj.grep_logging(function_names=function_names,
+                                                      check_logging_type=self.check_logging_type,
+                                                      files=candidate_files)
+        if proj_logging_removal:
+            for f in vproj.remove_logging(dict_removal=proj_logging_removal, function_names=function_names):
+                # In case some error caused by renaming
+                logger.error('Did not find recorded filepath from project: %s' % f)
+        return proj_logging_removal
+
+    def logging_remover_virtual_blobs(self, vproj, files, function_names):
+        """
+        logging_remover_virtual through the blob store: files already seen in the corpus are not formatted,
+        scanned or edited again
+        """
+        def read(names):
+            return {f: vproj.files[f].data for f in names}
+
+        def write(contents):
+            for f, data in contents.items():
+                vproj.files[f].data = data
+                vproj.files[f].encoding = None
+
+        def format_java(names):
+            vproj.format_java(files=names)
+            return read(names)
+
+        def scan(names):
+            return vproj.grep_logging(function_names=function_names, check_logging_type=self.check_logging_type,
+                                      files=names)
+
+        def edit(removal):
+            vproj.remove_logging(dict_removal=removal, function_names=function_names)
+            return read(removal)
+        return self.blob_store.remove_logging(read(files), function_names, format_java, scan, edit, write)
+
+    def remove_logging_blobs(self, d, files, function_names):
+        """
+        Format, grep and remove logging of the given files of a project through the blob store
+        Returns
+        -------
+        dict: f_path -> line number -> {line, linetype}
+        """
+        files = [os.path.normpath(f) for f in files]
+
+        def read(names):
+            contents = {}
+            for f in names:
+                with open(os.path.join(d, f), 'rb') as r:
+                    contents[f] = r.read()
+            return contents
+
+        def write(contents):
+            for f, data in contents.items():
+                with open(os.path.join(d, f), 'wb') as w:
+                    w.write(data)
+
+        def format_java(names):
+            self.format_java(d=d, files=names)
+            return read(names)
+
+        def scan(names):
+            proj_logging_removal = self.single_line_grep_logging(function_names=function_names, d=d, files=names)
+            if proj_logging_removal is None:
+                # A failed grep must not be memoized as files without logging
+                raise RuntimeError('Fail to grep logging of %s' % d)
+            return proj_logging_removal
+
+        def edit(removal):
+            self.remove_logging_by_linenum(dict_removal=removal, d=d, function_names=function_names)
+            return read(removal)
+        return self.blob_store.remove_logging(read(files), function_names, format_java, scan, edit, write)
+
+    def logging_remover_sharded(self, d, files, function_names, stored_proj_logging_removal=None, shards=2):
+        """
+        Format, grep and remove logging of a large project with a pool, one task per file shard
+        Parameters
+        ----------
+        d: The project directory
+        files: The log related files of the project
+        function_names: The function names of log level
+        stored_proj_logging_removal: The previously recorded logging removal of this project
+        shards: The number of file shards, which is also the size of the pool
+
+        Returns
+        -------
+        proj_logging_removal: The logging removal of all shards merged, as single_line_grep_logging returns
+        """
+        global _shard_remover
+        # Paths as recorded by single_line_grep_logging, without the leading ./ of get_files_with_keyword
+        files = [os.path.normpath(f) for f in files]
+        # Balance shards by file size: the largest files are dealt out first
+        files = sorted(files, key=lambda f: os.path.getsize(os.path.join(d, f)), reverse=True)
+        file_shards = [files[i::shards] for i in range(shards) if files[i::shards]]
+        tasks = []
+        for file_shard in file_shards:
+            stored = None
+            if stored_proj_logging_removal:
+                stored = {f: stored_proj_logging_removal[f] for f in file_shard if f in stored_proj_logging_removal}
+            tasks.append((d, file_shard, function_names, stored))
+        logger.info('Process %d log related files in %d shards' % (len(files), len(file_shards)))
+
+        _shard_remover = self
+        with multiprocessing.Pool(processes=len(file_shards)) as pool:
+            results = pool.map(_remove_logging_shard, tasks, chunksize=1)
+
+        proj_logging_removal = defaultdict(lambda: defaultdict(dict))
+        for res, usage in results:
+            child_usage.record(usage)
+            if res: proj_logging_removal.update(res)
+        return proj_logging_removal
+
+    def remove_logging_files(self, d, files, function_names, stored_proj_logging_removal=None):
+        """
+        Format, grep and remove logging of the given files of a project
+        Returns
+        -------
+        dict: f_path -> line number -> {line, linetype}, plain dicts so that it can be sent back from a pool
+        """
+        if self.blob_store is not None and not stored_proj_logging_removal:
+            return self.remove_logging_blobs(d=d, files=files, function_names=function_names) or None
+        self.format_java(d=d, files=files)
+        if stored_proj_logging_removal:
+            proj_logging_removal = stored_proj_logging_removal
+        else:
+            proj_logging_removal = self.single_line_grep_logging(function_names=function_names, d=d, files=files)
+        if proj_logging_removal:
+            self.remove_logging_by_linenum(dict_removal=proj_logging_removal, d=d, function_names=function_names)
+            return {f: dict(lines) for f, lines in proj_logging_removal.items()}
+        return None
+
     def rename_files(self, d):
         """
         Certain file path contain special chars which may cause error when reading
@@ -465,7 +838,7 @@ class LogRemover:
         """
         # Rename all files with special characters
         cmd_rename = r"find . -name '*.java' -exec rename 's/[?<>\$\\:*|\"]/_/g' {} \;"
-        subprocess.Popen(cmd_rename, shell=True, cwd=d).wait()
+        child_usage.run(cmd_rename, tool='find', shell=True, cwd=d)
 
     def check_lambda(self, line):
         """
@@ -540,15 +913,13 @@ class LogRemover:
                     if filename.endswith('.java'):
                         cmd = 'java -jar {f_jf} "{f_java}"'.format(f_jf=f_javaformatter,
                                                                    f_java=os.path.join(root, filename))
-                        p = subprocess.Popen(cmd, shell=True)
-                        p.wait()
+                        child_usage.run(cmd, tool='java', shell=True)
         else:
             for filename in files:
                 if filename.endswith('.java'):
                     cmd = 'java -jar {f_jf} "{f_java}"'.format(f_jf=f_javaformatter,
                                                                f_java=os.path.join(d, filename))
-                    p = subprocess.Popen(cmd, shell=True)
-                    p.wait()
+                    child_usage.run(cmd, tool='java', shell=True)
 
     def get_files_with_keyword(self, keyword, d, function_names):
         """
@@ -564,19 +935,21 @@ class LogRemover:
         try:
             cmd = """grep -ril "%s" --include="*.java" . | xargs grep -ilE "%s" """ % (
                 keyword, ('|'.join(function_names)))
-            out_raw = subprocess.check_output(cmd, shell=True, cwd=d)
+            out_raw = child_usage.check_output(cmd, tool='grep', shell=True, cwd=d)
+        except child_usage.ChildTimeout:
+            raise
         except Exception:
             logger.warning('Grepping command <-- %s -->failed at %s' % (cmd, d))
             # Redo grepping (not using recursion since we are uncertain if the unknown errors will cause an infinite loop)
             cmd = 'grep -ril "%s" --include="*.java"' % keyword
-            out_raw = subprocess.check_output(cmd, shell=True, cwd=d)
+            out_raw = child_usage.check_output(cmd, tool='grep', shell=True, cwd=d)
         try:
             out = out_raw.decode('utf-8')
         except UnicodeError:
             out = out_raw.decode('iso-8859-1')
         return [x for x in out.split('\n') if x != '']
 
-    def single_line_grep_logging(self, function_names, d):
+    def single_line_grep_logging(self, function_names, d, files=None):
         """
         Grep logging statements of single-lined logging
         Cannot handle logging statements that are across multiple lines (unless reformatted)
@@ -584,19 +957,33 @@ class LogRemover:
         ----------
         function_names: logging levels function names regarding to the LU used in this project
         d: The directory of the project
+        files: Only grep these files (relative to d), None to grep the whole project
 
         Returns
         -------
         """
         proj_logging_removal = defaultdict(lambda: defaultdict(dict))
 
-        cmd = 'grep -rinE "(.*log.*)\.({funcs})\(.*\)" --include=\*.java .'.format(
-            funcs='|'.join(function_names))
-        try:
-            out_raw = subprocess.check_output(cmd, shell=True, cwd=d)
-        except subprocess.CalledProcessError:
-            logger.warning('Fail to execute command %s at %s' % (cmd, d))
-            return None
+        if files is None:
+            cmd = 'grep -rinE "(.*log.*)\.({funcs})\(.*\)" --include=\*.java .'.format(
+                funcs='|'.join(function_names))
+            try:
+                out_raw = child_usage.check_output(cmd, tool='grep', shell=True, cwd=d)
+            except subprocess.CalledProcessError:
+                logger.warning('Fail to execute command %s at %s' % (cmd, d))
+                return None
+        else:
+            if not files:
+                return None
+            # File names are passed through stdin since a shard may exceed the limit of command line arguments
+            cmd = 'xargs -0 grep -HinE "(.*log.*)\.({funcs})\(.*\)" --'.format(funcs='|'.join(function_names))
+            p = child_usage.run(cmd, tool='grep', shell=True, cwd=d,
+                                input='\0'.join('./' + f for f in files).encode(), stdout=subprocess.PIPE)
+            # xargs exits with 123 if grep finds nothing in some of the files
+            if p.returncode not in (0, 123):
+                logger.warning('Fail to execute command %s at %s' % (cmd, d))
+                return None
+            out_raw = p.stdout
         try:
             out = out_raw.decode('utf-8')
         except UnicodeError:
@@ -702,12 +1089,12 @@ class LogRemover:
                 # Cannot write to original file directly since > has a higher priority
                 cmd = "awk '%s {gsub(/.*/,\"\")}; {print}' %s > %s_lrm_temp && mv %s_lrm_temp %s" % \
                       (' || '.join(['NR == %d' % x for x in lst_replace_line]), f, f, f, f)
-                p = subprocess.Popen(cmd, shell=True)
-
                 try:
-                    p.communicate()
+                    child_usage.run(cmd, tool='awk', shell=True)
+                except child_usage.ChildTimeout:
+                    raise
                 except Exception as ex:
-                    logger.error('Fail to remove log for {f}; {ex}'.format(f, str(ex)))
+                    logger.error('Fail to remove log for {f}; {ex}'.format(f=f, ex=str(ex)))
 
             if len(lst_replace_logging) > 0:
                 # Find logging statements and remove them
@@ -726,7 +1113,8 @@ class LogRemover:
                                 file=f_path, line_num=line_id, line=line_content, e=e))
                     # Rewrite file
                     fw.seek(0)
-                    fw.write('\n'.join(f_lines))
+                    # readlines keeps the line endings
+                    fw.write(''.join(f_lines))
                     fw.truncate()
 
     def decompress_project(self, f_tar, out_d, clean_project=True, keep_java_only=True):
@@ -746,18 +1134,45 @@ class LogRemover:
             if os.path.isdir(out_d):
                 shutil.rmtree(out_d)
 
-        # Decompress tar to temp folder
-        tar = tarfile.open(f_tar, "r:gz")
-        tar.extractall(path=out_d)
-        tar.close()
-
-        # If only keep java files
-        if keep_java_only:
-            subprocess.Popen("find . -type f ! -name '*.java' -delete", shell=True, cwd=out_d).wait()
+        # Decompress tar (or its repacked zip) to temp folder, only java files if keep_java_only
+        with ProjectArchive.open(f_tar, java_only=keep_java_only) as archive:
+            archive.extract(out_d, suffix='.java' if keep_java_only else None)
 
 
 if __name__ == '__main__':
+    args, _ = ut.parse_args_log_remover()
     f_removal = 'result/log_remove/logging_removal_lines.json'
-    logremover = LogRemover(f_removal=f_removal, sample_percentage=0.1)
+    admission = None
+    if args.admission_control:
+        # Created before any worker is forked so that all workers share the reservations
+        admission = AdmissionController(d_tmp=ut.getPath('TEMP_PROJ_ROOT'),
+                                        size_mb=load_size_estimates(['small', 'medium', 'large', 'vlarge']),
+                                        disk_headroom_mb=args.disk_headroom_gb * 1024,
+                                        mem_headroom_mb=args.mem_headroom_gb * 1024)
+    profile_dir = None
+    if args.profile:
+        profile_dir = os.path.join('log/profile', 'log_remover_' + datetime.now().strftime('%Y%m%d_%H%M%S'))
+    logging_index = None
+    if args.logging_index:
+        # Only projects whose archive changed since the last run are indexed again
+        logging_index = LoggingIndex(args.logging_index)
+        indexed, failed = logging_index.update(load_corpus(['small', 'medium', 'large', 'vlarge']))
+        logger.info('Logging index: %d projects indexed, %d failed' % (indexed, failed))
+    logremover = LogRemover(f_removal=f_removal, sample_percentage=0.1, admission=admission,
+                            work_queue=args.work_queue, lease_ttl=args.lease_ttl, profile_dir=profile_dir,
+                            shard_size_mb=args.shard_size_mb, shard_workers=args.shard_workers,
+                            in_memory=args.in_memory, logging_index=logging_index,
+                            shared_project_link=None if args.shared_project_link == 'none' else args.shared_project_link,
+                            metrics=RunMetrics('log_remove', interval=args.metrics_interval, progress=args.progress),
+                            timeout=args.timeout, timeout_per_kloc=args.timeout_per_kloc,
+                            blob_store=BlobStore(args.blob_store) if args.blob_store else None)
     for repeat_idx in range(1, 1 + logremover.repeats):
         logremover.logger_detector(repeat_idx)
+    # Merge the results of all workers
+    logremover.removal_sink.compact()
+    logremover.child_usage_sink.compact()
+    logremover.density.build_table()
+    if logremover.blob_store is not None:
+        logger.info('Blob store hit rates:\n%s' % logremover.blob_store.summary().to_string(index=False))
+    if profile_dir:
+        logger.info('Profile report (%s):\n%s' % (profile_dir, merge_profiles(profile_dir)))
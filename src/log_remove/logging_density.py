@@ -0,0 +1,104 @@
+"""
+Logging density counters collected during the logging removal scan
+The lines found by single_line_grep_logging are counted per file by level function, LU and linetype right away,
+so that density analytics need no second read of the corpus:
+    result/log_remove/logging_density_files.csv        per file counters (sharded by worker while running)
+    result/log_remove/logging_density.parquet          per project counters joined with the SLOC catalog
+                                                       (logging_density.csv if no parquet engine is installed)
+"""
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import pandas as pd
+import src.util.utils as ut
+from src.util.result_sink import CsvResultSink
+
+COUNTER_KEYS = ['project_id', 'file', 'lu', 'level', 'linetype']
+
+
+class LoggingDensity:
+    def __init__(self, d_out='result/log_remove'):
+        """
+        Parameters
+        ----------
+        d_out: The folder of the density tables
+        """
+        self.d_out = d_out
+        self.sink = CsvResultSink(os.path.join(d_out, 'logging_density_files.csv'), key=COUNTER_KEYS)
+
+    def count(self, project_id, proj_logging_removal, lu_levels):
+        """
+        Count the logging lines of a project
+        Parameters
+        ----------
+        project_id: The project id
+        proj_logging_removal: file -> line number -> {line, linetype}, as found by single_line_grep_logging
+        lu_levels: The LUs used in this project and their level functions
+
+        Returns
+        -------
+        df: One row per (file, lu, level, linetype) with column statements
+        """
+        level_lus = {}
+        for lu, levels in lu_levels.items():
+            for level in levels:
+                level_lus.setdefault(level.lower(), []).append(lu)
+        # The grep is case insensitive, so is the level
+        re_level = re.compile(r'\.(%s)\(' % '|'.join(map(re.escape, sorted(level_lus, key=len, reverse=True))), re.I) \
+            if level_lus else None
+
+        counters = {}
+        for f_path, lines in proj_logging_removal.items():
+            for line_info in lines.values():
+                m = re_level.search(line_info['line']) if re_level else None
+                level = m.group(1).lower() if m else 'unknown'
+                # A level function shared by several LUs of the project (e.g. info) is counted once for all of them
+                lu = '|'.join(sorted(level_lus.get(level, ['unknown'])))
+                key = (int(project_id), f_path, lu, level, line_info['linetype'] or 'none')
+                counters[key] = counters.get(key, 0) + 1
+        df = pd.DataFrame([k + (v,) for k, v in counters.items()], columns=COUNTER_KEYS + ['statements'])
+        return df
+
+    def record(self, project_id, proj_logging_removal, lu_levels):
+        """
+        Count the logging lines of a project and append them to the shard of the current worker
+        """
+        if not proj_logging_removal: return
+        self.sink.write(self.count(project_id, proj_logging_removal, lu_levels))
+
+    def build_table(self, sloc_dir='result/proj_sloc', size_types=('small', 'medium', 'large', 'vlarge')):
+        """
+        Merge the shards and write the per project table joined with the SLOC catalog
+        Parameters
+        ----------
+        sloc_dir: The directory of filesize_sloc_<size>.csv
+        size_types: The size levels of the SLOC catalog
+
+        Returns
+        -------
+        df: One row per (project, lu, level, linetype)
+        """
+        self.sink.compact()
+        # Shards of other nodes of a multi-node run are not compacted yet, but belong in the table
+        df_files = self.sink.read()
+        if df_files.empty:
+            return df_files
+        df = df_files.groupby(['project_id', 'lu', 'level', 'linetype'], as_index=False).agg(
+            statements=('statements', 'sum'), files=('file', 'nunique'))
+
+        dfs_sloc = [ut.csv_loader(os.path.join(sloc_dir, 'filesize_sloc_{}.csv'.format(s))) for s in size_types
+                    if os.path.isfile(os.path.join(sloc_dir, 'filesize_sloc_{}.csv'.format(s)))]
+        if dfs_sloc:
+            df_sloc = pd.concat(dfs_sloc, ignore_index=True).drop_duplicates('project_id', keep='last')
+            df = df.merge(df_sloc[['project_id', 'owner_repo', 'size', 'Code', 'Count']], on='project_id', how='left')
+            df['statements_per_kloc'] = df['statements'] / df['Code'] * 1000
+
+        f_out = os.path.join(self.d_out, 'logging_density')
+        try:
+            df.to_parquet(f_out + '.parquet', index=False)
+        except ImportError:
+            # No parquet engine (pyarrow/fastparquet) installed
+            df.to_csv(f_out + '.csv', index=False)
+        return df
@@ -0,0 +1,273 @@
+"""
+Corpus-wide inverted index of logging call sites
+Every call of an LU level function on a logger-like receiver is recorded once per project:
+    (level, receiver) -> project -> file -> line
+so that logging removal and analytics look up candidate files instead of grepping every project for "log".
+The index is a SQLite file built in a parallel pass over the corpus, and updated incrementally:
+only projects whose archive changed (mtime/size) since they were indexed are read again.
+The same read detects the LUs of every project from its imports (see lu_detector.py).
+    python src/log_remove/logging_index.py build [-l small,medium,large,vlarge]
+    python src/log_remove/logging_index.py summary
+"""
+import os
+import re
+import sys
+import json
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+import multiprocessing
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import pandas as pd
+import src.util.utils as ut
+from src.util.corpus_archive import ProjectArchive, find_repacked
+from src.log_remove.lu_detector import LU_PATTERNS, LuDetector, to_lu_columns
+
+logger = logging.getLogger(__name__)
+
+# The receiver token before .level(: an identifier, or the last character of an expression, e.g. ) of getLogger(..)
+_RECEIVER = re.compile(r'([\w$]+|\S)\s*$')
+# Logging statements may span lines; the statement starts after the last of these characters
+_STATEMENT_BOUNDARY = re.compile(r'[;{}]')
+
+
+def load_levels(f='conf/lu_levels.json'):
+    """
+    All level functions of all LUs, lower case (grep of logging removal is case insensitive)
+    """
+    with open(f) as r:
+        lu_levels = json.load(r)
+    return sorted({x.lower() for levels in lu_levels.values() for x in levels})
+
+
+def find_call_sites(text, re_levels):
+    """
+    Find the logging call sites of a java source
+    Parameters
+    ----------
+    text: The source code
+    re_levels: Compiled pattern of .<level>( with the level as group 1
+
+    Returns
+    -------
+    list: (level, receiver, line) of calls whose statement mentions "log" before the call
+    """
+    sites = []
+    line, pos = 1, 0
+    for m in re_levels.finditer(text):
+        line += text.count('\n', pos, m.start())
+        pos = m.start()
+        prefix = text[max(0, m.start() - 512):m.start()]
+        boundaries = list(_STATEMENT_BOUNDARY.finditer(prefix))
+        statement = prefix[boundaries[-1].end():] if boundaries else prefix
+        if 'log' not in statement.lower():
+            continue
+        receiver = _RECEIVER.search(statement)
+        sites.append((m.group(1).lower(), receiver.group(1) if receiver else '', line))
+    return sites
+
+
+def _archive_state(repo_path):
+    # The archive actually read (the repacked zip if any) decides whether a project has to be indexed again
+    f = find_repacked(repo_path, java_only=True) or repo_path
+    st = os.stat(f)
+    return f, st.st_mtime, st.st_size
+
+
+def _index_project(task):
+    project_id, repo_path, levels = task
+    try:
+        f, mtime, size = _archive_state(repo_path)
+        re_levels = re.compile(r'\.\s*(%s)\s*\(' % '|'.join(map(re.escape, levels)), re.I)
+        detector = LuDetector()
+        postings = []
+        lus = Counter()
+        with ProjectArchive.open(repo_path, java_only=True) as archive:
+            for name, data in archive.members(suffix='.java'):
+                try:
+                    text = data.decode('utf-8')
+                except UnicodeError:
+                    text = data.decode('iso-8859-1')
+                relpath = os.path.normpath(name)
+                postings.extend((project_id, level, receiver, relpath, line)
+                                for level, receiver, line in find_call_sites(text, re_levels))
+                # The LUs come from the imports of the same read
+                lus.update(detector.detect(text))
+        return project_id, f, mtime, size, postings, lus, None
+    except Exception as e:
+        return project_id, None, None, None, None, None, str(e)
+
+
+class LoggingIndex:
+    def __init__(self, path='result/log_remove/logging_index.sqlite', f_lu_levels='conf/lu_levels.json'):
+        """
+        Parameters
+        ----------
+        path: The SQLite file of the index
+        f_lu_levels: The LUs and their level functions; all of them are indexed
+        """
+        self.path = path
+        self.levels = load_levels(f_lu_levels)
+        with open(f_lu_levels) as r:
+            self.lu_names = list(json.load(r).keys())
+        if os.path.dirname(path):
+            ut.create_folder_if_not_exist(os.path.dirname(path))
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+        with self._lock:
+            conn = self._connect()
+            conn.execute('CREATE TABLE IF NOT EXISTS archives ('
+                         'project_id INTEGER PRIMARY KEY, archive TEXT, mtime REAL, size INTEGER, levels TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS postings ('
+                         'project_id INTEGER, level TEXT, receiver TEXT, file TEXT, line INTEGER)')
+            conn.execute('CREATE TABLE IF NOT EXISTS lus (project_id INTEGER, lu TEXT, files INTEGER)')
+            conn.execute('CREATE INDEX IF NOT EXISTS postings_project ON postings (project_id, level)')
+            conn.execute('CREATE INDEX IF NOT EXISTS postings_level ON postings (level, receiver)')
+
+    def _connect(self):
+        # A SQLite connection must not be shared with forked children
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def is_current(self, project_id, repo_path):
+        """
+        Whether the project is indexed from its current archive, with the current level functions
+        """
+        if not os.path.isfile(repo_path) and find_repacked(repo_path, java_only=True) is None:
+            return False
+        with self._lock:
+            row = self._connect().execute('SELECT archive, mtime, size, levels FROM archives WHERE project_id = ?',
+                                          (int(project_id),)).fetchone()
+        return row is not None and tuple(row) == _archive_state(repo_path) + (self._levels_key(),)
+
+    def _levels_key(self):
+        # Projects indexed before LU detection, with other level functions or other LU patterns are indexed again
+        patterns = hashlib.sha1(json.dumps(LU_PATTERNS, sort_keys=True).encode()).hexdigest()[:10]
+        return ','.join(self.levels) + ';' + patterns
+
+    def update(self, df, workers=None):
+        """
+        Index the projects that are new or whose archive changed
+        Parameters
+        ----------
+        df: The projects, with project_id and repo_path
+        workers: The number of processes reading archives
+
+        Returns
+        -------
+        (indexed, failed): The number of projects
+        """
+        tasks = [(int(row['project_id']), row['repo_path'], self.levels) for _, row in df.iterrows()
+                 if not self.is_current(row['project_id'], row['repo_path'])]
+        indexed = failed = 0
+        if not tasks:
+            return indexed, failed
+        # Archives are read by the pool; this process is the only writer
+        with multiprocessing.Pool(processes=min(workers or ut.getWorkers(), len(tasks))) as pool:
+            for project_id, f, mtime, size, postings, lus, err in pool.imap_unordered(_index_project, tasks):
+                if err is not None:
+                    failed += 1
+                    logger.error('Fail to index project %s: %s' % (project_id, err))
+                    continue
+                with self._lock:
+                    conn = self._connect()
+                    conn.execute('BEGIN IMMEDIATE')
+                    try:
+                        conn.execute('DELETE FROM postings WHERE project_id = ?', (project_id,))
+                        conn.executemany('INSERT INTO postings VALUES (?, ?, ?, ?, ?)', postings)
+                        conn.execute('DELETE FROM lus WHERE project_id = ?', (project_id,))
+                        conn.executemany('INSERT INTO lus VALUES (?, ?, ?)',
+                                         [(project_id, lu, n) for lu, n in sorted(lus.items())])
+                        conn.execute('INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?)',
+                                     (project_id, f, mtime, size, self._levels_key()))
+                        conn.execute('COMMIT')
+                    except Exception:
+                        conn.execute('ROLLBACK')
+                        raise
+                indexed += 1
+        return indexed, failed
+
+    def files(self, project_id, function_names):
+        """
+        The files of a project calling any of the level functions on a logger-like receiver
+        """
+        levels = sorted({x.lower() for x in function_names})
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT DISTINCT file FROM postings WHERE project_id = ? AND level IN (%s) ORDER BY file'
+                % ','.join('?' * len(levels)), [int(project_id)] + levels).fetchall()
+        return [x[0] for x in rows]
+
+    def postings(self, project_ids=None, levels=None):
+        """
+        The call sites as a dataframe: project_id, level, receiver, file, line
+        """
+        query, params, where = 'SELECT * FROM postings', [], []
+        if project_ids is not None:
+            project_ids = [int(x) for x in project_ids]
+            where.append('project_id IN (%s)' % ','.join('?' * len(project_ids)))
+            params += project_ids
+        if levels is not None:
+            levels = sorted({x.lower() for x in levels})
+            where.append('level IN (%s)' % ','.join('?' * len(levels)))
+            params += levels
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        with self._lock:
+            return pd.read_sql_query(query, self._connect(), params=params)
+
+    def lus(self):
+        """
+        The LUs detected in every indexed project, in the LU columns of log_all_stats.csv (see lu_detector.py)
+        """
+        with self._lock:
+            conn = self._connect()
+            df = pd.read_sql_query('SELECT project_id, lu, files FROM lus', conn)
+            project_ids = [x[0] for x in conn.execute('SELECT project_id FROM archives')]
+        return to_lu_columns(df, self.lu_names, project_ids=project_ids)
+
+    def summary(self):
+        """
+        Call sites and files per project and level
+        """
+        with self._lock:
+            return pd.read_sql_query(
+                'SELECT project_id, level, COUNT(*) AS call_sites, COUNT(DISTINCT file) AS files '
+                'FROM postings GROUP BY project_id, level', self._connect())
+
+
+def load_corpus(size_types, sloc_dir='result/proj_sloc'):
+    """
+    The projects of the SLOC catalog with their archives under REPO_ZIPPED_ROOT
+    """
+    df = pd.concat([ut.csv_loader(os.path.join(sloc_dir, 'filesize_sloc_{}.csv'.format(s))) for s in size_types])
+    df = df.drop_duplicates('project_id')
+    d_repo = ut.getPath('REPO_ZIPPED_ROOT')
+    df['repo_path'] = df['repo_path'].apply(lambda x: os.path.join(d_repo, os.path.basename(x)))
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inverted index of logging call sites of the corpus')
+    parser.add_argument('command', choices=['build', 'summary'])
+    parser.add_argument('--index', default='result/log_remove/logging_index.sqlite')
+    parser.add_argument('-l', '--size_level', default='small,medium,large,vlarge')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    index = LoggingIndex(args.index)
+    if args.command == 'build':
+        df = load_corpus([x.strip() for x in args.size_level.split(',')])
+        indexed, failed = index.update(df, workers=args.workers)
+        logger.info('Indexed %d projects (%d failed, %d up to date) in %s'
+                    % (indexed, failed, len(df) - indexed - failed, args.index))
+    else:
+        print(index.summary().groupby('level')[['call_sites', 'files']].sum().to_string())
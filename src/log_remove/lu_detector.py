@@ -0,0 +1,185 @@
+"""
+Detection of the logging utilities (LUs) of a project from its sources
+The LUs of a project decide the level functions removed from it (conf/lu_levels.json). conf/log_all_stats.csv lists
+them for the projects of the original study only; for other projects they are detected from the imports and logger
+factory calls of the java files:
+    org.slf4j. / LoggerFactory.getLogger(                       slf4j
+    org.apache.logging.log4j. / LogManager.getFormatterLogger(  log4j2
+    org.apache.commons.logging. / LogFactory.getLog(            acl
+    java.util.logging. / android.util.Log / timber.log.Timber / org.apache.log4j. / ch.qos.logback. ...
+All patterns are alternatives of one regex, so a file is matched in a single pass. Ambiguous calls
+(Logger.getLogger, LogManager.getLogger) are left to the imports. The logging index records the detected LUs
+while it scans the corpus (LoggingIndex.lus()); without it the LUs can be detected in a pass of their own:
+    python src/log_remove/lu_detector.py [-l small,medium,large,vlarge] [--out result/log_remove/lu_detected.csv]
+which writes the format of log_all_stats.csv.
+"""
+import os
+import re
+import sys
+import json
+import logging
+import argparse
+import multiprocessing
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import pandas as pd
+import src.util.utils as ut
+from src.util.corpus_archive import ProjectArchive
+
+logger = logging.getLogger(__name__)
+
+# LU -> patterns of its packages and of its unambiguous logger factory calls
+# LUs that are not in conf/lu_levels.json are reported in the others column, as in log_all_stats.csv
+LU_PATTERNS = {
+    'slf4j': [r'\borg\.slf4j\.', r'\bLoggerFactory\s*\.\s*getLogger\s*\('],
+    'logback': [r'\bch\.qos\.logback\.'],
+    'log4j': [r'\borg\.apache\.log4j\.'],
+    'log4j2': [r'\borg\.apache\.logging\.log4j\.', r'\bLogManager\s*\.\s*getFormatterLogger\s*\('],
+    'acl': [r'\borg\.apache\.commons\.logging\.', r'\bLogFactory\s*\.\s*getLog\s*\('],
+    'jul': [r'\bjava\.util\.logging\.'],
+    'androidlog': [r'\bandroid\.util\.Log\b'],
+    'timber.log.timber': [r'\btimber\.log\.Timber\b', r'\bTimber\s*\.\s*(?:plant|tag)\s*\('],
+    'tinylog': [r'\borg\.(?:pmw\.)?tinylog\.'],
+    'jboss-logging': [r'\borg\.jboss\.logging\.'],
+}
+
+
+class LuDetector:
+    def __init__(self, patterns=None):
+        """
+        Parameters
+        ----------
+        patterns: LU -> list of regex, default to LU_PATTERNS
+        """
+        self.patterns = patterns or LU_PATTERNS
+        self._lus = []
+        alternatives = []
+        for lu, regexes in self.patterns.items():
+            for regex in regexes:
+                alternatives.append('(?P<p%d>%s)' % (len(self._lus), regex))
+                self._lus.append(lu)
+        self._re = re.compile('|'.join(alternatives))
+
+    def detect(self, text):
+        """
+        The LUs used in a java source
+        """
+        return {self._lus[int(m.lastgroup[1:])] for m in self._re.finditer(text)}
+
+    def detect_project(self, repo_path):
+        """
+        The LUs of a compressed project
+        Returns
+        -------
+        Counter: LU -> number of java files using it
+        """
+        files = Counter()
+        with ProjectArchive.open(repo_path, java_only=True) as archive:
+            for _, data in archive.members(suffix='.java'):
+                # Imports and the names of the patterns are ASCII
+                files.update(self.detect(data.decode('iso-8859-1')))
+        return files
+
+
+def to_lu_columns(df, lus, project_ids=None):
+    """
+    LU columns as in log_all_stats.csv, used by filter_projects_by_lus
+    Parameters
+    ----------
+    df: Detected LUs in the long format: project_id, lu, files
+    lus: The LUs with their own column (the keys of lu_levels); other LUs are listed in others
+    project_ids: All projects to report, including those without any LU; default to the projects of df
+
+    Returns
+    -------
+    df: project_id, others, <lu>... (True if the project uses the LU)
+    """
+    project_ids = sorted(set(df['project_id']) if project_ids is None else {int(x) for x in project_ids})
+    used = df.loc[df['files'] > 0].groupby('project_id')['lu'].apply(set).to_dict()
+    rows = []
+    for project_id in project_ids:
+        found = used.get(project_id, set())
+        row = {'project_id': project_id, 'others': ','.join(sorted(found - set(lus)))}
+        row.update({lu: lu in found for lu in lus})
+        rows.append(row)
+    return pd.DataFrame(rows, columns=['project_id', 'others'] + list(lus))
+
+
+def merge_detected_lus(df_proj_lus, df_detected):
+    """
+    Add the detected LUs of the projects missing from log_all_stats.csv
+    Parameters
+    ----------
+    df_proj_lus: The LUs of each project, as loaded by LogRemover.load_lu_per_project
+    df_detected: The detected LUs, as returned by to_lu_columns
+
+    Returns
+    -------
+    df: df_proj_lus with a row for every detected project it does not list
+    """
+    df_proj_lus = df_proj_lus.copy()
+    others = df_proj_lus['others'].fillna('').astype(str)
+    for lu in df_detected.columns.drop(['project_id', 'others']):
+        if lu not in df_proj_lus.columns:
+            # LUs without a column are looked up in others; the column keeps that answer for the listed projects
+            df_proj_lus[lu] = others.str.contains(lu, regex=False)
+    df_new = df_detected.loc[~df_detected['project_id'].isin(df_proj_lus['project_id'])]
+    return pd.concat([df_proj_lus, df_new[[c for c in df_new.columns if c in df_proj_lus.columns]]],
+                     ignore_index=True)
+
+
+def _detect_project(task):
+    project_id, repo_path = task
+    try:
+        return project_id, LuDetector().detect_project(repo_path), None
+    except Exception as e:
+        return project_id, None, str(e)
+
+
+def detect_corpus(df, workers=None):
+    """
+    Detect the LUs of projects with a pool
+    Parameters
+    ----------
+    df: The projects, with project_id and repo_path
+
+    Returns
+    -------
+    df: project_id, lu, files
+    """
+    rows = []
+    tasks = [(int(row['project_id']), row['repo_path']) for _, row in df.iterrows()]
+    if not tasks:
+        return pd.DataFrame(columns=['project_id', 'lu', 'files'])
+    with multiprocessing.Pool(processes=min(workers or ut.getWorkers(), len(tasks))) as pool:
+        for project_id, files, err in pool.imap_unordered(_detect_project, tasks):
+            if err is not None:
+                logger.error('Fail to detect LUs of project %s: %s' % (project_id, err))
+                continue
+            rows.extend((project_id, lu, n) for lu, n in files.items())
+    return pd.DataFrame(rows, columns=['project_id', 'lu', 'files'])
+
+
+if __name__ == '__main__':
+    # The logging index imports this module
+    from src.log_remove.logging_index import load_corpus
+    parser = argparse.ArgumentParser(description='Detect the logging utilities of projects from their imports')
+    parser.add_argument('-l', '--size_level', default='small,medium,large,vlarge')
+    parser.add_argument('--out', default='result/log_remove/lu_detected.csv')
+    parser.add_argument('--lu_levels', default='conf/lu_levels.json')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    with open(args.lu_levels) as r:
+        lus = list(json.load(r).keys())
+    df_corpus = load_corpus([x.strip() for x in args.size_level.split(',')])
+    df = to_lu_columns(detect_corpus(df_corpus, workers=args.workers), lus, project_ids=df_corpus['project_id'])
+    # The project column of log_all_stats.csv is <project_id>-<repo_name>
+    names = df_corpus.set_index('project_id')['repo_name']
+    df.insert(0, 'project', ['%d-%s' % (x, names[x]) for x in df['project_id']])
+    ut.create_folder_if_not_exist(os.path.dirname(args.out) or '.')
+    df.drop(columns='project_id').to_csv(args.out, index=False)
+    logger.info('LUs of %d projects written to %s; %d use a general LU'
+                % (len(df), args.out, df[lus].any(axis=1).sum()))
@@ -0,0 +1,170 @@
+"""
+Stratified sampling of projects for all repeats at once
+The population of each size is loaded and filtered once; the samples of all repeats are drawn with one seeded
+random matrix per size, and saved as a single membership table (repeat, size, project_id)
+"""
+import os
+import sys
+import zlib
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import src.util.utils as ut
+
+
+def filter_projects_by_lus(df, df_proj_lus, lu_levels):
+    """
+    Filter projects by selected logging utilities, column-wise instead of row by row
+    An LU without its own column in df_proj_lus is looked up in the 'others' column
+    Parameters
+    ----------
+    df: The dataframe to be processed
+    df_proj_lus: The LUs used in each project
+    lu_levels: The LUs and their level functions
+
+    Returns
+    -------
+    df: Projects using general LUs, with columns is_general and general_lus
+    """
+    df = pd.merge(df, df_proj_lus, on='project_id')
+    lus = list(lu_levels.keys())
+    # An all-empty column is read as float, which has no .str accessor
+    others = (df['others'] if 'others' in df.columns else pd.Series('', index=df.index)).fillna('').astype(str)
+    hits = np.column_stack([
+        (df[x] == True).to_numpy(dtype=bool) if x in df.columns
+        else others.str.contains(x, regex=False).to_numpy(dtype=bool)
+        for x in lus]) if lus else np.zeros((len(df), 0), dtype=bool)
+    df['is_general'] = hits.any(axis=1)
+    df['general_lus'] = [[lus[j] for j in np.flatnonzero(r)] for r in hits]
+    return df[df['is_general']]
+
+
+class ProjectSampler:
+    def __init__(self, lu_levels, df_proj_lus, sloc_dir='result/proj_sloc', ignore_projects=None):
+        """
+        Parameters
+        ----------
+        lu_levels: The LUs and their level functions
+        df_proj_lus: The LUs used in each project
+        sloc_dir: The directory of filesize_sloc_<size>.csv
+        ignore_projects: Projects excluded from the population (e.g. failed in NiCad)
+        """
+        self.lu_levels = lu_levels
+        self.df_proj_lus = df_proj_lus
+        self.sloc_dir = sloc_dir
+        self.ignore_projects = ignore_projects
+
+    def load_population(self, sample_sizes):
+        """
+        Load and filter the projects of each size once
+        Parameters
+        ----------
+        sample_sizes: The size levels to be sampled
+
+        Returns
+        -------
+        df: All eligible projects, column 'size' is the size level
+        """
+        dfs = []
+        for size_type in sample_sizes:
+            df = ut.csv_loader(os.path.join(self.sloc_dir, 'filesize_sloc_{}.csv'.format(size_type)))
+            df['size'] = size_type
+            dfs.append(df)
+        df = pd.concat(dfs, ignore_index=True)
+        if self.ignore_projects is not None:
+            df = df.loc[~df['project_id'].isin(self.ignore_projects)]
+        return filter_projects_by_lus(df, self.df_proj_lus, self.lu_levels).reset_index(drop=True)
+
+    def sample(self, population, sample_percentage, repeats, seed=0):
+        """
+        Draw the samples of all repeats
+        Each size gets its own random stream; the matrix is filled repeat by repeat,
+        so adding repeats later does not change the samples of earlier repeats
+        Parameters
+        ----------
+        population: The dataframe from load_population
+        sample_percentage: The fraction of projects sampled from each size
+        repeats: The number of repeats
+        seed: The base seed
+
+        Returns
+        -------
+        df: Membership table indexed by (repeat, size), column project_id
+        """
+        if not 0.0 < sample_percentage <= 1.0:
+            raise ValueError('Not a proper sample rate. Sample rate should be in range (0, 1]')
+        members = []
+        for size_type, df_size in population.groupby('size', sort=False):
+            n = df_size.shape[0]
+            k = int(round(sample_percentage * n))
+            if k == 0: continue
+            project_ids = df_size['project_id'].to_numpy()
+            rng = np.random.default_rng([seed, zlib.crc32(size_type.encode())])
+            keys = rng.random((repeats, n))
+            if k < n:
+                idx = np.argpartition(keys, k - 1, axis=1)[:, :k]
+            else:
+                idx = np.tile(np.arange(n), (repeats, 1))
+            members.append(pd.DataFrame({
+                'repeat': np.repeat(np.arange(1, repeats + 1), k),
+                'size': size_type,
+                'project_id': project_ids[idx].ravel()
+            }))
+        if not members:
+            return pd.DataFrame(columns=['repeat', 'size', 'project_id']).set_index(['repeat', 'size'])
+        return pd.concat(members, ignore_index=True).set_index(['repeat', 'size']).sort_index()
+
+    def export_legacy(self, population, membership, sample_dir, overwrite=False):
+        """
+        Write one sample_<repeat>_sloc_<size>.csv per (repeat, size) as before
+        Parameters
+        ----------
+        population: The dataframe from load_population
+        membership: The membership table from sample
+        sample_dir: The output directory
+        overwrite: if overwrite existing files
+        """
+        df_members = membership.reset_index().merge(population, on=['project_id', 'size'], how='left')
+        for (repeat, size_type), df_sample in df_members.groupby(['repeat', 'size'], sort=False):
+            f_projects_sample = os.path.join(sample_dir, 'sample_{}_sloc_{}.csv'.format(repeat, size_type))
+            if os.path.isfile(f_projects_sample) and not overwrite:
+                continue
+            df_sample[population.columns].to_csv(f_projects_sample, index=False)
+
+    def _keep_legacy(self, membership, sample_dir):
+        df_members = membership.reset_index()
+        keep = []
+        for (repeat, size_type), df_sample in df_members.groupby(['repeat', 'size'], sort=False):
+            f_projects_sample = os.path.join(sample_dir, 'sample_{}_sloc_{}.csv'.format(repeat, size_type))
+            if os.path.isfile(f_projects_sample):
+                df_sample = pd.read_csv(f_projects_sample, usecols=['project_id']).assign(repeat=repeat, size=size_type)
+            keep.append(df_sample[['repeat', 'size', 'project_id']])
+        if not keep:
+            return membership
+        return pd.concat(keep, ignore_index=True).set_index(['repeat', 'size']).sort_index()
+
+    def run(self, sample_sizes, sample_percentage, repeats, sample_dir, export_legacy=False, overwrite=False, seed=0):
+        """
+        Sample all repeats and save the membership table (and the legacy per-file samples)
+        Returns
+        -------
+        df: The membership table
+        """
+        f_membership = os.path.join(sample_dir, 'sample_membership.csv')
+        population = self.load_population(sample_sizes)
+        if os.path.isfile(f_membership) and not overwrite:
+            membership = pd.read_csv(f_membership, index_col=['repeat', 'size'])
+            missing = set(range(1, repeats + 1)) - set(membership.index.get_level_values('repeat'))
+            if missing:
+                # Draw again: earlier repeats stay the same since the random streams are fixed
+                membership = self.sample(population, sample_percentage, repeats, seed=seed)
+        else:
+            membership = self.sample(population, sample_percentage, repeats, seed=seed)
+        if export_legacy and not overwrite:
+            # Samples already on file are kept, so the table has to describe them
+            membership = self._keep_legacy(membership, sample_dir)
+        membership.to_csv(f_membership)
+        if export_legacy:
+            self.export_legacy(population, membership, sample_dir, overwrite=overwrite)
+        return membership
@@ -0,0 +1,197 @@
+"""
+In-memory representation of a project for logging removal
+The java sources are read once from the compressed project into memory, where they are scanned and edited,
+and the cleaned archive is written from memory as well:
+    tar.gz/zip --> VirtualProject (relpath -> bytes) --> grep/edit in memory --> cleaned tar.gz
+The tree is only written to disk for external tools: JavaFormatter gets the log related files in a scratch folder,
+and materialize() writes the whole project when a later step (e.g. NiCad) needs it.
+"""
+import io
+import os
+import re
+import sys
+import shutil
+import tarfile
+import tempfile
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import src.util.utils as ut
+import src.util.child_usage as child_usage
+from src.util.corpus_archive import ProjectArchive
+
+# Same characters as LogRemover.rename_files
+_SPECIAL_CHARS = re.compile(r'[?<>$\\:*|"]')
+
+
+class SourceFile:
+    __slots__ = ('data', 'encoding', 'mode', 'mtime')
+
+    def __init__(self, data, mode=0o644, mtime=0):
+        self.data = data
+        # Decided on first decode; the edited text is encoded back the same way
+        self.encoding = None
+        self.mode = mode
+        self.mtime = mtime
+
+    def text(self):
+        if self.encoding is None:
+            try:
+                self.data.decode('utf-8')
+                self.encoding = 'utf-8'
+            except UnicodeError:
+                self.encoding = 'iso-8859-1'
+        return self.data.decode(self.encoding)
+
+    def set_text(self, text):
+        self.data = text.encode(self.encoding or 'utf-8', errors='replace')
+
+
+class VirtualProject:
+    def __init__(self, files=None):
+        """
+        Parameters
+        ----------
+        files: relpath -> SourceFile, where relpath starts with the project folder as in the original tar
+        """
+        self.files = files if files is not None else {}
+
+    @classmethod
+    def from_archive(cls, repo_path, keep_java_only=True):
+        """
+        Read a compressed project (or its repacked zip) without extracting it
+        Parameters
+        ----------
+        repo_path: The compressed project
+        keep_java_only: Only keep java files, as decompress_project does
+
+        Returns
+        -------
+        VirtualProject
+        """
+        files = {}
+        mtime = int(os.path.getmtime(repo_path)) if os.path.isfile(repo_path) else 0
+        with ProjectArchive.open(repo_path, java_only=keep_java_only) as archive:
+            for name, data in archive.members(suffix='.java' if keep_java_only else None):
+                files[os.path.normpath(name).lstrip('/')] = SourceFile(data, mtime=mtime)
+        return cls(files)
+
+    @property
+    def size(self):
+        return sum(len(f.data) for f in self.files.values())
+
+    def rename_files(self):
+        """
+        Replace special characters in java file names with _, as LogRemover.rename_files does on disk
+        """
+        for relpath in [x for x in self.files if _SPECIAL_CHARS.search(os.path.basename(x))]:
+            d, name = os.path.split(relpath)
+            self.files[os.path.join(d, _SPECIAL_CHARS.sub('_', name))] = self.files.pop(relpath)
+
+    def get_files_with_keyword(self, keyword, function_names):
+        """
+        Files containing the keyword and any of the function names, both case insensitive
+        """
+        re_funcs = re.compile('|'.join(function_names), re.I)
+        keyword = keyword.lower()
+        return [relpath for relpath, f in self.files.items()
+                if relpath.endswith('.java') and keyword in f.text().lower() and re_funcs.search(f.text())]
+
+    def format_java(self, files, f_javaformatter=None):
+        """
+        Run JavaFormatter on the given files, which are written to a scratch folder for it and read back
+        """
+        if not files: return
+        f_javaformatter = f_javaformatter or os.path.join(
+            *[ut.get_proj_root(), 'resources', 'javaformatter', 'JavaFormatter.jar'])
+        d_tmp = tempfile.mkdtemp(prefix='virtual_project_')
+        try:
+            for relpath in files:
+                f = os.path.join(d_tmp, relpath)
+                ut.create_folder_if_not_exist(os.path.dirname(f))
+                with open(f, 'wb') as w:
+                    w.write(self.files[relpath].data)
+                child_usage.run('java -jar {f_jf} "{f_java}"'.format(f_jf=f_javaformatter, f_java=f),
+                                tool='java', shell=True)
+                with open(f, 'rb') as r:
+                    data = r.read()
+                if data != self.files[relpath].data:
+                    self.files[relpath].data = data
+                    self.files[relpath].encoding = None
+        finally:
+            shutil.rmtree(d_tmp, ignore_errors=True)
+
+    def grep_logging(self, function_names, check_logging_type, files=None):
+        """
+        Find single-lined logging statements, as LogRemover.single_line_grep_logging does with grep
+        Parameters
+        ----------
+        function_names: logging levels function names regarding to the LU used in this project
+        check_logging_type: The function deciding the linetype of a line, given line and functions
+        files: Only search these files, None to search the whole project
+
+        Returns
+        -------
+        proj_logging_removal: f_path -> line number -> {line, linetype}
+        """
+        proj_logging_removal = defaultdict(lambda: defaultdict(dict))
+        re_logging = re.compile(r'(.*log.*)\.({funcs})\(.*\)'.format(funcs='|'.join(function_names)), re.I)
+        for relpath in sorted(files if files is not None else self.files):
+            if not relpath.endswith('.java'): continue
+            for line_num, line_content in enumerate(self.files[relpath].text().split('\n'), start=1):
+                if not re_logging.search(line_content): continue
+                # Skip lines in comments
+                if line_content.lower().strip().startswith((r'//', r'/*', r'*/')): continue
+                line_type = check_logging_type(line=line_content.lower().strip(), functions=function_names)
+                proj_logging_removal[relpath][line_num] = {'line': line_content, 'linetype': line_type}
+        return proj_logging_removal
+
+    def remove_logging(self, dict_removal, function_names):
+        """
+        Remove the recorded logging lines, as LogRemover.remove_logging_by_linenum does on disk
+        Returns
+        -------
+        missing: The recorded files not found in this project
+        """
+        re_logging = re.compile(r'.*(.*log.*\.({levels})\(.*\))'.format(levels='|'.join(function_names)),
+                                re.IGNORECASE)
+        missing = []
+        for f_path, line_info in dict_removal.items():
+            f = self.files.get(os.path.normpath(f_path))
+            if f is None:
+                missing.append(f_path)
+                continue
+            lines = f.text().split('\n')
+            for line_id, line_content_info in line_info.items():
+                idx = int(line_id) - 1
+                if idx >= len(lines) or line_content_info['linetype'] == 'lambda':
+                    continue
+                if line_content_info['linetype'] == 'condition':
+                    m = re_logging.match(lines[idx])
+                    if m:
+                        lines[idx] = lines[idx].replace(m.groups()[0], '')
+                else:
+                    lines[idx] = ''
+            f.set_text('\n'.join(lines))
+        return missing
+
+    def write_archive(self, f_tar, arcname):
+        """
+        Write the project as a compressed tar with the top folder arcname, as tar.add(tmp_out_dir) does
+        """
+        with tarfile.open(f_tar, 'w:gz') as tar:
+            for relpath in sorted(self.files):
+                f = self.files[relpath]
+                info = tarfile.TarInfo(os.path.join(arcname, relpath))
+                info.size, info.mode, info.mtime = len(f.data), f.mode, f.mtime
+                tar.addfile(info, io.BytesIO(f.data))
+
+    def materialize(self, d):
+        """
+        Write the project tree under d, for tools that need it on disk
+        """
+        for relpath, f in self.files.items():
+            f_out = os.path.join(d, relpath)
+            ut.create_folder_if_not_exist(os.path.dirname(f_out))
+            with open(f_out, 'wb') as w:
+                w.write(f.data)
@@ -7,12 +7,12 @@ import os
 import shutil
 import sys
 import subprocess
-import tarfile
 
 import pandas as pd
 import logging
 import ast
 from src.util.utils import getPath, parse_args_size_level
+from src.util.corpus_archive import ProjectArchive
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 
 global logger
@@ -46,10 +46,10 @@ def check_uncompressed_size(df, filetype='java'):
             logger.warning('Unable to locate file: %s; skip' % repo_path)
             continue
 
-        # Unzip tar since scc seems not accept processing on the fly
-        tar = tarfile.open(repo_path, "r:gz")
-        tar.extractall(path=folder_d)
-        tar.close()
+        # Unzip tar since scc seems not accept processing on the fly; only the files scc counts
+        exts = [filetype] if isinstance(filetype, str) else filetype
+        with ProjectArchive.open(repo_path, java_only=exts == ['java']) as archive:
+            archive.extract(folder_d, suffix=tuple('.' + x for x in exts))
 
         if isinstance(filetype, str):
             cmd = "scc --no-complexity  --include-ext {ext} -f json {d}".format(d=folder_d, ext=filetype)
@@ -0,0 +1,272 @@
+"""
+Disk and memory admission control for projects processed concurrently
+Every project reserves an estimated disk/memory budget before it is decompressed and releases it when done
+Projects that would exceed the budget wait until enough budget is released
+"""
+import os
+import sys
+import math
+import time
+import shutil
+import logging
+import threading
+import multiprocessing
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import src.util.utils as utils
+
+logger = logging.getLogger(__name__)
+
+
+def available_memory_mb():
+    """
+    Get the available memory of current machine in MB
+    Returns
+    -------
+
+    """
+    try:
+        import psutil
+        return psutil.virtual_memory().available / 1024 / 1024
+    except ImportError:
+        pass
+    try:
+        with open('/proc/meminfo') as r:
+            for line in r:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Fall back to free physical pages (e.g. on macOS without psutil)
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+
+def available_disk_mb(d):
+    """
+    Get the free disk space of the file system holding folder d in MB
+    Parameters
+    ----------
+    d: A folder on the file system to be checked
+
+    Returns
+    -------
+
+    """
+    return shutil.disk_usage(d).free / 1024 / 1024
+
+
+def load_size_estimates(size_types, d_proj_size='result/proj_size'):
+    """
+    Load the uncompressed size (size_mb) of each project from the size calculation results
+    Parameters
+    ----------
+    size_types: The size levels to be loaded
+    d_proj_size: The directory of filesize_mb_<size>.csv
+
+    Returns
+    -------
+    dict: project_id -> size_mb
+    """
+    size_mb = {}
+    for size_type in size_types:
+        f = os.path.join(d_proj_size, 'filesize_mb_{}.csv'.format(size_type))
+        if not os.path.isfile(f):
+            logger.warning('Size estimates not found: %s' % f)
+            continue
+        df = utils.csv_loader(f)
+        size_mb.update(dict(zip(df['project_id'].astype(int), df['size_mb'].astype(float))))
+    return size_mb
+
+
+def _to_mb(x):
+    # Missing estimates (None/NaN) count as 0
+    try:
+        x = float(x)
+    except (TypeError, ValueError):
+        return 0.0
+    return 0.0 if math.isnan(x) else x
+
+
+class AdmissionController:
+    """
+    Reserve disk and memory budget for a project before it starts
+    The controller must be created in the parent process before workers are forked,
+    so that all workers share the same reservations
+    """
+    def __init__(self, d_tmp, size_mb=None,
+                 disk_headroom_mb=10 * 1024,
+                 mem_headroom_mb=4 * 1024,
+                 disk_factor=3.0,
+                 mem_factor=20.0,
+                 min_mem_mb=512,
+                 poll_interval=30):
+        """
+        Parameters
+        ----------
+        d_tmp: The folder projects are decompressed into; its file system is checked for free disk
+        size_mb: dict of project_id -> uncompressed project size in MB (see load_size_estimates)
+        disk_headroom_mb: Disk space that is never handed out to projects
+        mem_headroom_mb: Memory that is never handed out to projects
+        disk_factor: Disk needed per MB of uncompressed project (sources, NiCad outputs and the archive)
+        mem_factor: Memory needed per MB of java sources (TXL parse trees, JavaFormatter JVMs)
+        min_mem_mb: Memory reserved for a project at least
+        poll_interval: Seconds between rechecks of free disk/memory while a project is waiting
+        """
+        utils.create_folder_if_not_exist(d_tmp)
+        self.d_tmp = d_tmp
+        self.size_mb = size_mb or {}
+        self.disk_headroom_mb = disk_headroom_mb
+        self.mem_headroom_mb = mem_headroom_mb
+        self.disk_factor = disk_factor
+        self.mem_factor = mem_factor
+        self.min_mem_mb = min_mem_mb
+        self.poll_interval = poll_interval
+
+        # Shared by all forked workers
+        self._cond = multiprocessing.Condition()
+        self._n_reserved = multiprocessing.Value('i', 0, lock=False)
+        self._disk_reserved = multiprocessing.Value('d', 0.0, lock=False)
+        self._mem_reserved = multiprocessing.Value('d', 0.0, lock=False)
+        self._disk_budget = multiprocessing.Value('d', 0.0, lock=False)
+        self._mem_budget = multiprocessing.Value('d', 0.0, lock=False)
+        self._refresh_budget()
+
+        # Reservations held by the current process; a project nested in another step is admitted once
+        self._held = {}
+        self._held_lock = threading.Lock()
+
+    def estimate(self, row):
+        """
+        Estimate the disk and memory needed by a project
+        Parameters
+        ----------
+        row: dataframe row, records the information of a project
+
+        Returns
+        -------
+        disk_mb, mem_mb
+        """
+        repo_id = int(row['project_id'])
+        java_mb = _to_mb(row.get('Bytes')) / 1024 / 1024
+        proj_mb = _to_mb(row.get('size_mb', self.size_mb.get(repo_id))) or java_mb
+        return proj_mb * self.disk_factor, max(self.min_mem_mb, java_mb * self.mem_factor)
+
+    def _refresh_budget(self):
+        # Only called while nothing is reserved, so the free space is not taken by any running project
+        self._disk_budget.value = available_disk_mb(self.d_tmp) - self.disk_headroom_mb
+        self._mem_budget.value = available_memory_mb() - self.mem_headroom_mb
+
+    def _fits(self, disk_mb, mem_mb):
+        if self._n_reserved.value == 0:
+            # Always admit a project on an idle node, otherwise a project larger than the budget never runs
+            self._refresh_budget()
+            return True
+        # Free disk/memory can also be taken by other users of the machine
+        if available_disk_mb(self.d_tmp) < self.disk_headroom_mb or available_memory_mb() < self.mem_headroom_mb:
+            return False
+        return (self._disk_reserved.value + disk_mb <= self._disk_budget.value and
+                self._mem_reserved.value + mem_mb <= self._mem_budget.value)
+
+    def acquire(self, row):
+        """
+        Block until the budget of a project is reserved
+        Parameters
+        ----------
+        row: dataframe row, records the information of a project
+        """
+        self.acquire_all([row])
+
+    def acquire_all(self, rows):
+        """
+        Block until the budget of all projects is reserved at once
+        Projects run together (e.g. a NiCad batch) must not hold part of their budget while waiting for the rest,
+        otherwise workers holding parts of their batches wait for each other forever
+        Parameters
+        ----------
+        rows: dataframe rows of the projects; each one is released on its own by release()
+        """
+        new = []
+        with self._held_lock:
+            for row in rows:
+                repo_id = int(row['project_id'])
+                if repo_id in self._held:
+                    self._held[repo_id][0] += 1
+                elif repo_id not in [x for x, _, _ in new]:
+                    new.append((repo_id, *self.estimate(row)))
+        if not new:
+            return
+
+        disk_mb = sum(x[1] for x in new)
+        mem_mb = sum(x[2] for x in new)
+        start = time.time()
+        with self._cond:
+            while not self._fits(disk_mb, mem_mb):
+                self._cond.wait(timeout=self.poll_interval)
+            self._n_reserved.value += len(new)
+            self._disk_reserved.value += disk_mb
+            self._mem_reserved.value += mem_mb
+            disk_headroom = self._disk_budget.value - self._disk_reserved.value
+            mem_headroom = self._mem_budget.value - self._mem_reserved.value
+            n_reserved = self._n_reserved.value
+
+        with self._held_lock:
+            for repo_id, project_disk_mb, project_mem_mb in new:
+                self._held[repo_id] = [1, project_disk_mb, project_mem_mb]
+        logger.info('Admitted project %s after waiting %.1fs; reserved disk %.0f MB, memory %.0f MB; '
+                    'headroom disk %.0f MB, memory %.0f MB; %d projects in flight' % (
+                        ', '.join(str(x[0]) for x in new), time.time() - start, disk_mb, mem_mb, disk_headroom,
+                        mem_headroom, n_reserved))
+
+    def release(self, row):
+        """
+        Release the budget of a project
+        Parameters
+        ----------
+        row: dataframe row, records the information of a project
+        """
+        repo_id = int(row['project_id'])
+        with self._held_lock:
+            held = self._held.get(repo_id)
+            if held is None:
+                return
+            held[0] -= 1
+            if held[0] > 0:
+                return
+            del self._held[repo_id]
+        _, disk_mb, mem_mb = held
+
+        with self._cond:
+            self._n_reserved.value -= 1
+            self._disk_reserved.value = max(0.0, self._disk_reserved.value - disk_mb)
+            self._mem_reserved.value = max(0.0, self._mem_reserved.value - mem_mb)
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, row):
+        """
+        Reserve the budget of a project for the duration of the with block
+        Parameters
+        ----------
+        row: dataframe row, records the information of a project
+        """
+        self.acquire(row)
+        try:
+            yield
+        finally:
+            self.release(row)
+
+    @contextmanager
+    def reserve_all(self, rows):
+        """
+        Reserve the budget of several projects at once for the duration of the with block, see acquire_all
+        Parameters
+        ----------
+        rows: dataframe rows of the projects
+        """
+        self.acquire_all(rows)
+        try:
+            yield
+        finally:
+            for row in rows:
+                self.release(row)
@@ -0,0 +1,384 @@
+"""
+Resource usage of external child processes
+Most CPU and memory of a run is spent in children: nicad6/TXL, java (JavaFormatter), grep, awk and scc.
+Children started through this module are reaped with wait4, so the wall time, user/sys CPU and peak RSS of every
+invocation are known (the rusage includes the descendants the child waited for, e.g. TXL under nicad6).
+Invocations are collected per project:
+    with child_usage.collect() as usage:
+        child_usage.run(cmd, tool='nicad6', shell=True, cwd=d)
+    row.update(child_usage.summarize(usage))
+Each stage keeps one row per project and tool in result/<stage>/child_usage.csv; the report lists memory-heavy
+projects and the number of workers the machine can afford:
+    python src/util/child_usage.py report result/clone_detection/child_usage.csv
+Children of a project can be given a deadline, scaled with the size of the project; a child still running at the
+deadline is killed with its whole process group and ChildTimeout is raised:
+    with child_usage.deadline(child_usage.scaled_timeout(row, base=600, per_kloc=5)):
+        child_usage.run(cmd, shell=True)
+Children reaped by someone else (e.g. the asyncio child watcher) are wrapped into
+    python src/util/child_usage.py exec --out usage.json -- <cmd>
+which runs <cmd>, writes its usage to usage.json and exits with its return code.
+"""
+import os
+import sys
+import json
+import math
+import time
+import signal
+import argparse
+import resource
+import subprocess
+import contextvars
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import pandas as pd
+from src.util.profiler import tool_name
+
+# The invocations of the project being processed by the current thread (or asyncio task), None if not collected
+_collector = contextvars.ContextVar('child_usage', default=None)
+# The monotonic time by which the children of the current project must finish, None for no limit
+_deadline = contextvars.ContextVar('child_deadline', default=None)
+# ru_maxrss is in KB on Linux and in bytes on macOS
+_RSS_TO_MB = 1 / 1024 / 1024 if sys.platform == 'darwin' else 1 / 1024
+# Lines of java code per MB, for projects whose SLOC is not known
+_KLOC_PER_MB = 25
+
+
+class ChildTimeout(subprocess.TimeoutExpired):
+    """
+    A child killed with its process group because it did not finish in time
+    """
+
+
+class AccountedPopen(subprocess.Popen):
+    """
+    Popen that reaps its child with wait4 and records the resource usage of the child
+    """
+    def __init__(self, args, tool=None, **kwargs):
+        self.tool = tool or tool_name(args)
+        self.usage = None
+        self.timed_out = False
+        self._own_group = bool(kwargs.get('start_new_session')) or kwargs.get('process_group') == 0
+        self._collector = _collector.get()
+        # Linux counts the memory of this process before exec into the peak RSS of the child, so a peak up to
+        # the peak RSS of this process tells nothing about the child itself
+        self._baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self._start = time.perf_counter()
+        super().__init__(args, **kwargs)
+
+    def _try_wait(self, wait_flags):
+        # Same as Popen._try_wait, with the rusage that waitpid drops
+        try:
+            pid, sts, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return self.pid, 0
+        if pid == self.pid:
+            self.usage = {'tool': self.tool,
+                          'wall': time.perf_counter() - self._start,
+                          'user': rusage.ru_utime,
+                          'sys': rusage.ru_stime,
+                          'max_rss_mb': rusage.ru_maxrss * _RSS_TO_MB if rusage.ru_maxrss > self._baseline_rss
+                          else float('nan'),
+                          'returncode': os.waitstatus_to_exitcode(sts),
+                          'timed_out': self.timed_out}
+            if self._collector is not None:
+                self._collector.append(self.usage)
+        return pid, sts
+
+    def kill_group(self):
+        """
+        Kill the child, with the processes it started if it leads its own process group
+        """
+        try:
+            if self._own_group:
+                os.killpg(self.pid, signal.SIGKILL)
+            else:
+                self.kill()
+        except ProcessLookupError:
+            pass
+
+
+def popen(args, tool=None, **kwargs):
+    """
+    subprocess.Popen, accounted
+    Parameters
+    ----------
+    args: The command
+    tool: The name of the tool recorded, default to the first token of the command
+    """
+    return AccountedPopen(args, tool=tool, **kwargs)
+
+
+def run(args, tool=None, input=None, check=False, timeout=None, **kwargs):
+    """
+    subprocess.run, accounted
+    Parameters
+    ----------
+    timeout: Seconds before the child is killed, shortened to what is left of the deadline of the project;
+        the child runs in its own process group, so the processes it started are killed as well
+    """
+    timeout = remaining(timeout)
+    if timeout is not None:
+        if timeout <= 0:
+            # Not started since the project is out of time, but counted as a timeout of the tool
+            record([{'tool': tool or tool_name(args), 'wall': 0.0, 'user': 0.0, 'sys': 0.0,
+                     'max_rss_mb': float('nan'), 'returncode': None, 'timed_out': True}])
+            raise ChildTimeout(args, 0)
+        kwargs.setdefault('start_new_session', True)
+    if input is not None:
+        kwargs['stdin'] = subprocess.PIPE
+    with AccountedPopen(args, tool=tool, **kwargs) as p:
+        try:
+            stdout, stderr = p.communicate(input, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            p.timed_out = True
+            p.kill_group()
+            stdout, stderr = p.communicate()
+            raise ChildTimeout(args, timeout, output=stdout, stderr=stderr)
+        except BaseException:
+            p.kill_group()
+            raise
+    if check and p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, args, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(args, p.returncode, stdout, stderr)
+
+
+def check_output(args, tool=None, **kwargs):
+    """
+    subprocess.check_output, accounted
+    """
+    return run(args, tool=tool, stdout=subprocess.PIPE, check=True, **kwargs).stdout
+
+
+def remaining(timeout=None):
+    """
+    The timeout of a child: timeout, shortened to what is left of the deadline of the project
+    """
+    end = _deadline.get()
+    if end is None:
+        return timeout
+    left = end - time.monotonic()
+    return left if timeout is None else min(timeout, left)
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    The children started within must all be finished in seconds, None for no limit
+    A nested deadline can only make it earlier
+    """
+    if seconds is None:
+        yield
+        return
+    end = time.monotonic() + seconds
+    outer = _deadline.get()
+    token = _deadline.set(end if outer is None else min(outer, end))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def scaled_timeout(row, base, per_kloc=0):
+    """
+    Seconds allowed to the children of a project, growing with its size
+    Parameters
+    ----------
+    row: The project, with its SLOC in Code, or its java code in Bytes or size_mb
+    base: Seconds allowed to any project, None for no limit
+    per_kloc: Seconds added per thousand lines of code
+
+    Returns
+    -------
+    seconds: None for no limit
+    """
+    if base is None:
+        return None
+    kloc = 0
+    for column, to_kloc in [('Code', 1 / 1000), ('Bytes', _KLOC_PER_MB / 1024 / 1024), ('size_mb', _KLOC_PER_MB)]:
+        value = row.get(column) if hasattr(row, 'get') else None
+        if value is not None and value == value:
+            kloc = float(value) * to_kloc
+            break
+    return base + per_kloc * kloc
+
+
+def timed_out(usage):
+    """
+    Whether any of the collected invocations was killed at its timeout
+    """
+    return any(x.get('timed_out') for x in usage)
+
+
+def record(usage):
+    """
+    Add invocations measured elsewhere (e.g. by a pool worker or the exec wrapper) to the current collection
+    """
+    collector = _collector.get()
+    if collector is not None:
+        collector.extend(usage)
+
+
+@contextmanager
+def collect():
+    """
+    Collect the invocations of the current thread (or asyncio task) into a list
+    Invocations of a nested collection are also added to the enclosing one
+    """
+    usage = []
+    token = _collector.set(usage)
+    try:
+        yield usage
+    finally:
+        _collector.reset(token)
+        record(usage)
+
+
+def summarize(usage, prefix='child_'):
+    """
+    The usage of all invocations of a project, as columns of its result row
+    Wall and CPU times are summed, the peak RSS is the largest of all invocations (NaN if none of them got above
+    the RSS of the worker)
+    """
+    return {prefix + 'calls': len(usage),
+            prefix + 'wall': sum(x['wall'] for x in usage),
+            prefix + 'user': sum(x['user'] for x in usage),
+            prefix + 'sys': sum(x['sys'] for x in usage),
+            prefix + 'max_rss_mb': max((x['max_rss_mb'] for x in usage if x['max_rss_mb'] == x['max_rss_mb']),
+                                       default=float('nan'))}
+
+
+def share(usage, fraction):
+    """
+    The part of invocations run for several projects at once (e.g. a batched NiCad run) attributed to one of them
+    Wall and CPU times are scaled by fraction; the peak RSS is kept, as the project was processed with the others
+    """
+    return [dict(x, wall=x['wall'] * fraction, user=x['user'] * fraction, sys=x['sys'] * fraction) for x in usage]
+
+
+def usage_by_tool(usage, **keys):
+    """
+    The usage of a project per tool, e.g. for child_usage.csv
+    Parameters
+    ----------
+    usage: The collected invocations
+    keys: Columns identifying the project, e.g. project_id
+
+    Returns
+    -------
+    df: keys, tool, calls, failed, timeouts, wall, user, sys, max_rss_mb
+    """
+    columns = list(keys) + ['tool', 'calls', 'failed', 'timeouts', 'wall', 'user', 'sys', 'max_rss_mb']
+    if not usage:
+        return pd.DataFrame(columns=columns)
+    df = pd.DataFrame(usage)
+    df['failed'] = df['returncode'] != 0
+    df = df.groupby('tool').agg(calls=('wall', 'size'), failed=('failed', 'sum'), timeouts=('timed_out', 'sum'),
+                                wall=('wall', 'sum'), user=('user', 'sum'), sys=('sys', 'sum'),
+                                max_rss_mb=('max_rss_mb', 'max')).reset_index()
+    for k, v in keys.items():
+        df[k] = v
+    return df[columns]
+
+
+def _total_memory_mb():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 / 1024
+
+
+def recommend_workers(df, mem_mb=None, cpus=None, quantile=0.95, headroom=0.8):
+    """
+    The number of projects the machine can process at the same time, from the usage of earlier runs
+    Parameters
+    ----------
+    df: child_usage.csv
+    mem_mb: The memory of the machine, default to the physical memory
+    cpus: The CPUs of the machine, default to os.cpu_count()
+    quantile: The quantile of the peak RSS of projects that must fit into memory
+    headroom: The share of the memory given to the children
+
+    Returns
+    -------
+    (workers, detail): The recommended workers, and the figures it is based on
+    """
+    mem_mb = mem_mb or _total_memory_mb()
+    cpus = cpus or os.cpu_count()
+    per_project = df.groupby('project_id').agg(wall=('wall', 'sum'), cpu=('user', 'sum'),
+                                               sys=('sys', 'sum'), max_rss_mb=('max_rss_mb', 'max'))
+    rss = float(per_project['max_rss_mb'].quantile(quantile))
+    # Children using more than one core (e.g. the JVM) leave fewer cores to the other workers
+    cores_per_project = max(1.0, float(((per_project['cpu'] + per_project['sys']) /
+                                        per_project['wall'].clip(lower=1e-9)).median()))
+    by_memory = math.floor(mem_mb * headroom / rss) if rss > 0 else cpus
+    by_cpu = math.floor(cpus / cores_per_project)
+    detail = {'projects': len(per_project), 'rss_quantile_mb': rss, 'cores_per_project': cores_per_project,
+              'workers_by_memory': by_memory, 'workers_by_cpu': by_cpu}
+    return max(1, min(by_memory, by_cpu)), detail
+
+
+def _exec(args):
+    # The child shares the process group of this wrapper, so killing the group kills both
+    p = popen(args.cmd, tool=args.tool)
+    try:
+        p.wait()
+    except KeyboardInterrupt:
+        p.wait()
+    try:
+        with open(args.out + '.tmp', 'w') as w:
+            json.dump(p.usage, w)
+        os.replace(args.out + '.tmp', args.out)
+    except OSError:
+        # The usage is lost, but the caller still gets the return code of the command
+        pass
+    return p.returncode
+
+
+def exec_command(cmd, f_out, tool=None):
+    """
+    The command running cmd through the exec wrapper, for children that are not reaped by this module
+    """
+    # The command may run in another folder
+    return [sys.executable, os.path.abspath(__file__), 'exec', '--out', os.path.abspath(f_out)] + \
+        (['--tool', tool] if tool else []) + ['--'] + list(cmd)
+
+
+def load_exec_usage(f_out):
+    """
+    The usage written by the exec wrapper, [] if the wrapper was killed before writing it
+    """
+    if not os.path.isfile(f_out):
+        return []
+    with open(f_out) as r:
+        usage = json.load(r)
+    os.remove(f_out)
+    return [usage] if usage else []
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resource usage of external child processes')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_exec = subparsers.add_parser('exec', help='Run a command and write its resource usage')
+    parser_exec.add_argument('--out', required=True, help='The json file of the usage')
+    parser_exec.add_argument('--tool', default=None)
+    parser_exec.add_argument('cmd', nargs=argparse.REMAINDER)
+    parser_report = subparsers.add_parser('report', help='Memory-heavy projects and the recommended workers')
+    parser_report.add_argument('f_usage', help='A child_usage.csv')
+    parser_report.add_argument('--top', type=int, default=20)
+    parser_report.add_argument('--mem_gb', type=float, default=None, help='Default to the physical memory')
+    parser_report.add_argument('--cpus', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == 'exec':
+        if args.cmd and args.cmd[0] == '--':
+            args.cmd = args.cmd[1:]
+        sys.exit(_exec(args))
+    from src.util.result_sink import CsvResultSink
+    df = CsvResultSink(args.f_usage, key=['project_id', 'tool']).read()
+    print('The most memory-heavy projects:')
+    print(df.groupby('project_id').agg(calls=('calls', 'sum'), wall=('wall', 'sum'), max_rss_mb=('max_rss_mb', 'max'))
+          .sort_values('max_rss_mb', ascending=False).head(args.top).to_string())
+    print('\nPer tool:')
+    print(df.groupby('tool').agg(calls=('calls', 'sum'), wall=('wall', 'sum'), user=('user', 'sum'),
+                                 sys=('sys', 'sum'), max_rss_mb=('max_rss_mb', 'max')).to_string())
+    workers, detail = recommend_workers(df, mem_mb=args.mem_gb * 1024 if args.mem_gb else None, cpus=args.cpus)
+    print('\nRecommended workers: %d (%s)' % (workers, ', '.join('%s=%s' % (k, round(v, 1) if isinstance(v, float)
+                                                                            else v) for k, v in detail.items())))
@@ -0,0 +1,222 @@
+"""
+Random access to the projects of the corpus
+A .tar.gz can only be read from the start, so fetching the java files (or a handful of log related files) of a project
+means gunzipping all of it. The repack tool converts each <name>.tar.gz of REPO_ZIPPED_ROOT into <name>.zip next to it,
+with the same member names and every member compressed on its own:
+    python src/util/corpus_archive.py [--src REPO_ZIPPED_ROOT] [--java_only]
+With --java_only the zip only has the .java files and is named <name>.java.zip. ProjectArchive.open(repo_path) then
+reads the zip if it is there and up to date, and the .tar.gz otherwise, so readers keep passing the repo_path of the
+catalog. A .java.zip is only read by readers that ask for java files alone (java_only=True).
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import tarfile
+import zipfile
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import src.util.utils as utils
+
+logger = logging.getLogger(__name__)
+
+
+def repacked_path(repo_path, java_only=False):
+    """
+    The zip of a compressed project, e.g. owner_repo.tar.gz --> owner_repo.zip (owner_repo.java.zip if java_only)
+    """
+    base = repo_path[:-len('.tar.gz')] if repo_path.endswith('.tar.gz') else os.path.splitext(repo_path)[0]
+    return base + ('.java.zip' if java_only else '.zip')
+
+
+def find_repacked(repo_path, java_only=False):
+    """
+    The zip of a compressed project if it is there and newer than the .tar.gz, otherwise None
+    Parameters
+    ----------
+    repo_path: The .tar.gz of the project
+    java_only: The caller only reads .java files, so a zip repacked with java_only serves it too
+    """
+    for f_zip in [repacked_path(repo_path)] + ([repacked_path(repo_path, java_only=True)] if java_only else []):
+        if os.path.isfile(f_zip) and (not os.path.isfile(repo_path) or
+                                      os.path.getmtime(f_zip) >= os.path.getmtime(repo_path)):
+            return f_zip
+    return None
+
+
+def _is_safe(name):
+    name = os.path.normpath(name)
+    return not (os.path.isabs(name) or name.startswith('..'))
+
+
+class ProjectArchive:
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path: A .zip written by repack, or a .tar.gz
+        """
+        self.path = path
+        self.is_zip = path.endswith('.zip')
+        self._zip = zipfile.ZipFile(path) if self.is_zip else None
+        self._tar = None
+
+    @classmethod
+    def open(cls, repo_path, java_only=False):
+        """
+        Open the repacked zip of a project if it is newer than the .tar.gz, otherwise the .tar.gz itself
+        Parameters
+        ----------
+        repo_path: The .tar.gz of the project
+        java_only: Only .java files will be read, see find_repacked
+        """
+        return cls(find_repacked(repo_path, java_only=java_only) or repo_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._zip is not None: self._zip.close()
+        if self._tar is not None: self._tar.close()
+
+    def _tarfile(self):
+        # Random access to a .tar.gz decompresses everything before the member anyway; keep it open for later reads
+        if self._tar is None:
+            self._tar = tarfile.open(self.path, 'r:gz')
+        return self._tar
+
+    def names(self, suffix=None):
+        """
+        Names of the files in the archive, optionally only those ending with suffix (a string or a tuple)
+        """
+        if self.is_zip:
+            names = [x.filename for x in self._zip.infolist() if not x.is_dir()]
+        else:
+            names = [m.name for m in self._tarfile().getmembers() if m.isfile()]
+        return [x for x in names if suffix is None or x.endswith(suffix)]
+
+    def read(self, name):
+        """
+        The content of a member
+        """
+        if self.is_zip:
+            return self._zip.read(name)
+        return self._tarfile().extractfile(name).read()
+
+    def members(self, suffix=None, names=None):
+        """
+        Iterate (name, data) of the files ending with suffix, or of the given names
+        """
+        if self.is_zip:
+            for name in (names if names is not None else self.names(suffix)):
+                yield name, self._zip.read(name)
+            return
+        wanted = set(names) if names is not None else None
+        # A single pass over the stream
+        with tarfile.open(self.path, 'r|gz') as tar:
+            for m in tar:
+                if not m.isfile(): continue
+                if wanted is not None and m.name not in wanted: continue
+                if wanted is None and suffix is not None and not m.name.endswith(suffix): continue
+                yield m.name, tar.extractfile(m).read()
+
+    def extract(self, out_d, suffix=None):
+        """
+        Extract the archive into out_d, optionally only the files ending with suffix
+        """
+        # out_d exists even if no member matches, as after extracting the whole project
+        utils.create_folder_if_not_exist(out_d)
+        if not self.is_zip and suffix is None:
+            with tarfile.open(self.path, 'r:gz') as tar:
+                tar.extractall(path=out_d)
+            return
+        for name, data in self.members(suffix=suffix):
+            if not _is_safe(name):
+                logger.warning('Skip member %s of %s' % (name, self.path))
+                continue
+            f = os.path.join(out_d, name)
+            utils.create_folder_if_not_exist(os.path.dirname(f))
+            with open(f, 'wb') as w:
+                w.write(data)
+
+
+def repack(repo_path, java_only=False):
+    """
+    Convert a compressed project into a zip with the same member names
+    Parameters
+    ----------
+    repo_path: The .tar.gz of the project
+    java_only: Only keep .java files, in <name>.java.zip
+
+    Returns
+    -------
+    f_zip: The zip written
+    """
+    f_zip = repacked_path(repo_path, java_only=java_only)
+    f_tmp = f_zip + '.tmp'
+    with tarfile.open(repo_path, 'r|gz') as tar, \
+            zipfile.ZipFile(f_tmp, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        for m in tar:
+            if not m.isfile(): continue
+            if java_only and not m.name.endswith('.java'): continue
+            info = zipfile.ZipInfo(m.name, date_time=_date_time(m.mtime))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = (m.mode & 0xFFFF) << 16
+            with tar.extractfile(m) as r, zf.open(info, 'w', force_zip64=m.size > 2 ** 31) as w:
+                shutil.copyfileobj(r, w)
+    os.replace(f_tmp, f_zip)
+    return f_zip
+
+
+def _date_time(mtime):
+    # Zip cannot store dates before 1980
+    return time.localtime(max(mtime, 315532800))[:6]
+
+
+def _repack(args):
+    repo_path, java_only = args
+    try:
+        repack(repo_path, java_only=java_only)
+        return repo_path, None
+    except Exception as e:
+        return repo_path, str(e)
+
+
+def repack_corpus(d_src, java_only=False, workers=None, overwrite=False):
+    """
+    Repack all .tar.gz projects of a folder, skipping those already repacked
+    Returns
+    -------
+    (repacked, failed): The number of projects
+    """
+    repo_paths = sorted(os.path.join(d_src, x) for x in os.listdir(d_src) if x.endswith('.tar.gz'))
+    if not overwrite:
+        repo_paths = [x for x in repo_paths if find_repacked(x, java_only=java_only) is None]
+    repacked = failed = 0
+    with multiprocessing.Pool(processes=workers or utils.getWorkers()) as pool:
+        for repo_path, err in pool.imap_unordered(_repack, [(x, java_only) for x in repo_paths]):
+            if err is None:
+                repacked += 1
+            else:
+                failed += 1
+                logger.error('Fail to repack %s: %s' % (repo_path, err))
+    return repacked, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Repack the corpus into zips with random access to members')
+    parser.add_argument('--src', type=str, default=None, help="The folder of .tar.gz projects, default REPO_ZIPPED_ROOT")
+    parser.add_argument('--java_only', action='store_true', help="Only keep .java files in the zips")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--overwrite', action='store_true', help="Repack projects that already have a zip")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    d_src = args.src or utils.getPath('REPO_ZIPPED_ROOT', ischeck=True)
+    repacked, failed = repack_corpus(d_src, java_only=args.java_only, workers=args.workers, overwrite=args.overwrite)
+    logger.info('Repacked %d projects in %s; %d failed' % (repacked, d_src, failed))
@@ -0,0 +1,253 @@
+"""
+Live progress and throughput metrics of a run
+Workers update counters in shared memory (created by the parent before forking); a reporter thread of the parent
+aggregates them every few seconds into:
+    - a Prometheus text file, e.g. log/metrics/clone_detection.prom (readable by the node_exporter textfile collector)
+    - an optional one-line progress view on the terminal
+    - a warning in the log when no project finished for a while although projects are in flight (e.g. a stuck NiCad)
+"""
+import os
+import sys
+import time
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import src.util.utils as utils
+
+logger = logging.getLogger(__name__)
+
+# Slots of the shared counters
+DONE, FAILED, IN_FLIGHT, BYTES, LAST_FINISHED = range(5)
+
+
+class Progress:
+    """
+    The outcome of one project, reported by the worker processing it
+    """
+    __slots__ = ('failed',)
+
+    def __init__(self):
+        self.failed = False
+
+    def fail(self):
+        self.failed = True
+
+
+class RunMetrics:
+    def __init__(self, stage, f_prom=None, interval=15, progress=False, stall_after=1800, window=600):
+        """
+        Parameters
+        ----------
+        stage: The stage label of all metrics, e.g. clone_detection
+        f_prom: The Prometheus text file, default to log/metrics/<stage>.prom
+        interval: Seconds between two reports
+        progress: Show a progress line on stderr
+        stall_after: Seconds without a finished project (while some are in flight) before warning about a stall
+        window: Seconds of history used for the current rates and the ETA
+        """
+        self.stage = stage
+        self.f_prom = f_prom or os.path.join('log/metrics', '%s.prom' % stage)
+        self.interval = interval
+        self.progress = progress
+        self.stall_after = stall_after
+        self.window = window
+        # Shared with forked workers, so it must be created before they are
+        self._counters = multiprocessing.Array('d', 5)
+        self._local = threading.local()
+        self.total = 0
+        self.total_bytes = 0
+        self._start = None
+        self._history = deque()
+        self._stalled = False
+        self._stop = threading.Event()
+        self._reporter = None
+
+    # Worker side
+    @contextmanager
+    def track(self, row):
+        """
+        Count a project as in flight, then as done (or failed if progress.fail() was called or an exception is raised)
+        """
+        progress = Progress()
+        self._local.progress = progress
+        self._add(IN_FLIGHT, 1)
+        try:
+            yield progress
+        except BaseException:
+            progress.fail()
+            raise
+        finally:
+            size = row.get('Bytes', 0) if hasattr(row, 'get') else 0
+            with self._counters.get_lock():
+                self._counters[IN_FLIGHT] -= 1
+                self._counters[FAILED if progress.failed else DONE] += 1
+                self._counters[BYTES] += float(size) if size == size and size else 0
+                self._counters[LAST_FINISHED] = time.time()
+
+    def iterrows(self, df):
+        """
+        df.iterrows(), tracking every project until the loop moves on to the next one
+        """
+        for i, row in df.iterrows():
+            with self.track(row):
+                yield i, row
+
+    def fail(self):
+        """
+        Mark the project tracked by the current thread as failed
+        """
+        progress = getattr(self._local, 'progress', None)
+        if progress is not None:
+            progress.fail()
+
+    def _add(self, slot, value):
+        with self._counters.get_lock():
+            self._counters[slot] += value
+
+    # Parent side
+    def snapshot(self):
+        with self._counters.get_lock():
+            counters = list(self._counters)
+        now = time.time()
+        done, failed, in_flight, n_bytes, last_finished = counters
+        finished = done + failed
+        self._history.append((now, finished, n_bytes))
+        while len(self._history) > 1 and self._history[0][0] < now - self.window:
+            self._history.popleft()
+        t0, finished0, bytes0 = self._history[0]
+        if now - t0 >= self.interval and finished > finished0:
+            rate, bytes_rate = (finished - finished0) / (now - t0), (n_bytes - bytes0) / (now - t0)
+        else:
+            elapsed = max(now - self._start, 1e-9)
+            rate, bytes_rate = finished / elapsed, n_bytes / elapsed
+        remaining = max(self.total - finished, 0)
+        eta = remaining / rate if rate > 0 else float('nan')
+        # Nothing finished for a while, although projects are being processed
+        since = now - (last_finished or self._start)
+        stalled = in_flight > 0 and since > self.stall_after
+        return {'total': self.total, 'done': done, 'failed': failed, 'in_flight': in_flight, 'bytes': n_bytes,
+                'rate': rate, 'bytes_rate': bytes_rate, 'eta': eta, 'since_last_finished': since,
+                'stalled': stalled, 'elapsed': now - self._start}
+
+    def to_prometheus(self, s):
+        label = '{stage="%s"}' % self.stage
+        metrics = [
+            ('projects_total', 'gauge', 'Projects of the run', s['total']),
+            ('projects_done_total', 'counter', 'Projects finished', s['done']),
+            ('projects_failed_total', 'counter', 'Projects failed', s['failed']),
+            ('projects_in_flight', 'gauge', 'Projects being processed', s['in_flight']),
+            ('bytes_processed_total', 'counter', 'Java bytes of finished projects', s['bytes']),
+            ('projects_per_second', 'gauge', 'Recent project throughput', s['rate']),
+            ('bytes_per_second', 'gauge', 'Recent byte throughput', s['bytes_rate']),
+            ('eta_seconds', 'gauge', 'Estimated seconds until all projects are finished', s['eta']),
+            ('seconds_since_last_finished', 'gauge', 'Seconds since a project last finished',
+             s['since_last_finished']),
+            ('stalled', 'gauge', '1 if no project finished for a while although some are in flight',
+             int(s['stalled'])),
+            ('run_start_time_seconds', 'gauge', 'Start of the run', self._start),
+        ]
+        lines = []
+        for name, kind, doc, value in metrics:
+            lines += ['# HELP loggingbench_%s %s' % (name, doc), '# TYPE loggingbench_%s %s' % (name, kind),
+                      'loggingbench_%s%s %s' % (name, label, 'NaN' if value != value else repr(float(value)))]
+        return '\n'.join(lines) + '\n'
+
+    def report(self):
+        s = self.snapshot()
+        utils.create_folder_if_not_exist(os.path.dirname(self.f_prom))
+        # Written aside and renamed, so that a scraper never reads half a file
+        with open(self.f_prom + '.tmp', 'w') as w:
+            w.write(self.to_prometheus(s))
+        os.replace(self.f_prom + '.tmp', self.f_prom)
+        if s['stalled'] and not self._stalled:
+            logger.warning('[%s] No project finished for %d min while %d are in flight'
+                           % (self.stage, s['since_last_finished'] / 60, s['in_flight']))
+        self._stalled = s['stalled']
+        if self.progress:
+            sys.stderr.write('\r[%s] %d/%d done, %d failed, %d in flight | %.2f projects/s, %.2f MB/s | ETA %s%s   ' % (
+                self.stage, s['done'], s['total'], s['failed'], s['in_flight'], s['rate'],
+                s['bytes_rate'] / 1024 / 1024, _format_seconds(s['eta']), ' | STALLED' if s['stalled'] else ''))
+            sys.stderr.flush()
+        return s
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.report()
+            except Exception as e:
+                logger.warning('Fail to report metrics: %s' % e)
+
+    def start(self, df):
+        """
+        Reset the counters for the projects of df and start reporting; called by the parent before forking workers
+        """
+        with self._counters.get_lock():
+            for i in range(len(self._counters)):
+                self._counters[i] = 0
+        self.total = len(df)
+        self.total_bytes = float(df['Bytes'].sum()) if 'Bytes' in df.columns else 0
+        self._start = time.time()
+        self._history.clear()
+        self._stalled = False
+        self._stop.clear()
+        self._reporter = threading.Thread(target=self._run, daemon=True)
+        self._reporter.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._reporter is not None:
+            self._reporter.join()
+            self._reporter = None
+        s = self.report()
+        if self.progress:
+            sys.stderr.write('\n')
+        logger.info('[%s] %d done, %d failed of %d projects in %s' % (
+            self.stage, s['done'], s['failed'], s['total'], _format_seconds(s['elapsed'])))
+
+
+def _format_seconds(seconds):
+    if seconds != seconds:
+        return '-'
+    h, rem = divmod(int(seconds), 3600)
+    return '%dh%02dm' % (h, rem // 60) if h else '%dm%02ds' % divmod(rem, 60)
+
+
+def track(metrics, row):
+    """
+    metrics.track(row), or a no-op if metrics is None
+    """
+    return metrics.track(row) if metrics is not None else nullcontext(Progress())
+
+
+def iterrows(metrics, df):
+    """
+    metrics.iterrows(df), or df.iterrows() if metrics is None
+    """
+    return metrics.iterrows(df) if metrics is not None else df.iterrows()
+
+
+def fail(metrics):
+    """
+    Mark the project tracked by the current thread as failed, if metrics are collected
+    """
+    if metrics is not None:
+        metrics.fail()
+
+
+@contextmanager
+def reporting(metrics, df):
+    """
+    Report metrics while the projects of df are processed, if metrics is not None
+    """
+    if metrics is None:
+        yield
+        return
+    metrics.start(df)
+    try:
+        yield
+    finally:
+        metrics.stop()
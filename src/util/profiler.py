@@ -0,0 +1,194 @@
+"""
+Opt-in profiling of worker processes
+Each worker (and every thread it starts) runs under cProfile and writes its own stats file;
+merge_profiles() combines them into one ranked report.
+Time spent waiting on external tools (grep, awk, java, nicad6, scc, ...) is measured separately
+by timing subprocess waits, so that it is not mistaken for Python time.
+"""
+import os
+import sys
+import json
+import glob
+import time
+import pstats
+import itertools
+import cProfile
+import threading
+import subprocess
+from functools import wraps
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import src.util.utils as utils
+
+# Child process waits of the current process: tool -> [calls, seconds]
+_child_waits = {}
+_child_waits_lock = threading.Lock()
+_wait_depth = threading.local()
+_patched = False
+# Numbers the profiled threads of a process; thread idents are reused once a thread exits
+_thread_seq = itertools.count(1)
+
+# Profiler entries that only block on child processes; they are left out of the Python ranking
+_WAIT_FUNCTIONS = ('waitpid', 'wait4', 'poll', 'select', 'epoll')
+# Profiler entries blocking on other threads (e.g. join), whose own work is profiled separately
+_LOCK_FUNCTIONS = ("'acquire' of '_thread.lock'", "'acquire' of '_thread.RLock'")
+
+
+def tool_name(cmd):
+    """
+    The external tool of a command, e.g. "./nicad6 blocks java ..." -> nicad6
+    """
+    if not isinstance(cmd, str):
+        cmd = ' '.join(map(str, cmd))
+    tokens = cmd.strip().split()
+    return os.path.basename(tokens[0]) if tokens else '?'
+
+
+def record_child_wait(tool, seconds):
+    """
+    Record time spent waiting on a child process
+    Parameters
+    ----------
+    tool: The name of the external tool
+    seconds: The waited time
+    """
+    with _child_waits_lock:
+        calls_seconds = _child_waits.setdefault(tool, [0, 0.0])
+        calls_seconds[0] += 1
+        calls_seconds[1] += seconds
+
+
+def _timed_wait(orig):
+    @wraps(orig)
+    def wrapper(self, *args, **kwargs):
+        # communicate() calls wait() internally; count the outermost call only
+        depth = getattr(_wait_depth, 'n', 0)
+        _wait_depth.n = depth + 1
+        start = time.perf_counter()
+        try:
+            return orig(self, *args, **kwargs)
+        finally:
+            _wait_depth.n = depth
+            if depth == 0:
+                record_child_wait(tool_name(self.args), time.perf_counter() - start)
+    return wrapper
+
+
+def _profiled_thread_run(orig, out_dir):
+    @wraps(orig)
+    def run(self):
+        prof = cProfile.Profile()
+        try:
+            prof.runcall(orig, self)
+        finally:
+            prof.dump_stats(os.path.join(out_dir, 'worker_{}_thread_{}.prof'.format(os.getpid(), next(_thread_seq))))
+    return run
+
+
+def _patch(out_dir):
+    # Only done inside profiled workers, so that unprofiled runs are untouched
+    global _patched
+    if _patched: return
+    subprocess.Popen.wait = _timed_wait(subprocess.Popen.wait)
+    subprocess.Popen.communicate = _timed_wait(subprocess.Popen.communicate)
+    threading.Thread.run = _profiled_thread_run(threading.Thread.run, out_dir)
+    _patched = True
+
+
+class ProfiledWorker:
+    """
+    Wrap a worker function so that it runs under cProfile
+    A class rather than a closure so that it can be passed to multiprocessing.Process with any start method
+    Repeated calls in the same process (e.g. one per leased project) add up in one stats file per process
+    """
+    def __init__(self, func, out_dir):
+        """
+        Parameters
+        ----------
+        func: The worker function
+        out_dir: The folder for stats files of all workers
+        """
+        self.func = func
+        self.out_dir = out_dir
+        self._pid = None
+        self._prof = None
+        self._wall = 0.0
+
+    def __call__(self, *args, **kwargs):
+        if self._pid != os.getpid():
+            # First call in this (forked) process
+            utils.create_folder_if_not_exist(self.out_dir)
+            _patch(self.out_dir)
+            self._pid = os.getpid()
+            self._prof = cProfile.Profile()
+            self._wall = 0.0
+        start = time.time()
+        try:
+            return self._prof.runcall(self.func, *args, **kwargs)
+        finally:
+            self._wall += time.time() - start
+            prefix = os.path.join(self.out_dir, 'worker_{}'.format(self._pid))
+            self._prof.dump_stats(prefix + '.prof')
+            with _child_waits_lock:
+                child_waits = dict(_child_waits)
+            with open(prefix + '.json', 'w') as w:
+                json.dump({'pid': self._pid, 'wall': self._wall, 'child_waits': child_waits}, w)
+
+
+def merge_profiles(out_dir, top=40):
+    """
+    Merge the stats files of all workers into one ranked report (<out_dir>/report.txt)
+    Parameters
+    ----------
+    out_dir: The folder with the stats files
+    top: The number of functions listed
+
+    Returns
+    -------
+    report: The report text
+    """
+    f_profs = sorted(glob.glob(os.path.join(out_dir, 'worker_*.prof')))
+    if not f_profs:
+        return ''
+    stats = pstats.Stats(*f_profs)
+
+    workers = []
+    child_waits = {}
+    for f_json in sorted(glob.glob(os.path.join(out_dir, 'worker_*.json'))):
+        with open(f_json) as r:
+            worker = json.load(r)
+        workers.append(worker)
+        for tool, (calls, seconds) in worker['child_waits'].items():
+            child_waits.setdefault(tool, [0, 0.0])
+            child_waits[tool][0] += calls
+            child_waits[tool][1] += seconds
+
+    child_total = sum(seconds for _, seconds in child_waits.values())
+    lock_total = sum(v[2] for (filename, _, func), v in stats.stats.items()
+                     if filename == '~' and any(x in func for x in _LOCK_FUNCTIONS))
+    lines = ['Workers: {}, max wall time: {:.1f}s'.format(len(workers), max([w['wall'] for w in workers] or [0])),
+             'Profiled time (all workers and threads): {:.1f}s'.format(stats.total_tt),
+             'Waiting on child processes: {:.1f}s'.format(child_total),
+             'Waiting on other threads: {:.1f}s'.format(lock_total),
+             'Python (incl. file I/O): {:.1f}s'.format(max(0.0, stats.total_tt - child_total - lock_total)),
+             '',
+             'Child process waits by tool:',
+             '{:>12} {:>10} {:>12}'.format('tool', 'waits', 'seconds')]
+    for tool, (calls, seconds) in sorted(child_waits.items(), key=lambda x: -x[1][1]):
+        lines.append('{:>12} {:>10} {:>12.1f}'.format(tool, calls, seconds))
+
+    lines += ['', 'Top {} Python functions by own time:'.format(top),
+              '{:>10} {:>12} {:>12}  {}'.format('calls', 'tottime', 'cumtime', 'function')]
+    ranked = sorted(stats.stats.items(), key=lambda x: -x[1][2])
+    n = 0
+    for (filename, lineno, func), (_, ncalls, tottime, cumtime, _) in ranked:
+        if filename == '~' and any(x in func for x in _WAIT_FUNCTIONS + _LOCK_FUNCTIONS):
+            continue
+        lines.append('{:>10} {:>12.3f} {:>12.3f}  {}:{}({})'.format(ncalls, tottime, cumtime, filename, lineno, func))
+        n += 1
+        if n >= top: break
+
+    report = '\n'.join(lines)
+    with open(os.path.join(out_dir, 'report.txt'), 'w') as w:
+        w.write(report + '\n')
+    return report
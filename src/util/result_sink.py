@@ -0,0 +1,231 @@
+"""
+Result sinks safe for concurrent workers
+Each worker process appends to its own shard file next to the canonical result, so no cross-process lock is needed.
+compact() merges the shards of the current host into the canonical file (deduplicated by the key) once its workers
+are done, and read() gives the merged view of the canonical file and all shards at any time.
+<dir>/<name>                       canonical result (e.g. clone_detection_check.csv)
+<dir>/<name>.lock                  held while a host merges its shards into the canonical result
+<dir>/.shards/<name>/<host>_<pid>*  shards of each worker
+In a multi-node run (a shared work queue) every node compacts its own shards when its workers finish, while other
+nodes may still be writing theirs; read() is the source of truth until the last node has compacted.
+"""
+import os
+import sys
+import time
+import glob
+import json
+import socket
+import threading
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import pandas as pd
+import src.util.utils as utils
+
+
+class ResultSink:
+    def __init__(self, f, ext, lock_timeout=600):
+        """
+        Parameters
+        ----------
+        f: The canonical result file
+        ext: The extension of shard files
+        lock_timeout: Seconds after which the lock of the canonical result is taken as left by a crashed host
+        """
+        self.f = f
+        self.ext = ext
+        self.lock_timeout = lock_timeout
+        self.d_shards = os.path.join(os.path.dirname(os.path.abspath(f)), '.shards', os.path.basename(f))
+        # Threads of the same worker share its shard
+        self._lock = threading.Lock()
+
+    def _shard_prefix(self):
+        return os.path.join(self.d_shards, '{}_{}'.format(socket.gethostname(), os.getpid()))
+
+    def shards(self):
+        """
+        All shard files, oldest first
+        """
+        return sorted(glob.glob(os.path.join(self.d_shards, '*' + self.ext)), key=os.path.getmtime)
+
+    def host_shards(self):
+        """
+        The shard files of the workers of the current host, oldest first
+        """
+        return sorted(glob.glob(os.path.join(self.d_shards, '{}_*{}'.format(socket.gethostname(), self.ext))),
+                      key=os.path.getmtime)
+
+    @contextmanager
+    def _locked(self):
+        # Hosts sharing the result folder merge into the canonical result one at a time (O_EXCL works on NFSv3+)
+        utils.create_folder_if_not_exist(os.path.dirname(os.path.abspath(self.f)))
+        f_lock = self.f + '.lock'
+        while True:
+            try:
+                fd = os.open(f_lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(f_lock) > self.lock_timeout:
+                        os.remove(f_lock)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.5)
+        try:
+            os.write(fd, '{}:{}'.format(socket.gethostname(), os.getpid()).encode())
+            os.close(fd)
+            yield
+        finally:
+            os.remove(f_lock)
+
+    def clear(self):
+        """
+        Remove the canonical result and all shards
+        """
+        for f in self.shards() + [self.f]:
+            if os.path.isfile(f):
+                os.remove(f)
+
+    def _replace_canonical(self, write, shards):
+        # Write next to the canonical file then rename, so readers never see a partial result; call with _locked()
+        f_tmp = '{}.{}.tmp'.format(self.f, os.getpid())
+        write(f_tmp)
+        os.replace(f_tmp, self.f)
+        for f in shards:
+            os.remove(f)
+
+
+class CsvResultSink(ResultSink):
+    """
+    Sink for dataframes, e.g. clone_detection_check.csv and filesize_sloc_<size>.csv
+    """
+    def __init__(self, f, key='project_id', lock_timeout=600):
+        """
+        Parameters
+        ----------
+        f: The canonical csv
+        key: Column(s) identifying a result row; the latest row of a key wins
+        lock_timeout: See ResultSink
+        """
+        super().__init__(f, ext='.csv', lock_timeout=lock_timeout)
+        self.key = key
+        self._part = 0
+
+    def write(self, df):
+        """
+        Append rows to the shard of the current worker
+        Parameters
+        ----------
+        df: The dataframe to be saved
+        """
+        if df.empty: return
+        with self._lock:
+            utils.create_folder_if_not_exist(self.d_shards)
+            while True:
+                f_shard = '{}_{}{}'.format(self._shard_prefix(), self._part, self.ext)
+                if not os.path.isfile(f_shard):
+                    df.to_csv(f_shard, mode='w', index=False, header=True)
+                    return
+                with open(f_shard) as r:
+                    header = r.readline().rstrip('\n')
+                if header == ','.join(map(str, df.columns)):
+                    df.to_csv(f_shard, mode='a', index=False, header=False)
+                    return
+                # Columns changed, start a new part so that every shard has one header
+                self._part += 1
+
+    def _read(self, shards):
+        dfs = [utils.csv_loader(f) for f in ([self.f] if os.path.isfile(self.f) else []) + shards]
+        if not dfs:
+            return pd.DataFrame()
+        df = pd.concat(dfs, ignore_index=True, sort=False)
+        keys = [self.key] if isinstance(self.key, str) else list(self.key)
+        if all(k in df.columns for k in keys):
+            df = df.drop_duplicates(subset=keys, keep='last')
+        return df.reset_index(drop=True)
+
+    def read(self):
+        """
+        The merged view of the canonical result and all shards
+        Returns
+        -------
+        df
+        """
+        return self._read(self.shards())
+
+    def compact(self):
+        """
+        Merge the shards of the current host into the canonical result; call when no worker of the host is writing
+        Returns
+        -------
+        df: The compacted result, without the shards of other hosts
+        """
+        with self._locked():
+            shards = self.host_shards()
+            df = self._read(shards)
+            if shards:
+                self._replace_canonical(lambda f: df.to_csv(f, index=False), shards)
+        return df
+
+
+class JsonResultSink(ResultSink):
+    """
+    Sink for dicts keyed by project id, e.g. logging_removal_lines.json
+    Every write is one JSON line in the shard of the current worker
+    """
+    def __init__(self, f, lock_timeout=600):
+        super().__init__(f, ext='.jsonl', lock_timeout=lock_timeout)
+
+    def write(self, d):
+        """
+        Append a dict of project_id -> result to the shard of the current worker
+        """
+        if not any(d): return
+        line = json.dumps(d)
+        with self._lock:
+            utils.create_folder_if_not_exist(self.d_shards)
+            with open(self._shard_prefix() + self.ext, 'a') as w:
+                w.write(line + '\n')
+
+    def _read(self, shards):
+        js = {}
+        if os.path.isfile(self.f):
+            with open(self.f) as r:
+                js = json.load(r)
+        for f in shards:
+            with open(f) as r:
+                for line in r:
+                    # Skip a line cut by a crashed worker
+                    try:
+                        js.update(json.loads(line))
+                    except ValueError:
+                        continue
+        return js
+
+    def read(self):
+        """
+        The merged view of the canonical result and all shards
+        Returns
+        -------
+        dict
+        """
+        return self._read(self.shards())
+
+    def compact(self):
+        """
+        Merge the shards of the current host into the canonical result; call when no worker of the host is writing
+        Returns
+        -------
+        dict: The compacted result, without the shards of other hosts
+        """
+        with self._locked():
+            shards = self.host_shards()
+            js = self._read(shards)
+
+            def write(f):
+                with open(f, 'w') as w:
+                    w.write(json.dumps(js, indent=4))
+            if shards:
+                self._replace_canonical(write, shards)
+        return js
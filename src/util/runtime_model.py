@@ -0,0 +1,354 @@
+"""
+Per-stage runtime model learned from past runs
+Run records are parsed from the logs of earlier runs (one "finished" line per project), joined with the
+project size metrics (SLOC: Code, files: Count) and fitted with a robust (Huber) regression in log-log space:
+    log(seconds) = b0 + b1 * log(1 + Code) + b2 * log(1 + Count)
+The model predicts the cost of each project, which gives an ETA for a planned run, a longest-first order and
+balanced chunks for the schedulers, and flags projects that ran far beyond their prediction.
+Models are saved as result/runtime_model/<stage>.json
+
+Usage:
+    python src/util/runtime_model.py fit --stage clone_detection --logs "log/clone_detection/*.log"
+    python src/util/runtime_model.py eta --stage clone_detection --size_level small,medium --workers 32
+    python src/util/runtime_model.py outliers --stage clone_detection --logs "log/clone_detection/*.log"
+"""
+import os
+import re
+import sys
+import glob
+import json
+import heapq
+import logging
+import argparse
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import src.util.utils as utils
+
+logger = logging.getLogger(__name__)
+
+D_MODEL = 'result/runtime_model'
+
+# <asctime> - <pid> - <level> - [<context>] <message>; the context is absent in logs written before it was added
+_LOG_LINE = re.compile(r'^(?P<time>\d{2}-\w{3}-\d{2} \d{2}:\d{2}:\d{2}) - (?P<pid>\d+) - (?P<level>\w+) - '
+                       r'(?:\[(?P<context>[^\]]*)\] )?(?P<message>.*)$')
+_CONTEXT_PROJECT = re.compile(r'project_id=(\d+)')
+
+# stage -> pattern of the line logged when a project is finished
+# "seconds" is only logged by newer runs; older runs are timed by the previous finished line of the same process
+# "project_id" is only needed for logs without context
+FINISHED_PATTERNS = {
+    'clone_detection': re.compile(
+        r'^Clone detection finished(?: in (?P<seconds>[\d.]+)s)?\. Results are saved in .*/(?P<project_id>\d+)_[^/]*$'),
+    'clone_detection_logging_removal': re.compile(
+        r'^Clone detection for project .*\((?P<project_id>\d+)\) finished(?: in (?P<seconds>[\d.]+)s)?\.$'),
+    'log_remove': re.compile(
+        r'^Logging removal finished(?: in (?P<seconds>[\d.]+)s)?\.'),
+}
+
+
+def parse_run_records(f_logs, stage):
+    """
+    Parse the runtime of each finished project from log files
+    Parameters
+    ----------
+    f_logs: Log files (or glob patterns)
+    stage: The stage to be parsed, a key of FINISHED_PATTERNS
+
+    Returns
+    -------
+    df: Columns project_id, seconds, finished, pid, f_log; the latest run of a project wins
+    """
+    pattern = FINISHED_PATTERNS[stage]
+    records = []
+    for f_log in sorted(set(f for p in f_logs for f in glob.glob(p))):
+        # Last finished line of each process, for logs without timing
+        last_finished = {}
+        with open(f_log, errors='replace') as r:
+            for line in r:
+                m = _LOG_LINE.match(line.rstrip('\n'))
+                if m is None: continue
+                pid = int(m.group('pid'))
+                m_finished = pattern.match(m.group('message'))
+                if m_finished is None: continue
+                finished = datetime.strptime(m.group('time'), utils.LOG_DATEFMT)
+                previous, last_finished[pid] = last_finished.get(pid), finished
+
+                project_id = m_finished.groupdict().get('project_id')
+                if m.group('context'):
+                    m_project = _CONTEXT_PROJECT.search(m.group('context'))
+                    project_id = m_project.group(1) if m_project else project_id
+                if project_id is None: continue
+
+                if m_finished.group('seconds') is not None:
+                    seconds = float(m_finished.group('seconds'))
+                elif previous is not None:
+                    # Workers process their projects one after another
+                    seconds = (finished - previous).total_seconds()
+                else:
+                    continue
+                records.append((int(project_id), seconds, finished, pid, f_log))
+    df = pd.DataFrame(records, columns=['project_id', 'seconds', 'finished', 'pid', 'f_log'])
+    return df.sort_values('finished').drop_duplicates('project_id', keep='last').reset_index(drop=True)
+
+
+def load_project_features(sloc_dir='result/proj_sloc', size_types=('small', 'medium', 'large', 'vlarge')):
+    """
+    Load the size metrics of projects
+    Parameters
+    ----------
+    sloc_dir: The directory of filesize_sloc_<size>.csv
+    size_types: The size levels to be loaded
+
+    Returns
+    -------
+    df: One row per project
+    """
+    dfs = []
+    for size_type in size_types:
+        f = os.path.join(sloc_dir, 'filesize_sloc_{}.csv'.format(size_type))
+        if os.path.isfile(f):
+            dfs.append(utils.csv_loader(f))
+    if not dfs:
+        return pd.DataFrame(columns=['project_id'])
+    return pd.concat(dfs, ignore_index=True).drop_duplicates('project_id', keep='last')
+
+
+class RuntimeModel:
+    """
+    Robust log-log regression of project runtime on project size metrics
+    """
+    def __init__(self, stage, features=('Code', 'Count')):
+        """
+        Parameters
+        ----------
+        stage: The stage modeled, e.g. clone_detection
+        features: The size metrics used as predictors
+        """
+        self.stage = stage
+        self.features = list(features)
+        self.coef = None
+        # Robust scale of residuals in log space
+        self.scale = None
+        # Retransformation factor from median to mean runtime
+        self.smearing = 1.0
+        self.n = 0
+
+    def _design(self, df):
+        X = np.log1p(df[self.features].astype(float).clip(lower=0).fillna(0).to_numpy())
+        return np.column_stack([np.ones(len(df)), X])
+
+    def fit(self, df, huber_k=1.345, max_iter=50):
+        """
+        Fit the model with iteratively reweighted least squares (Huber weights)
+        Parameters
+        ----------
+        df: Run records joined with size metrics, must have column seconds and all features
+        huber_k: Residuals beyond huber_k scales are down-weighted
+        max_iter: The maximum number of iterations
+
+        Returns
+        -------
+        self
+        """
+        df = df.dropna(subset=self.features + ['seconds'])
+        df = df.loc[df['seconds'] > 0]
+        if len(df) < len(self.features) + 2:
+            raise ValueError('Not enough run records of stage %s to fit: %d' % (self.stage, len(df)))
+        X, y = self._design(df), np.log(df['seconds'].to_numpy(dtype=float))
+
+        w = np.ones(len(y))
+        coef = np.zeros(X.shape[1])
+        for _ in range(max_iter):
+            sw = np.sqrt(w)
+            new_coef = np.linalg.lstsq(X * sw[:, None], y * sw, rcond=None)[0]
+            r = y - X @ new_coef
+            scale = 1.4826 * np.median(np.abs(r - np.median(r))) or np.std(r) or 1e-6
+            u = np.abs(r) / (huber_k * scale)
+            w = np.where(u <= 1, 1.0, 1.0 / np.maximum(u, 1e-12))
+            converged = np.allclose(new_coef, coef, atol=1e-6)
+            coef = new_coef
+            if converged: break
+
+        r = y - X @ coef
+        self.coef = coef
+        self.scale = float(1.4826 * np.median(np.abs(r - np.median(r))) or np.std(r))
+        self.smearing = float(np.mean(np.exp(r)))
+        self.n = len(y)
+        return self
+
+    def predict(self, df, expected=True):
+        """
+        Predict the runtime of projects in seconds
+        Parameters
+        ----------
+        df: Projects with all features
+        expected: The expected (mean) runtime if True, otherwise the typical (median) runtime
+
+        Returns
+        -------
+        np.ndarray
+        """
+        seconds = np.exp(self._design(df) @ self.coef)
+        return seconds * self.smearing if expected else seconds
+
+    def flag_outliers(self, df, k=3.0):
+        """
+        Flag projects that ran far beyond their prediction
+        Parameters
+        ----------
+        df: Run records joined with size metrics
+        k: Projects whose log residual exceeds k robust scales are flagged
+
+        Returns
+        -------
+        df: With columns predicted_seconds, ratio and is_outlier, sorted by ratio
+        """
+        df = df.copy()
+        df['predicted_seconds'] = self.predict(df, expected=False)
+        df['ratio'] = df['seconds'] / df['predicted_seconds']
+        df['is_outlier'] = np.log(df['ratio']) > k * self.scale
+        return df.sort_values('ratio', ascending=False)
+
+    def save(self, f=None):
+        f = f or os.path.join(D_MODEL, '%s.json' % self.stage)
+        utils.create_folder_if_not_exist(os.path.dirname(f))
+        with open(f, 'w') as w:
+            json.dump({'stage': self.stage, 'features': self.features, 'coef': list(map(float, self.coef)),
+                       'scale': self.scale, 'smearing': self.smearing, 'n': self.n}, w, indent=4)
+        return f
+
+    @classmethod
+    def load(cls, stage, f=None):
+        """
+        Load the model of a stage
+        Returns
+        -------
+        model: None if the stage has no model on file
+        """
+        f = f or os.path.join(D_MODEL, '%s.json' % stage)
+        if not os.path.isfile(f):
+            return None
+        with open(f) as r:
+            js = json.load(r)
+        model = cls(js['stage'], js['features'])
+        model.coef = np.array(js['coef'])
+        model.scale, model.smearing, model.n = js['scale'], js['smearing'], js['n']
+        return model
+
+
+def _lpt(costs, workers):
+    # Longest processing time first: every project goes to the worker finishing earliest
+    heap = [(0.0, i) for i in range(workers)]
+    assignment = np.empty(len(costs), dtype=int)
+    for idx in np.argsort(-np.asarray(costs), kind='stable'):
+        load, i = heapq.heappop(heap)
+        assignment[idx] = i
+        heapq.heappush(heap, (load + costs[idx], i))
+    return assignment, max(load for load, _ in heap) if heap else 0.0
+
+
+def longest_first(df, model):
+    """
+    Order projects by predicted runtime, longest first, so that long projects do not start last
+    Parameters
+    ----------
+    df: Projects with all features of the model
+    model: RuntimeModel
+
+    Returns
+    -------
+    df: With column predicted_seconds
+    """
+    df = df.copy()
+    df['predicted_seconds'] = model.predict(df)
+    return df.sort_values('predicted_seconds', ascending=False, kind='stable')
+
+
+def balanced_chunks(df, model, chunks):
+    """
+    Split projects into chunks with equal predicted runtime instead of equal size
+    Each chunk is ordered longest first
+    Parameters
+    ----------
+    df: Projects with all features of the model
+    model: RuntimeModel
+    chunks: The number of chunks
+
+    Returns
+    -------
+    list of dataframes
+    """
+    df = longest_first(df, model)
+    assignment, _ = _lpt(df['predicted_seconds'].to_numpy(), chunks)
+    return [df.loc[assignment == i].drop(columns='predicted_seconds') for i in range(chunks)]
+
+
+def estimate_eta(df, model, workers):
+    """
+    Estimate the runtime of a planned run on a number of workers
+    Parameters
+    ----------
+    df: Projects to be processed
+    model: RuntimeModel
+    workers: The number of projects processed at the same time
+
+    Returns
+    -------
+    dict: projects, total (seconds summed over projects), makespan (seconds) and finish (datetime)
+    """
+    costs = model.predict(df)
+    _, makespan = _lpt(costs, workers)
+    return {'projects': len(df), 'total': float(np.sum(costs)), 'makespan': float(makespan),
+            'finish': datetime.now() + timedelta(seconds=float(makespan))}
+
+
+def log_eta(df, model, workers):
+    """
+    Log the ETA of a planned run
+    """
+    eta = estimate_eta(df, model, workers)
+    logger.info('ETA of %s: %d projects, %s of work on %d workers, %s wall time, finishing around %s' % (
+        model.stage, eta['projects'], timedelta(seconds=round(eta['total'])), workers,
+        timedelta(seconds=round(eta['makespan'])), eta['finish'].strftime('%Y-%m-%d %H:%M')))
+    return eta
+
+
+def _training_data(args):
+    df_runs = parse_run_records(args.logs.split(','), args.stage)
+    return df_runs.merge(load_project_features(args.sloc_dir), on='project_id')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runtime model of each stage learned from past runs')
+    parser.add_argument('command', choices=['fit', 'eta', 'outliers'])
+    parser.add_argument('--stage', default='clone_detection', choices=list(FINISHED_PATTERNS.keys()))
+    parser.add_argument('--logs', default='log/clone_detection/*.log',
+                        help="Comma separated log files (or glob patterns) of past runs")
+    parser.add_argument('--sloc_dir', default='result/proj_sloc')
+    parser.add_argument('-l', '--size_level', default='small,medium,large,vlarge',
+                        help="Size levels of the planned run (eta)")
+    parser.add_argument('--workers', type=int, default=utils.getWorkers())
+    parser.add_argument('-k', type=float, default=3.0, help="Robust scales beyond which a run is an outlier")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if args.command == 'fit':
+        df = _training_data(args)
+        model = RuntimeModel(args.stage).fit(df)
+        f = model.save()
+        print('Fitted on %d runs: coef=%s, scale=%.3f; saved in %s' % (model.n, np.round(model.coef, 3), model.scale, f))
+    else:
+        model = RuntimeModel.load(args.stage)
+        if model is None:
+            sys.exit('No runtime model of stage %s; run "fit" first' % args.stage)
+        if args.command == 'eta':
+            df = load_project_features(args.sloc_dir, [x.strip() for x in args.size_level.split(',')])
+            log_eta(df, model, args.workers)
+        else:
+            df = model.flag_outliers(_training_data(args), k=args.k)
+            print(df.loc[df['is_outlier'], ['project_id', 'Code', 'Count', 'seconds', 'predicted_seconds', 'ratio']]
+                  .to_string(index=False))
@@ -1,11 +1,17 @@
 import math
 import os
+import atexit
 import argparse
 import platform
+import signal
 import socket
+import contextvars
+import multiprocessing
 import pandas as pd
-import numpy as np
 import logging
+import logging.handlers
+from queue import Empty
+from contextlib import contextmanager
 from functools import wraps
 from threading import Thread
 from multiprocessing import Process, Pool
@@ -64,6 +70,14 @@ def parse_args_size_level(*args, **kwargs):
                         You can specify on level or multiple levels joined by comma
                         """,
                         required=True)
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=None,
+                        help="Seconds allowed to scc on a single project before it is killed with its process group")
+    parser.add_argument('--timeout_per_kloc',
+                        type=float,
+                        default=0,
+                        help="Seconds added to --timeout per thousand lines of code, estimated from the archive size")
 
     return parser.parse_known_args()
 
@@ -102,7 +116,8 @@ def parse_args_clone_detection(*args, **kwargs):
     parser.add_argument('--granularity',
                         type=str,
                         default='blocks',
-                        help="Currently NiCad can handle granularity: functions and blocks.")
+                        help="Currently NiCad can handle granularity: functions and blocks.\n"
+                             "Comma separated granularities (e.g. functions,blocks) are run on the same extracted project")
     parser.add_argument('--clonetype',
                         type=str,
                         default='default',
@@ -117,7 +132,137 @@ def parse_args_clone_detection(*args, **kwargs):
                              "To detect type 3-2 (near miss rename) clones, setthreshold = 0.3 with rename=blind\n"
                              "To detect type 3-2c (near miss and consistently rename) clones, setthreshold=0.3 with rename=consistent\n"
                              "Note1: type 2 includes type 1, type 3-1 includes type 1, and type 3-2 includes types 1 and 2.\n"
-                             "Note2: default uses type 3-2")
+                             "Note2: default uses type 3-2\n"
+                             "Comma separated clone types (e.g. type1,type2,type3-2) are run on the same extracted project, "
+                             "reusing the source extraction of NiCad; results of each configuration are saved in "
+                             "result/clone_detection/<granularity>_<clonetype>")
+    parser.add_argument('--asyncio',
+                        action='store_true',
+                        dest='use_asyncio',
+                        help="Run NiCad from a single asyncio event loop instead of forking one Python process per chunk")
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=None,
+                        help="Seconds allowed to the external tools (NiCad, JavaFormatter, ...) of a single project "
+                             "before they are killed with their process group; timed out projects are recorded with "
+                             "FailureClass timeout")
+    parser.add_argument('--timeout_per_kloc',
+                        type=float,
+                        default=0,
+                        help="Seconds added to --timeout per thousand lines of code of the project")
+    parser.add_argument('--admission_control',
+                        action='store_true',
+                        help="Reserve disk and memory budget for each project before it is decompressed")
+    parser.add_argument('--disk_headroom_gb',
+                        type=float,
+                        default=10,
+                        help="Free disk (GB) in the temp folder that admission control never hands out to projects")
+    parser.add_argument('--mem_headroom_gb',
+                        type=float,
+                        default=4,
+                        help="Free memory (GB) that admission control never hands out to projects")
+    parser.add_argument('--nicad_batch',
+                        type=int,
+                        default=1,
+                        help="Detect clones of this many small projects with a single NiCad run, whose results are "
+                             "split back per project (clone pairs across projects are discarded); 1 to disable")
+    parser.add_argument('--nicad_batch_max_mb',
+                        type=float,
+                        default=1,
+                        help="Projects with at most this much java code (MB) are batched by --nicad_batch")
+    parser.add_argument('--fragment_cache',
+                        action='store_true',
+                        help="With --remove_logging, reuse the NiCad fragments of files unchanged since the original-project "
+                             "run (see result/fragment_cache) and extract only the files changed by logging removal")
+    parser.add_argument('--work_queue',
+                        type=str,
+                        default=None,
+                        help="Lease projects from a work queue shared by several nodes instead of splitting them by chunks. "
+                             "A *.sqlite file for a single node, otherwise a directory on the shared file system")
+    parser.add_argument('--lease_ttl',
+                        type=float,
+                        default=600,
+                        help="Seconds a project lease stays valid without heartbeat before other workers reclaim it")
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help="Run every worker under cProfile and write a merged report to log/profile")
+    parser.add_argument('--progress',
+                        action='store_true',
+                        help="Show live progress, throughput and ETA on the terminal")
+    parser.add_argument('--metrics_interval',
+                        type=float,
+                        default=15,
+                        help="Seconds between two updates of the metrics file log/metrics/<stage>.prom")
+    return parser.parse_known_args()
+
+
+def parse_args_log_remover(*args, **kwargs):
+    parser = argparse.ArgumentParser(description='Input args for removing logging statements from sampled projects', *args, **kwargs)
+    parser.add_argument('--work_queue',
+                        type=str,
+                        default=None,
+                        help="Lease projects from a work queue shared by several nodes instead of splitting them by chunks. "
+                             "A *.sqlite file for a single node, otherwise a directory on the shared file system")
+    parser.add_argument('--lease_ttl',
+                        type=float,
+                        default=600,
+                        help="Seconds a project lease stays valid without heartbeat before other workers reclaim it")
+    parser.add_argument('--admission_control',
+                        action='store_true',
+                        help="Reserve disk and memory budget for each project before it is decompressed")
+    parser.add_argument('--disk_headroom_gb',
+                        type=float,
+                        default=10,
+                        help="Free disk (GB) in the temp folder that admission control never hands out to projects")
+    parser.add_argument('--mem_headroom_gb',
+                        type=float,
+                        default=4,
+                        help="Free memory (GB) that admission control never hands out to projects")
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help="Run every worker under cProfile and write a merged report to log/profile")
+    parser.add_argument('--progress',
+                        action='store_true',
+                        help="Show live progress, throughput and ETA on the terminal")
+    parser.add_argument('--metrics_interval',
+                        type=float,
+                        default=15,
+                        help="Seconds between two updates of the metrics file log/metrics/<stage>.prom")
+    parser.add_argument('--shard_size_mb',
+                        type=float,
+                        default=None,
+                        help="Split projects with more java code (MB) than this into file shards processed by a pool")
+    parser.add_argument('--shard_workers',
+                        type=int,
+                        default=None,
+                        help="The number of file shards (and pool size) of a large project, default to all workers")
+    parser.add_argument('--in_memory',
+                        action='store_true',
+                        help="Read, clean and archive projects in memory; the temp folder only gets the cleaned tree")
+    parser.add_argument('--logging_index',
+                        type=str,
+                        default=None,
+                        help="Look up files with logging call sites in this index (SQLite, updated before the run) "
+                             "instead of grepping every project")
+    parser.add_argument('--shared_project_link',
+                        choices=['symlink', 'hardlink', 'none'],
+                        default='symlink',
+                        help="Clean a project sampled by several repeats once and link it into every repeat; "
+                             "none to clean it again per repeat")
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=None,
+                        help="Seconds allowed to the external tools (JavaFormatter, grep, ...) of a single project "
+                             "before they are killed with their process group; timed out projects are skipped next time")
+    parser.add_argument('--timeout_per_kloc',
+                        type=float,
+                        default=0,
+                        help="Seconds added to --timeout per thousand lines of code of the project")
+    parser.add_argument('--blob_store',
+                        type=str,
+                        default=None,
+                        help="Memoize the formatting, scanning and edits of java files by content in this store "
+                             "(SQLite), so that files shared by several projects are processed once")
     return parser.parse_known_args()
 
 
@@ -170,6 +315,11 @@ def getPath(param_str: str, ischeck=False):
         },
     }
 
+    # Environment overrides, e.g. LOGGINGBENCH_NICAD_ROOT (used by src/benchmark to point at stubs)
+    p = os.environ.get('LOGGINGBENCH_' + param_str.upper())
+    if p is not None:
+        return check_existance(p) if ischeck else p
+
     try:
         # Get path: By key --> OS
         p = pathes[param_str.upper()][platform.system().upper()]
@@ -274,7 +424,9 @@ def chunkify(data, chunks):
         project_info_chunks = [data[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(chunks)]
         return project_info_chunks
     elif isinstance(data, pd.DataFrame):
-        df_split = np.array_split(data, chunks)
+        # np.array_split returns ndarrays for dataframes on recent numpy, so split by position
+        k, m = divmod(len(data), chunks)
+        df_split = [data.iloc[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(chunks)]
         return df_split
 
 
@@ -285,18 +437,178 @@ def output_prepare(f):
         os.remove(os.path.abspath(f))
 
 
+LOG_FORMAT = '%(asctime)s - %(process)d - %(levelname)s - %(context)s%(message)s'
+LOG_DATEFMT = '%d-%b-%y %H:%M:%S'
+
+# Per-project context attached to every log record; contextvars keeps it apart between threads and asyncio tasks
+_log_context = contextvars.ContextVar('log_context', default=None)
+# The central log listener: (queue, listener process, pid of the process owning the listener)
+_log_listener = None
+
+
+class _ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    Send records to the central log listener, tagged with the target log file and the current log context
+    """
+    def __init__(self, queue, f_log):
+        super().__init__(queue)
+        self.f_log = f_log
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        record.f_log = self.f_log
+        record.context = _format_log_context()
+        return record
+
+
+class _ContextFileHandler(logging.FileHandler):
+    """
+    Write records directly into the log file; used where no central log listener is available
+    """
+    def __init__(self, f_log):
+        super().__init__(f_log)
+        self.f_log = f_log
+        self.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT))
+
+    def emit(self, record):
+        record.context = _format_log_context()
+        super().emit(record)
+
+
+def _format_log_context():
+    ctx = _log_context.get()
+    if not ctx:
+        return ''
+    return '[%s] ' % ' '.join('%s=%s' % (k, v) for k, v in ctx.items())
+
+
+def _log_listener_loop(queue, batch_size=500, flush_interval=1.0):
+    """
+    The single process writing all log files: records are drained from the queue in batches,
+    and each log file is written and flushed once per batch
+    """
+    # Ctrl+C is handled by the parent, which stops the listener after the workers are gone
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    formatter = logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT)
+    files = {}
+    stopped = False
+    while not stopped:
+        try:
+            batch = [queue.get(timeout=flush_interval)]
+        except Empty:
+            continue
+        while len(batch) < batch_size:
+            try:
+                batch.append(queue.get_nowait())
+            except Empty:
+                break
+        lines = {}
+        for record in batch:
+            if record is None:
+                stopped = True
+                continue
+            lines.setdefault(record.f_log, []).append(formatter.format(record))
+        for f_log, f_lines in lines.items():
+            if f_log not in files:
+                files[f_log] = open(f_log, 'a')
+            files[f_log].write('\n'.join(f_lines) + '\n')
+            files[f_log].flush()
+    for w in files.values():
+        w.close()
+
+
+def _stop_log_listener():
+    global _log_listener
+    if _log_listener is None or _log_listener[2] != os.getpid():
+        return
+    queue, listener, _ = _log_listener
+    queue.put(None)
+    listener.join()
+    _log_listener = None
+
+
+def _get_log_queue():
+    """
+    Get the queue of the central log listener; the listener is started on first use in the main process
+    Forked workers inherit the queue, so that all their records are written by the same listener
+    Returns
+    -------
+    queue, or None if the listener cannot be started in this process
+    """
+    global _log_listener
+    if _log_listener is not None:
+        return _log_listener[0]
+    if multiprocessing.parent_process() is not None:
+        # A child that did not inherit a listener (e.g. spawn start method) must not start its own
+        return None
+    queue = multiprocessing.Queue(-1)
+    listener = Process(target=_log_listener_loop, args=(queue,), daemon=True)
+    listener.start()
+    _log_listener = (queue, listener, os.getpid())
+    atexit.register(_stop_log_listener)
+    return queue
+
+
 def setlogger(f_log, logger=None, level=logging.INFO):
+    """
+    Log into f_log through the central log listener, so that workers never write log files themselves
+    Parameters
+    ----------
+    f_log: The log file
+    logger: The name of the logger to be configured, root logger if None.
+            A named logger keeps its own file; the root logger also writes into it if not configured yet
+    level: The logging level
+
+    Returns
+    -------
+    The configured logger
+    """
+    f_log = os.path.abspath(f_log)
     if not os.path.isdir(os.path.dirname(f_log)):
         os.makedirs(os.path.dirname(f_log))
-    logging.basicConfig(
-        filename=os.path.join(f_log),
-        level=level,
-        format='%(asctime)s - %(process)d - %(levelname)s - %(message)s',
-        datefmt='%d-%b-%y %H:%M:%S')
+
+    def make_handler():
+        queue = _get_log_queue()
+        if queue is None:
+            return _ContextFileHandler(f_log)
+        return _ContextQueueHandler(queue, f_log)
+
+    root = logging.getLogger()
+    own_handlers = [h for h in root.handlers if hasattr(h, 'f_log')]
     if logger:
-        return logging.getLogger(logger)
+        target = logging.getLogger(logger)
+        if not any(getattr(h, 'f_log', None) == f_log for h in target.handlers):
+            target.addHandler(make_handler())
+        target.propagate = False
+        if not own_handlers:
+            root.addHandler(make_handler())
+            root.setLevel(level)
     else:
-        return logging.getLogger()
+        target = root
+        if [h.f_log for h in own_handlers] != [f_log]:
+            # The latest root configuration wins
+            for h in own_handlers:
+                root.removeHandler(h)
+            root.addHandler(make_handler())
+    target.setLevel(level)
+    return target
+
+
+@contextmanager
+def log_context(**kwargs):
+    """
+    Attach context (e.g. project_id) to all records logged within the with block
+    Parameters
+    ----------
+    kwargs: The context to be attached
+    """
+    ctx = dict(_log_context.get() or {})
+    ctx.update(kwargs)
+    token = _log_context.set(ctx)
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
 
 def setRWLock():
     # Setup io lock
@@ -0,0 +1,436 @@
+"""
+Lease-based work queue shared by several workers/nodes
+Each worker atomically leases a project with an expiry, sends heartbeats while processing it and marks it done.
+Leases of crashed workers expire and are reclaimed by other workers.
+Two backends are supported:
+    - A directory on a shared file system (claims rely on atomic O_EXCL create/rename, fine on NFSv3+)
+    - A SQLite file (for single-node runs and local tests; do not put it on NFS)
+"""
+import os
+import sys
+import abc
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import argparse
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import src.util.utils as utils
+
+logger = logging.getLogger(__name__)
+
+
+def get_owner():
+    """
+    The identity of the current worker: <hostname>:<pid>
+    """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue(abc.ABC):
+    """
+    Interface of a lease-based work queue
+    Tasks are identified by project id; namespace separates independent runs on the same storage (e.g. repeats)
+    """
+    def __init__(self, path, namespace='default', ttl=600, max_attempts=3):
+        """
+        Parameters
+        ----------
+        path: The storage of the queue
+        namespace: The name of the task list
+        ttl: Seconds a lease is valid without heartbeat
+        max_attempts: A task whose lease expired this many times is marked failed instead of leased again
+        """
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+
+    @abc.abstractmethod
+    def add(self, project_ids):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def lease(self, owner):
+        """
+        Lease the next available project
+        Returns
+        -------
+        project_id or None if nothing is left to lease
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def heartbeat(self, project_id, owner):
+        """
+        Extend the lease of a project
+        Returns
+        -------
+        False if the lease is no longer held by owner
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def done(self, project_id, owner):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def release(self, project_id, owner):
+        """
+        Give a leased project back to the queue, e.g. when its worker hit an exception
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def counts(self):
+        """
+        Returns
+        -------
+        dict: state -> number of projects
+        """
+        raise NotImplementedError
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """
+    Work queue stored in a SQLite file; every lease is a single IMMEDIATE transaction
+    """
+    def __init__(self, path, namespace='default', ttl=600, max_attempts=3):
+        super().__init__(path, namespace, ttl, max_attempts)
+        if os.path.dirname(path):
+            utils.create_folder_if_not_exist(os.path.dirname(path))
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connect().execute(
+                'CREATE TABLE IF NOT EXISTS tasks ('
+                'namespace TEXT, project_id INTEGER, state TEXT, owner TEXT, '
+                'expires REAL, attempts INTEGER, updated REAL, '
+                'PRIMARY KEY (namespace, project_id))')
+
+    def _connect(self):
+        # A SQLite connection must not be shared with forked children
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def add(self, project_ids):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(
+                "INSERT OR IGNORE INTO tasks VALUES (?, ?, 'pending', NULL, 0, 0, ?)",
+                [(self.namespace, int(x), now) for x in project_ids])
+            conn.execute('COMMIT')
+
+    def lease(self, owner):
+        with self._lock:
+            conn = self._connect()
+            while True:
+                now = time.time()
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    res = conn.execute(
+                        "SELECT project_id, state, attempts FROM tasks WHERE namespace = ? AND "
+                        "(state = 'pending' OR (state = 'leased' AND expires < ?)) "
+                        "ORDER BY project_id LIMIT 1", (self.namespace, now)).fetchone()
+                    if res is None:
+                        conn.execute('COMMIT')
+                        return None
+                    project_id, state, attempts = res
+                    if state == 'leased':
+                        logger.warning('Reclaim expired lease of project %d' % project_id)
+                    if attempts >= self.max_attempts:
+                        conn.execute("UPDATE tasks SET state = 'failed', owner = NULL, updated = ? "
+                                     "WHERE namespace = ? AND project_id = ?", (now, self.namespace, project_id))
+                        conn.execute('COMMIT')
+                        logger.error('Project %d failed after %d attempts' % (project_id, attempts))
+                        continue
+                    conn.execute("UPDATE tasks SET state = 'leased', owner = ?, expires = ?, "
+                                 "attempts = attempts + 1, updated = ? WHERE namespace = ? AND project_id = ?",
+                                 (owner, now + self.ttl, now, self.namespace, project_id))
+                    conn.execute('COMMIT')
+                    return project_id
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+
+    def _update_own(self, sql, params, project_id, owner):
+        with self._lock:
+            cur = self._connect().execute(
+                sql + " WHERE namespace = ? AND project_id = ? AND owner = ? AND state = 'leased'",
+                params + (self.namespace, int(project_id), owner))
+            return cur.rowcount > 0
+
+    def heartbeat(self, project_id, owner):
+        now = time.time()
+        return self._update_own('UPDATE tasks SET expires = ?, updated = ?', (now + self.ttl, now),
+                                project_id, owner)
+
+    def done(self, project_id, owner):
+        return self._update_own("UPDATE tasks SET state = 'done', updated = ?", (time.time(),),
+                                project_id, owner)
+
+    def release(self, project_id, owner):
+        return self._update_own("UPDATE tasks SET state = 'pending', owner = NULL, updated = ?", (time.time(),),
+                                project_id, owner)
+
+    def counts(self):
+        with self._lock:
+            res = self._connect().execute('SELECT state, COUNT(*) FROM tasks WHERE namespace = ? GROUP BY state',
+                                          (self.namespace,)).fetchall()
+        return dict(res)
+
+
+class FileWorkQueue(WorkQueue):
+    """
+    Work queue stored as marker files on a shared file system
+    <path>/<namespace>/tasks/<id>   task list
+    <path>/<namespace>/leases/<id>  lease: "<owner> <expires> <attempts>", created with O_EXCL
+    <path>/<namespace>/attempts/<id> attempts of a released project, kept while it is not leased
+    <path>/<namespace>/done/<id>    finished
+    <path>/<namespace>/failed/<id>  given up after max_attempts
+    """
+    def __init__(self, path, namespace='default', ttl=600, max_attempts=3):
+        super().__init__(path, namespace, ttl, max_attempts)
+        self.d = os.path.join(path, namespace)
+        for sub in ['tasks', 'leases', 'attempts', 'done', 'failed']:
+            utils.create_folder_if_not_exist(os.path.join(self.d, sub))
+
+    def _f(self, sub, project_id):
+        return os.path.join(self.d, sub, str(project_id))
+
+    def _read_lease(self, f):
+        try:
+            with open(f) as r:
+                owner, expires, attempts = r.read().split()
+            return owner, float(expires), int(attempts)
+        except (OSError, ValueError):
+            # Missing, or caught between create and write
+            return None
+
+    def _write_lease(self, f, owner, attempts):
+        self._write_atomic(f, '{} {} {}'.format(owner, time.time() + self.ttl, attempts))
+
+    @staticmethod
+    def _write_atomic(f, text):
+        # Replace the file atomically so readers never see a partial content
+        f_tmp = '{}.{}.tmp'.format(f, uuid.uuid4().hex)
+        with open(f_tmp, 'w') as w:
+            w.write(text)
+        os.replace(f_tmp, f)
+
+    def _read_attempts(self, project_id):
+        try:
+            with open(self._f('attempts', project_id)) as r:
+                return int(r.read())
+        except (OSError, ValueError):
+            return 0
+
+    def add(self, project_ids):
+        for project_id in project_ids:
+            f = self._f('tasks', int(project_id))
+            if not os.path.isfile(f):
+                open(f, 'a').close()
+
+    def _try_claim(self, project_id, owner, attempts):
+        f_lease = self._f('leases', project_id)
+        try:
+            fd = os.open(f_lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        os.close(fd)
+        self._write_lease(f_lease, owner, attempts)
+        return True
+
+    def _reclaim(self, project_id):
+        """
+        Remove an expired lease; only one of the competing workers wins the rename
+        Returns
+        -------
+        The attempts of the reclaimed lease, or None if not reclaimed
+        """
+        f_lease = self._f('leases', project_id)
+        lease = self._read_lease(f_lease)
+        if lease is None or lease[1] >= time.time():
+            return None
+        f_stale = '{}.stale.{}'.format(f_lease, uuid.uuid4().hex)
+        try:
+            os.rename(f_lease, f_stale)
+        except FileNotFoundError:
+            return None
+        stale = self._read_lease(f_stale)
+        if stale is not None and stale[1] >= time.time():
+            # The owner sent a heartbeat in between; put its lease back
+            try:
+                os.link(f_stale, f_lease)
+            except FileExistsError:
+                pass
+            os.remove(f_stale)
+            return None
+        os.remove(f_stale)
+        logger.warning('Reclaim expired lease of project %s' % project_id)
+        return lease[2]
+
+    def lease(self, owner):
+        finished = set(os.listdir(os.path.join(self.d, 'done'))) | set(os.listdir(os.path.join(self.d, 'failed')))
+        for name in sorted(os.listdir(os.path.join(self.d, 'tasks')), key=int):
+            if name in finished:
+                continue
+            project_id = int(name)
+            attempts = self._read_attempts(project_id)
+            if os.path.exists(self._f('leases', project_id)):
+                reclaimed = self._reclaim(project_id)
+                if reclaimed is None:
+                    continue
+                attempts = max(attempts, reclaimed)
+            if attempts >= self.max_attempts:
+                open(self._f('failed', project_id), 'a').close()
+                logger.error('Project %d failed after %d attempts' % (project_id, attempts))
+                continue
+            if self._try_claim(project_id, owner, attempts + 1):
+                # The done marker is written before the lease is removed, so a project finished
+                # since the listing above is caught here
+                if os.path.exists(self._f('done', project_id)) or os.path.exists(self._f('failed', project_id)):
+                    os.remove(self._f('leases', project_id))
+                    continue
+                return project_id
+        return None
+
+    def _is_owner(self, project_id, owner):
+        lease = self._read_lease(self._f('leases', project_id))
+        return lease is not None and lease[0] == owner
+
+    def heartbeat(self, project_id, owner):
+        lease = self._read_lease(self._f('leases', project_id))
+        if lease is None or lease[0] != owner:
+            return False
+        self._write_lease(self._f('leases', project_id), owner, lease[2])
+        return True
+
+    def done(self, project_id, owner):
+        if not self._is_owner(project_id, owner):
+            return False
+        open(self._f('done', project_id), 'a').close()
+        os.remove(self._f('leases', project_id))
+        return True
+
+    def release(self, project_id, owner):
+        lease = self._read_lease(self._f('leases', project_id))
+        if lease is None or lease[0] != owner:
+            return False
+        # The lease file goes away, its attempts must not: a project failing on every try ends up in failed/
+        self._write_atomic(self._f('attempts', project_id), str(lease[2]))
+        os.remove(self._f('leases', project_id))
+        return True
+
+    def counts(self):
+        tasks = set(os.listdir(os.path.join(self.d, 'tasks')))
+        done = tasks & set(os.listdir(os.path.join(self.d, 'done')))
+        failed = tasks & set(os.listdir(os.path.join(self.d, 'failed')))
+        leased = tasks & set(os.listdir(os.path.join(self.d, 'leases'))) - done - failed
+        return {'pending': len(tasks - done - failed - leased), 'leased': len(leased),
+                'done': len(done), 'failed': len(failed)}
+
+
+def open_work_queue(path, namespace='default', ttl=600, max_attempts=3):
+    """
+    Open a work queue: a *.sqlite/*.db file uses SQLite, anything else is treated as a shared directory
+    """
+    if path.endswith(('.sqlite', '.db')):
+        return SQLiteWorkQueue(path, namespace=namespace, ttl=ttl, max_attempts=max_attempts)
+    return FileWorkQueue(path, namespace=namespace, ttl=ttl, max_attempts=max_attempts)
+
+
+class Heartbeat(threading.Thread):
+    """
+    Keep a lease alive while its project is being processed
+    """
+    def __init__(self, queue, project_id, owner, interval):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.project_id = project_id
+        self.owner = owner
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            if not self.queue.heartbeat(self.project_id, self.owner):
+                logger.error('Lost the lease of project %s' % self.project_id)
+                return
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def run_leased(df, func, queue):
+    """
+    Lease projects one by one and run func on the single-row dataframe of each project
+    Parameters
+    ----------
+    df: The dataframe with all projects in the queue
+    func: The function processing a dataframe of projects, e.g. CloneDetection.clone_detection_in_project
+    queue: The work queue
+    """
+    owner = get_owner()
+    df_by_id = df.set_index(df['project_id'].astype(int), drop=False)
+    while True:
+        project_id = queue.lease(owner)
+        if project_id is None:
+            break
+        if project_id not in df_by_id.index:
+            # Queued by another run with a different project list
+            queue.release(project_id, owner)
+            logger.warning('Project %d is not in the project list of this worker; released' % project_id)
+            continue
+        heartbeat = Heartbeat(queue, project_id, owner, interval=queue.ttl / 3)
+        heartbeat.start()
+        try:
+            func(df_by_id.loc[[project_id]])
+        except Exception as e:
+            logger.error('Project %d failed in worker %s: %s' % (project_id, owner, str(e)))
+            heartbeat.stop()
+            queue.release(project_id, owner)
+            continue
+        heartbeat.stop()
+        queue.done(project_id, owner)
+
+
+def run_leased_workers(df, func, queue, workers=None):
+    """
+    Start workers processes on this node, each leasing projects from the queue until it is drained
+    Parameters
+    ----------
+    df: The dataframe with all projects in the queue
+    func: The function processing a dataframe of projects
+    queue: The work queue; projects in df are added to it if missing
+    workers: The number of processes, default to utils.getWorkers()
+    """
+    queue.add(df['project_id'])
+    jobs = []
+    for _ in range(workers or utils.getWorkers()):
+        jobs.append(
+            multiprocessing.Process(target=run_leased, args=(df, func, queue, ))
+        )
+    [j.start() for j in jobs]
+    [j.join() for j in jobs]
+    logger.info('Work queue %s (%s): %s' % (queue.path, queue.namespace, queue.counts()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show the progress of a work queue')
+    parser.add_argument('path', type=str, help="The work queue: a *.sqlite file or a shared directory")
+    parser.add_argument('--namespace', type=str, default='default', help="The namespace of the task list")
+    args = parser.parse_args()
+    utils.print_msg_box('\n'.join('{}: {}'.format(k, v) for k, v in
+                                  sorted(open_work_queue(args.path, namespace=args.namespace).counts().items())),
+                        title='Work queue %s' % args.path)